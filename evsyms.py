@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+シンボル表（code -> 名前）。understeer.py と export_mapping_defaults.py が共有する唯一の定義。
+import 時に 1 回だけ作り、全ローダ/エコー/デバッグ/TSV 書き出しで同じ名前を使う。
+"""
+import re
+from typing import Dict
+
+from evdev import ecodes
+
+# evdev は同じコードに別名をタプル（古い版はリスト）で持つ。範囲マーカー名は避け、
+# 既存 TSV/VIRTUAL_*_ORDER が使っている名前を優先する
+_SYM_SKIP = re.compile(r"_(MIN|MAX|CNT|MISC)$|^KEY_MIN_INTERESTING$|^FF_(EFFECT|WAVEFORM)_|^FF_MAX_EFFECTS$"
+                       r"|^BTN_(MOUSE|JOYSTICK|GAMEPAD|DIGI|WHEEL)$")
+_SYM_PREFERRED = {"BTN_A", "BTN_B", "BTN_X", "BTN_Y", "BTN_TRIGGER_HAPPY1", "KEY_MUTE"}
+
+
+def build_symbol_table(tbl) -> Dict[int, str]:
+    out: Dict[int, str] = {}
+    for code, names in tbl.items():
+        if isinstance(names, str):
+            out[int(code)] = names
+            continue
+        names = list(names)
+        pref = [n for n in names if n in _SYM_PREFERRED]
+        ok = [n for n in names if not _SYM_SKIP.search(n)]
+        out[int(code)] = (pref or ok or names)[0]
+    return out
+
+
+ABS_NAMES: Dict[int, str] = build_symbol_table(ecodes.ABS)
+BTN_NAMES: Dict[int, str] = build_symbol_table(ecodes.BTN)
+KEY_NAMES: Dict[int, str] = {**build_symbol_table(ecodes.KEY), **BTN_NAMES}   # EV_KEY 全体
+FF_NAMES:  Dict[int, str] = build_symbol_table(ecodes.FF)
@@ -88,17 +88,14 @@ def tag_from_name(name: str) -> str:
         return "shift"
     return "src"
 
+# code -> 名前 の逆引き表。understeer.py と同じ evsyms.py の表を使う（別名ポリシーを 2 か所に持たない）
+from evsyms import ABS_NAMES, KEY_NAMES
+
 def resolve_abs_name(code: int) -> str:
-    try:
-        return ecodes.bytype(ecodes.EV_ABS, int(code))
-    except Exception:
-        return f"ABS_{code}"
+    return ABS_NAMES.get(int(code)) or f"ABS_{code}"
 
 def resolve_key_name(code: int) -> str:
-    try:
-        return ecodes.bytype(ecodes.EV_KEY, int(code))
-    except Exception:
-        return f"KEY_{code}"
+    return KEY_NAMES.get(int(code)) or f"KEY_{code}"
 
 # ---------- ここから /dev/input/jsN 由来の “JsTest の番号” を取り出す ----------
 # linux/joystick.h より（ioctl 番号）
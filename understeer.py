@@ -22,9 +22,13 @@ import logging
 import time
 from dataclasses import dataclass
 from typing import Optional, Dict, Tuple
+from collections.abc import Mapping
+from types import MappingProxyType
 import os
+import json
 import re
 import sys
+import sysconfig
 from dataclasses import dataclass
 
 from typing import Dict, List, Optional, Set, Tuple
@@ -38,87 +42,39 @@ import threading
 import struct
 import ctypes
 import traceback
+from array import array
+import heapq
+import operator
+import math
+import select
+import concurrent.futures
+import mmap
 
 import errno, struct
 
 
 import time
 import logging
-from collections import defaultdict
 
 import sys, logging, signal
 import faulthandler; faulthandler.enable()  # 例外時・終了時にスタックを必ず出す
 from evdev.ecodes import ABS
 
-from evdev.ecodes import ABS as EC_ABS
-
 import os
-from collections import defaultdict
+import stat
 
 # =========================
-# Button merge debugger/logic
+# シンボル表（code -> 名前）。定義は evsyms.py の 1 か所だけ（export_mapping_defaults.py と共有）
 # =========================
-class ButtonMerger:
-    """
-    複数ソース→同一仮想ボタンの合流器。
-    ・OR論理：active_count[vcode] > 0 なら仮想は押下
-    ・エッジ検出：source_edge[(stype,scode)] で直前状態を保持
-    """
-    def __init__(self, debug: bool = False, name_resolver=None):
-        self.debug = debug
-        self._active_count = defaultdict(int)         # vcode -> active sources
-        self._src_state = {}                          # (stype,scode) -> 0/1
-        self._name = name_resolver or (lambda code: f"BTN_{code}")
+from evsyms import ABS_NAMES, BTN_NAMES, KEY_NAMES, FF_NAMES
+FF_TYPE_LABELS: Dict[int, str] = {c: f"{n[3:]}({c})" for c, n in FF_NAMES.items()}   # 82 -> 'CONSTANT(82)'
 
-    def reset(self):
-        self._active_count.clear()
-        self._src_state.clear()
+def key_name(code: int) -> str:
+    """EV_KEY コード → 'BTN_*' / 'KEY_*'（不明なら 'KEY_<code>'）"""
+    return KEY_NAMES.get(code) or f"KEY_{code}"
 
-    def update(self, src_key, vcode: int, pressed: int, now_ms: int = 0):
-        """
-        src_key: ("KEY", scode) 等、物理キー識別子
-        pressed: 1/0
-        戻り値: [(vcode, new_state)] が必要なら1件返す。状態不変なら []。
-        """
-        prev_src = self._src_state.get(src_key, 0)
-        if prev_src == pressed:
-            # 物理側で状態変化なし（抑制）
-            if self.debug:
-                print(f"[MERGE] src unchanged {src_key}={pressed} v:{vcode} "
-                      f"active={self._active_count.get(vcode,0)}")
-            return []
-
-        self._src_state[src_key] = pressed
-        # カウント更新
-        if pressed:
-            self._active_count[vcode] += 1
-        else:
-            self._active_count[vcode] = max(0, self._active_count[vcode]-1)
-
-        active = self._active_count[vcode]
-        new_v_state = 1 if active > 0 else 0
-        # 仮想の前状態を推定：active>1→押下継続、active==1→今回で押下、active==0→今回で解放
-        # ただし確実にエッジでのみ発火
-        emit = []
-        # 前状態は active 変更前に推定したいが、カウンタ方式では簡便化：
-        #   (pressed=1 で active==1) => 押下エッジ
-        #   (pressed=0 で active==0) => 解放エッジ
-        if pressed and active == 1:
-            emit = [(vcode, 1)]
-        elif (not pressed) and active == 0:
-            emit = [(vcode, 0)]
-
-        if self.debug:
-            vname = self._name(vcode)
-            print(f"[MERGE] src {src_key} -> {vname} {'DOWN' if pressed else 'UP'}  "
-                  f"active={active}  emit={emit}")
-        return emit
-
-    def dump_state(self):
-        return {
-            "active_count": dict(self._active_count),
-            "sources": {str(k): v for k, v in self._src_state.items()},
-        }
+def abs_name(code: int) -> str:
+    return ABS_NAMES.get(code) or f"ABS_{code}"
 
 def _resolveAbsCode(code_or_name):
     """ 'ABS_2' / 'ABS_THROTTLE' / 2 → int （失敗 None）"""
@@ -129,7 +85,7 @@ def _resolveAbsCode(code_or_name):
         return int(s)
     if s.startswith("ABS_") and s[4:].isdigit():
         return int(s.split("_",1)[1])
-    return EC_ABS.get(s, None)
+    return ecodes.ecodes.get(s, None) if s.startswith("ABS_") else None
 
 from evdev.ecodes import ecodes as EC  # 名前→コードの総合辞書
 
@@ -171,25 +127,6 @@ def _resolveKeyCode(code_or_name):
     # ここまで整えた名前で evdev の総合辞書を引く
     return EC.get(s, None)
 
-def _findReverseOption(axisMappings, srcTag: str, srcCode: int):
-    """
-    axisMappings から srcTag × srcCode に合致する行を探し、
-    {'reverse': True/False, ...} を返す。無ければ None。
-    ※ srcAbs が 'ABS_2' 文字列で入っていても吸収する。
-    """
-    logging.debug("_findReverseOption")
-    logging.debug(srcTag)
-    logging.debug(srcCode)
-    target = int(srcCode)
-    for row in axisMappings:
-        tag = (row.get("srcTag") or "").strip().lower()
-        if tag != srcTag:
-            continue
-        cand = int(row.get("srcAbs"))
-        if cand == target:
-            return row.get("options")
-    return None
-
 # SIGUSR1 を送ると全スレッドのスタックを即時ダンプできる:
 def _dump_stacks(signum, frame):
     faulthandler.dump_traceback(file=sys.stderr, all_threads=True)
@@ -198,7 +135,6 @@ signal.signal(getattr(signal, "SIGUSR1", signal.SIGINT), _dump_stacks)
 # ログ詳細化（必要なら上書き）
 logging.getLogger().setLevel(logging.DEBUG)
 
-axisMappings = []
 def invertRawValue(v: int, vmin: int, vmax: int) -> int:
     # 中心反転の一般式。双極/単極どちらでもOK。
     return vmin + vmax - v
@@ -252,8 +188,16 @@ def _normalize_groups(groups):
 def parseOptionsCell(cell: str) -> dict:
     """
     最後の列のオプション文字列をパース。
-    例: "REVERSE DEADZONE=200" → {"reverse": True, "deadzone": 200}
-    今回はREVERSEのみ使えばOK。拡張を見越して汎用に。
+    例: "REVERSE DEADZONE=3 GAMMA=1.5 RATE=500"
+      REVERSE          : 軸反転
+      RATE=<Hz>        : 仮想軸への出力レート上限（中間サンプルは捨てて最新値のみ定周期で送出）
+      DEADZONE[=<%>]   : デッドゾーン（値省略時は既定の 2.5%）。双極軸は中心、UNIPOLAR は下端
+      SAT=<%>          : サチュレーション（この位置で出力が最大に張り付く）
+      GAMMA=<g>        : 応答カーブ（1.0=リニア、>1 で中心/踏み始めが鈍く）
+      EMA=<alpha>      : 指数移動平均（0 < alpha <= 1、小さいほど滑らか）
+      ONEEURO=<mincutoff>[,<beta>] : One-Euro フィルタ
+      CENTER           : 静止時の実測センター追従（ドリフト吸収）
+      UNIPOLAR         : ペダル等の片側軸として扱う（min→max）
     """
     opts = {"reverse": False}
     if not cell:
@@ -261,17 +205,155 @@ def parseOptionsCell(cell: str) -> dict:
     tokens = [t.strip() for t in cell.split() if t.strip()]
     for t in tokens:
         u = t.upper()
-        if u in ("REVERSE", "INV", "INVERT", "INVERTED"):
-            opts["reverse"] = True
-        # 拡張例（将来用）:
-        # elif u.startswith("DEADZONE="):
-        #     try:
-        #         opts["deadzone"] = int(u.split("=",1)[1])
-        #     except ValueError:
-        #         pass
+        key, _, val = u.partition("=")
+        try:
+            if u in ("REVERSE", "INV", "INVERT", "INVERTED"):
+                opts["reverse"] = True
+            elif key == "RATE":
+                hz = int(val)
+                if hz > 0:
+                    opts["rate"] = hz
+            elif key in ("DEADZONE", "DZ"):
+                opts["deadzone"] = float(val.rstrip("%")) if val else None
+            elif key in ("SAT", "SATURATION"):
+                opts["saturation"] = float(val.rstrip("%"))
+            elif key == "GAMMA":
+                opts["gamma"] = float(val)
+            elif key == "EMA":
+                opts["ema"] = float(val)
+            elif key in ("ONEEURO", "1EURO"):
+                parts = val.split(",")
+                opts["oneeuro"] = (float(parts[0]), float(parts[1]) if len(parts) > 1 else 0.0)
+            elif u in ("CENTER", "TRACKCENTER"):
+                opts["track_center"] = True
+            elif u in ("UNIPOLAR", "PEDAL"):
+                opts["unipolar"] = True
+        except (ValueError, IndexError):
+            logging.warning("オプション指定が不正: %s", t)
     return opts
 
-from evdev.ecodes import ABS as EC_ABS
+
+# 1 軸あたりの LUT 上限（raw の幅がこれを超える軸は都度計算にフォールバック）
+_AXIS_LUT_MAX = 1 << 17
+
+class _AxisChain:
+    """
+    物理軸 1 本ぶんの整形チェーン（TSV オプションからロード時にコンパイル）。
+      raw → [センター追従] → LUT(反転/デッドゾーン/サチュレーション/ガンマ/仮想レンジ変換) → [EMA / One-Euro]
+    LUT は raw 全域ぶんの整数配列。ホットパスは配列 1 回引き＋指定時のみ小さな状態更新。
+    オプション無しなら従来の _lin_piecewise と同じ値になる。
+    """
+    __slots__ = ("smin", "smax", "c0", "lut", "last", "track", "_c_q16", "_dz_track",
+                 "_ema_a", "_ema_q16", "_euro", "_euro_x", "_euro_dx", "_euro_t",
+                 "_shape_args")
+
+    def __init__(self, smin: int, smax: int, dmin: int, dc: int, dmax: int,
+                 opts: Optional[dict] = None, dz_default_pct: float = 2.5):
+        opts = opts if isinstance(opts, dict) else {}
+        self.smin, self.smax = int(smin), int(smax)
+        self.c0 = (self.smin + self.smax) // 2
+        full = max(1, self.smax - self.smin)
+
+        dz = opts.get("deadzone", 0.0) if "deadzone" in opts else 0.0
+        if dz is None:
+            dz = dz_default_pct
+        sat = opts.get("saturation", 100.0)
+        self._shape_args = (bool(opts.get("reverse")), bool(opts.get("unipolar")),
+                            max(0.0, min(dz, 99.0)) / 100.0,
+                            max(1.0, min(sat, 100.0)) / 100.0,
+                            max(0.05, float(opts.get("gamma", 1.0))),
+                            int(dmin), int(dc), int(dmax))
+
+        # raw 全域を先に計算しておく
+        if full + 1 <= _AXIS_LUT_MAX:
+            self.lut = array('i', (self._shape(r) for r in range(self.smin, self.smax + 1)))
+            self.last = len(self.lut) - 1
+        else:
+            self.lut = None
+            self.last = full
+
+        # センター追従（静止時のみ、遅い EMA で中心のドリフトを吸収）
+        self.track = bool(opts.get("track_center"))
+        self._c_q16 = self.c0 << 16
+        self._dz_track = max(1, int(full * 0.025))
+
+        # 平滑化（EMA は固定小数点、One-Euro は float）
+        ema = opts.get("ema")
+        self._ema_a = int(max(0.0, min(float(ema), 1.0)) * 65536) if ema else 0
+        self._ema_q16 = None
+        self._euro = opts.get("oneeuro")
+        self._euro_x = None
+        self._euro_dx = 0.0
+        self._euro_t = 0.0
+
+    def _shape(self, raw: int) -> int:
+        reverse, unipolar, dz, sat, gamma, dmin, dc, dmax = self._shape_args
+        smin, smax, c = self.smin, self.smax, self.c0
+        r = smin + smax - raw if reverse else raw
+        if unipolar:
+            x = (r - smin) / max(1, smax - smin)
+        elif r >= c:
+            x = (r - c) / max(1, smax - c)
+        else:
+            x = (r - c) / max(1, c - smin)
+        a = abs(x)
+        if a <= dz:
+            a = 0.0
+        elif a >= sat:
+            a = 1.0
+        else:
+            a = (a - dz) / (sat - dz)
+        if gamma != 1.0 and a > 0.0:
+            a = a ** gamma
+        if unipolar:
+            return int(round(dmin + a * (dmax - dmin)))
+        if x >= 0:
+            return int(round(dc + a * (dmax - dc)))
+        return int(round(dc - a * (dc - dmin)))
+
+    @property
+    def stateless(self) -> bool:
+        return not (self.track or self._ema_a or self._euro)
+
+    def process(self, raw: int) -> int:
+        if self.track:
+            # 静止（中心付近）時だけ実測センターへ寄せ、その差分を raw から引く
+            c = self._c_q16 >> 16
+            if -self._dz_track <= raw - c <= self._dz_track:
+                self._c_q16 += ((raw << 16) - self._c_q16) // 50     # alpha = 0.02
+                c = self._c_q16 >> 16
+            raw -= c - self.c0
+        i = raw - self.smin
+        if i < 0:
+            i = 0
+        elif i > self.last:
+            i = self.last
+        v = self.lut[i] if self.lut is not None else self._shape(self.smin + i)
+        if self._ema_a:
+            q = self._ema_q16
+            q = (v << 16) if q is None else q + ((((v << 16) - q) * self._ema_a) >> 16)
+            self._ema_q16 = q
+            v = (q + 0x8000) >> 16
+        elif self._euro:
+            v = self._one_euro(v)
+        return v
+
+    def _one_euro(self, v: int) -> int:
+        mincutoff, beta = self._euro
+        now = time.monotonic()
+        if self._euro_x is None:
+            self._euro_x, self._euro_t = float(v), now
+            return v
+        dt = max(1e-4, now - self._euro_t)
+        self._euro_t = now
+        # 速度（1Hz カットオフ固定）→ 速度に応じてカットオフを上げる
+        a_d = 1.0 / (1.0 + 1.0 / (2 * 3.141592653589793 * 1.0 * dt))
+        dx = (v - self._euro_x) / dt
+        self._euro_dx += a_d * (dx - self._euro_dx)
+        cutoff = mincutoff + beta * abs(self._euro_dx)
+        a = 1.0 / (1.0 + 1.0 / (2 * 3.141592653589793 * cutoff * dt))
+        self._euro_x += a * (v - self._euro_x)
+        return int(round(self._euro_x))
 
 def _toAbsCode(name_or_num: str):
     s = (str(name_or_num).strip()).upper()
@@ -279,10 +361,15 @@ def _toAbsCode(name_or_num: str):
         return int(s)
     if s.startswith("ABS_") and s[4:].isdigit():
         return int(s[4:])
-    return EC_ABS.get(s, None)
+    # 名前は総合辞書で引く
+    return EC.get(s, None) if s.startswith("ABS_") else None
 
 # --- TSV loader (blank-line groups) ---
-def _parse_mapping_tsv(path: str):
+def _parse_mapping_tsv(path: str, rows: Optional[list] = None):
+    """
+    戻り: groups = [[(src_tag, src_code, virt_code, src_type), ...], ...]
+    rows を渡すと TSV 1 行ぶんの dict（group_id/srcTag/srcAbs/virtAbs/options...）を追記する
+    """
     groups, cur = [], []
     group_id = 0
     with open(path, "r", encoding="utf-8") as f:
@@ -314,9 +401,9 @@ def _parse_mapping_tsv(path: str):
             dv = (cols[6] or "").strip()
             # KEY は _resolveKeyCode、ABS は _toAbsCode
             if src_type == "KEY":
-                src_code = _resolveKeyCode(cols[5] or cols[4])
+                virt_code = _resolveKeyCode(dv) if dv else None
             else:
-                src_code = _toAbsCode(cols[5] or cols[4])
+                virt_code = _toAbsCode(dv) if dv else None
             if virt_code is None:
                 # 未指定フォールバック（VIRTUAL_*_ORDER のラベル→実コードに解決）
                 if src_type == "KEY":
@@ -340,19 +427,21 @@ def _parse_mapping_tsv(path: str):
             # ★ groups 用（ (src_tag, src_code, virt_code, src_type) ）← “実コード”を入れる！
             cur.append((src_tag, int(src_code), int(virt_code), src_type))
 
-            # ★ axisMappings 用（数値で保持・virt_codeを格納）
+            # ★ rows 用（数値で保持・virt_codeを格納）
             entry = {
                 "group_id": group_id,
                 "device": cols[0],
 
                 "srcTag": src_tag,              # 'wheel' 等
+                "srcType": src_type,            # 'ABS' | 'KEY'
                 "srcAbs": int(src_code),        # ★ 数値コードで保存！
                 "virtAbs": int(virt_code),      # ★ 数値（= ABS/BTN のコード）
 
                 "note": cols[7],                # js_index_in_js
                 "options": opts_dict,           # {'reverse': True/False}
             }
-            axisMappings.append(entry)
+            if rows is not None:
+                rows.append(entry)
             logging.info(entry)
     if cur:
         groups.append(cur)
@@ -378,31 +467,124 @@ except NameError:
     "BTN_6", "BTN_7", "BTN_8", "BTN_9", "BTN_DEAD"]
 
 # --- routing builder ---
-def build_routing_from_tsv(axes_path: str|None, btns_path: str|None):
+@dataclass(frozen=True)
+class MappingRouting:
     """
-    戻り:
-      virt2src: dict[str vname] -> list[(src_type, src_code)]
-      src2virt: dict[(src_type, src_code)] -> list[str vname]
-      map_src2virt_abs: dict[("ABS", code)] -> int vcode   # 仮想“出現順”インデックス
-      map_src2virt_key: dict[("KEY", code)] -> int vcode   # 仮想“出現順”インデックス
+    TSV 2 本から組んだルーティング一式（ロード後は不変。作り直す時は丸ごと差し替える）
+      virt2src     : {vname: ((src_type, src_code), ...)}      TSV 出現順
+      src2virt     : {(src_type, src_code): (vname, ...)}
+      src2virt_abs : {(src_tag, src_code): vcode}              実 emit 用
+      src2virt_key : {(src_tag, src_code): vcode}
+      rows         : TSV 1 行 = 1 dict（srcTag/srcType/srcAbs/virtAbs/options ...）
+    """
+    virt2src: Mapping
+    src2virt: Mapping
+    src2virt_abs: Mapping
+    src2virt_key: Mapping
+    rows: Tuple[Mapping, ...] = ()
+    axes_groups: int = 0
+    button_groups: int = 0
+
+    @classmethod
+    def from_plain(cls, d: dict) -> "MappingRouting":
+        return cls(
+            virt2src=MappingProxyType({k: tuple(v) for k, v in d["virt2src"].items()}),
+            src2virt=MappingProxyType({k: tuple(v) for k, v in d["src2virt"].items()}),
+            src2virt_abs=MappingProxyType(dict(d["src2virt_abs"])),
+            src2virt_key=MappingProxyType(dict(d["src2virt_key"])),
+            rows=tuple(MappingProxyType(r) for r in d["rows"]),
+            axes_groups=d["axes_groups"],
+            button_groups=d["button_groups"],
+        )
+
+    def to_json(self) -> dict:
+        """キャッシュ用。JSON はタプルをキーにできないので (キー..., 値) の並びにする"""
+        return {
+            "virt2src": {k: [list(s) for s in v] for k, v in self.virt2src.items()},
+            "src2virt": [[list(k), list(v)] for k, v in self.src2virt.items()],
+            "src2virt_abs": [[tag, code, v] for (tag, code), v in self.src2virt_abs.items()],
+            "src2virt_key": [[tag, code, v] for (tag, code), v in self.src2virt_key.items()],
+            "rows": [dict(r) for r in self.rows],
+            "axes_groups": self.axes_groups,
+            "button_groups": self.button_groups,
+        }
+
+    @classmethod
+    def from_json(cls, d: dict) -> "MappingRouting":
+        return cls.from_plain({
+            "virt2src": {k: [tuple(s) for s in v] for k, v in d["virt2src"].items()},
+            "src2virt": {tuple(k): v for k, v in d["src2virt"]},
+            "src2virt_abs": {(tag, code): v for tag, code, v in d["src2virt_abs"]},
+            "src2virt_key": {(tag, code): v for tag, code, v in d["src2virt_key"]},
+            "rows": d["rows"],
+            "axes_groups": d["axes_groups"],
+            "button_groups": d["button_groups"],
+        })
+
+    @classmethod
+    def empty(cls) -> "MappingRouting":
+        return cls.from_plain({"virt2src": {}, "src2virt": {}, "src2virt_abs": {}, "src2virt_key": {},
+                               "rows": [], "axes_groups": 0, "button_groups": 0})
+
+
+# コンパイル済みキャッシュの形式（中身の構造を変えたら上げる）
+_MAPPING_CACHE_VER = 2      # 2: pickle をやめて JSON に（root で読むので任意コード実行の口を作らない）
+
+def _mapping_cache_key(*paths) -> tuple:
+    """TSV の (絶対パス, mtime_ns, size) と evdev バージョンでキャッシュの有効性を判定"""
+    try:
+        from importlib.metadata import version as _pkg_version
+        evdev_ver = _pkg_version("evdev")
+    except Exception:
+        evdev_ver = "unknown"
+    files = []
+    for path in paths:
+        if not path:
+            files.append(None)
+            continue
+        st = os.stat(path)
+        files.append((os.path.abspath(path), st.st_mtime_ns, st.st_size))
+    return (_MAPPING_CACHE_VER, evdev_ver, tuple(files))
+
+def build_routing_from_tsv(axes_path: str|None, btns_path: str|None,
+                           cache_path: str|None = None) -> MappingRouting:
+    """
+    軸/ボタン TSV を 1 回ずつだけパースして MappingRouting を返す。
+    cache_path を渡すと、TSV が変わっていない限り JSON 1 回読みで済ませる（名前解決も省略）。
     """
     logging.info(f"build_routing_from_tsv axes={axes_path} btns={btns_path}")
 
-    # 既知コード→記号名の逆引き（見つからなければ空文字）
-    def _ec_name_by_code(code: int, kind: str) -> str:
-        if kind == "ABS":
-            for k, v in _EC.__dict__.items():
-                if k.startswith("ABS_") and v == code:
-                    return k
-        else:
-            for k, v in _EC.__dict__.items():
-                if k.startswith("BTN_") and v == code:
-                    return k
-        return ""
+    key = None
+    if cache_path:
+        try:
+            key = _mapping_cache_key(axes_path, btns_path)
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached["key"] == json.loads(json.dumps(key)):    # タプルは JSON ではリストになる
+                logging.info("[mapping] cache hit: %s", cache_path)
+                return MappingRouting.from_json(cached["routing"])
+            logging.info("[mapping] cache stale: %s", cache_path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("[mapping] cache ignored (%s): %s", cache_path, e)
 
-    from evdev import ecodes as _EC
-    axes_groups   = _parse_mapping_tsv(axes_path) if axes_path else []
-    button_groups = _parse_mapping_tsv(btns_path) if btns_path else []
+    routing = _compile_routing(axes_path, btns_path)
+
+    if cache_path and key is not None:
+        try:
+            tmp = f"{cache_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"key": key, "routing": routing.to_json()}, f, ensure_ascii=False)
+            os.replace(tmp, cache_path)
+        except OSError as e:
+            logging.warning("[mapping] cache write failed (%s): %s", cache_path, e)
+    return routing
+
+def _compile_routing(axes_path: str|None, btns_path: str|None) -> MappingRouting:
+    rows: list = []
+    axes_groups   = _parse_mapping_tsv(axes_path, rows) if axes_path else []
+    button_groups = _parse_mapping_tsv(btns_path, rows) if btns_path else []
 
     virt2src, src2virt = {}, {}
     # --- 仮想→物理 / 物理→仮想
@@ -411,7 +593,7 @@ def build_routing_from_tsv(axes_path: str|None, btns_path: str|None):
         if not grp:
             continue
         vcode = int(grp[0][2])  # = 実コード（ABS_* の値）
-        vname = _ec_name_by_code(vcode, "ABS") or f"ABS_{vcode}"
+        vname = abs_name(vcode)
         lst = []
         for (stag, scode, _v, stype) in grp:
             scode = int(scode)
@@ -423,7 +605,7 @@ def build_routing_from_tsv(axes_path: str|None, btns_path: str|None):
         if not grp:
             continue
         vcode = int(grp[0][2])  # = 実コード（BTN_* の値）
-        vname = _ec_name_by_code(vcode, "KEY") or f"BTN_{vcode}"
+        vname = KEY_NAMES.get(vcode) or f"BTN_{vcode}"
         lst = []
         for (stag, scode, _v, stype) in grp:
             scode = int(scode)
@@ -443,7 +625,11 @@ def build_routing_from_tsv(axes_path: str|None, btns_path: str|None):
         for (stag, scode, vcode, stype) in grp:
             map_src2virt_key[(stag, int(scode))] = int(vcode)
 
-    return virt2src, src2virt, map_src2virt_abs, map_src2virt_key
+    return MappingRouting.from_plain({
+        "virt2src": virt2src, "src2virt": src2virt,
+        "src2virt_abs": map_src2virt_abs, "src2virt_key": map_src2virt_key,
+        "rows": rows, "axes_groups": len(axes_groups), "button_groups": len(button_groups),
+    })
 
 # Project Cars 2 で、 4.0 〜 5.0 ms ぐらい。
 # 500Hz (=  2.00 ms)
@@ -468,8 +654,6 @@ ABS = {
 # 以下はClass内部で設定
 # DEBUG_TELEMETORY = False
 
-CREATED_UI = False
-
 import evdev
 import fcntl, struct
 from evdev import ecodes, InputEvent, UInput
@@ -479,14 +663,205 @@ import os, fcntl, select
 import signal, threading, os
 import time, threading
 
-def set_initial_ff_gain(_fd, percent):
-    """FFB初期ゲイン設定。percentは0～100"""
+# ------------------------
+# --rt: リアルタイム優先度 / CPU 固定 / メモリロック と遅延ヒストグラム
+# ------------------------
+
+class LatencyHistogram:
+    """
+    log2 バケット（µs）の遅延ヒストグラム。record は配列 1 要素の加算だけ（ロック無し・1 スレッド 1 個）
+    バケット i は [2^(i-1), 2^i) µs（0 は 1µs 未満）
+    """
+    NBUCKETS = 32
+
+    def __init__(self, name: str):
+        self.name = name
+        self.counts = array('Q', bytes(8 * self.NBUCKETS))
+        self.total = 0
+        self.max_ns = 0
+
+    def record_ns(self, ns: int):
+        if ns < 0:
+            ns = 0
+        us = ns // 1000
+        i = us.bit_length()
+        self.counts[i if i < self.NBUCKETS else self.NBUCKETS - 1] += 1
+        self.total += 1
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def percentile_us(self, q: float) -> int:
+        """q(0..1) 分位点のバケット上端（µs）"""
+        if not self.total:
+            return 0
+        need = q * self.total
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= need:
+                return 1 << i
+        return 1 << (self.NBUCKETS - 1)
+
+    def summary(self) -> str:
+        return (f"{self.name}: n={self.total} p50<{self.percentile_us(0.5)}us "
+                f"p99<{self.percentile_us(0.99)}us max={self.max_ns / 1000:.0f}us")
+
+    def dump(self):
+        logging.info("[hist] %s", self.summary())
+        for i, c in enumerate(self.counts):
+            if c:
+                lo = 0 if i == 0 else 1 << (i - 1)
+                logging.debug("[hist]   %s %7d..%-7d us : %d", self.name, lo, 1 << i, c)
+
+
+# 計測点（--rt 時は終了時に必ず、-v 以上ならそれ以外でも出力）
+#   input.lat : 物理 SYN_REPORT のカーネル時刻 → 仮想側へ書き終えるまで
+#   ff.loop   : FF サーバループ 1 周の遅れ（LoopWait_sec との差）
+HISTOGRAMS: Dict[str, LatencyHistogram] = {}
+
+def latency_histogram(name: str) -> LatencyHistogram:
+    h = HISTOGRAMS.get(name)
+    if h is None:
+        h = HISTOGRAMS[name] = LatencyHistogram(name)
+    return h
+
+
+@dataclass(frozen=True)
+class RtConfig:
+    policy: int                      # os.SCHED_FIFO / os.SCHED_RR
+    input_prio: int
+    ff_prio: int
+    input_cpus: Optional[frozenset]  # None ならアフィニティは触らない
+    ff_cpus: Optional[frozenset]
+    prefault_mb: int
+
+    @classmethod
+    def from_args(cls, args) -> Optional["RtConfig"]:
+        if not getattr(args, "rt", False):
+            return None
+        return cls(
+            policy=os.SCHED_RR if args.rt_policy == "rr" else os.SCHED_FIFO,
+            input_prio=int(args.rt_prio),
+            ff_prio=int(args.rt_ff_prio if args.rt_ff_prio is not None else args.rt_prio),
+            input_cpus=_parse_cpu_list(args.rt_cpus),
+            ff_cpus=_parse_cpu_list(args.rt_ff_cpus if args.rt_ff_cpus is not None else args.rt_cpus),
+            prefault_mb=int(args.rt_prefault_mb),
+        )
+
+
+def _parse_cpu_list(spec: Optional[str]) -> Optional[frozenset]:
+    """'2,3' / '2-3' / '0,4-5' -> frozenset。空・None は None"""
+    if not spec:
+        return None
+    cpus = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            a, b = part.split("-", 1)
+            cpus.update(range(int(a), int(b) + 1))
+        else:
+            cpus.add(int(part))
+    return frozenset(cpus) or None
+
+
+MCL_CURRENT = 1
+MCL_FUTURE  = 2
+M_TRIM_THRESHOLD = -1
+M_MMAP_MAX       = -4
+_RT_MEMORY_DONE = False
+
+def rt_lock_memory(prefault_mb: int):
+    """
+    プロセス全体で 1 回: malloc の trim/mmap を止めて → mlockall(CURRENT|FUTURE) →
+    prefault_mb ぶんのヒープを触ってから返す（以後のページフォルトを避ける）。権限が無ければ警告のみ
+    """
+    global _RT_MEMORY_DONE
+    if _RT_MEMORY_DONE:
+        return
+    _RT_MEMORY_DONE = True
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError as e:
+        logging.warning("[rt] libc unavailable, memory not locked: %s", e)
+        return
+    try:
+        # free したヒープを OS に返さない（返すと次の確保でまたフォルトする）。prefault より前に
+        libc.mallopt(M_TRIM_THRESHOLD, -1)
+        libc.mallopt(M_MMAP_MAX, 0)
+    except AttributeError:
+        pass
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        err = ctypes.get_errno()
+        logging.warning("[rt] mlockall failed: %s (need CAP_IPC_LOCK or a higher RLIMIT_MEMLOCK)",
+                        os.strerror(err))
+        return
+    if prefault_mb > 0:
+        # bytearray は 0 埋めで全ページに触る。すぐ捨てても trim されずロックされたまま残る
+        bytearray(prefault_mb << 20)
+    # 起動時に作ったオブジェクトは以後の GC 走査から外す（GC 停止時間を短く）
+    import gc
+    gc.collect()
+    gc.freeze()
+    logging.info("[rt] memory locked (prefault %d MB)", prefault_mb)
+
+
+def gil_status() -> str:
+    """
+    "gil": 通常ビルド / "free-threaded": GIL 無しで動作中 /
+    "free-threaded-gil": free-threaded ビルドだが GIL が有効（未対応の C 拡張が読み込まれた / PYTHON_GIL=1）
+    """
+    if not sysconfig.get_config_var("Py_GIL_DISABLED"):
+        return "gil"
+    return "free-threaded-gil" if sys._is_gil_enabled() else "free-threaded"
+
+
+def rt_enter_thread(cfg: Optional[RtConfig], role: str):
+    """
+    呼び出したスレッド自身を RT 優先度 / CPU 固定にする（role: "input" / "ff"）。
+    Linux の sched_setscheduler(0)/sched_setaffinity(0) はスレッド単位。失敗しても続行
+    """
+    if cfg is None:
+        return
+    prio = cfg.ff_prio if role == "ff" else cfg.input_prio
+    cpus = cfg.ff_cpus if role == "ff" else cfg.input_cpus
+    rt_lock_memory(cfg.prefault_mb)
+    try:
+        lo, hi = os.sched_get_priority_min(cfg.policy), os.sched_get_priority_max(cfg.policy)
+        os.sched_setscheduler(0, cfg.policy, os.sched_param(min(max(prio, lo), hi)))
+        logging.info("[rt] %s thread: %s prio=%d", role,
+                     "SCHED_RR" if cfg.policy == os.SCHED_RR else "SCHED_FIFO", prio)
+    except (PermissionError, OSError) as e:
+        logging.warning("[rt] %s thread: realtime scheduling unavailable (%s); "
+                        "run as root or grant CAP_SYS_NICE / rtprio", role, e)
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+            logging.info("[rt] %s thread: pinned to CPU %s", role, ",".join(map(str, sorted(cpus))))
+        except OSError as e:
+            logging.warning("[rt] %s thread: CPU affinity %s failed: %s", role, sorted(cpus), e)
+
+def rt_leave_thread(cfg: Optional[RtConfig]):
+    """RT スレッドから生成されて設定を継承したワーカーを SCHED_OTHER / 全 CPU に戻す"""
+    if cfg is None:
+        return
+    try:
+        os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+        os.sched_setaffinity(0, range(os.cpu_count() or 1))
+    except OSError:
+        pass
+
+
+def set_initial_ff_gain(_fd, percent, autocenter=None):
+    """FFB初期ゲイン設定。percentは0～100（autocenter 省略時は percent と同じ）"""
     # AutoCenter 設定
-    ac_value = int((percent / 100.0) * 0xFFFF)
+    ac_pct = percent if autocenter is None else autocenter
+    ac_value = int((ac_pct / 100.0) * 0xFFFF)
     ac_event = struct.pack("llHHI", int(time.time()), 0, ecodes.EV_FF,
                            ecodes.FF_AUTOCENTER, ac_value)
     os.write(_fd, ac_event)  # ← 修正ポイント
-    print(f"Initial AutoCenter: {percent:.1f}% ({ac_value})")
+    print(f"Initial AutoCenter: {ac_pct:.1f}% ({ac_value})")
     
     # Gain 設定
     gn_value = int((percent / 100.0) * 0xFFFF)
@@ -557,34 +932,374 @@ class DeltaColorFormatter(logging.Formatter):
         return out
 
 
-class RateLimitedLogger:
-    """一定間隔 or 変化量しきい値を満たした時だけログを出す"""
-    def __init__(self, min_interval_ms=5000, min_delta=200):
+class TelemetrySampler:
+    """
+    -vvv のテレメトリ。ホットパスは array('i') の 1 要素書き込みだけ
+    （(src_tag, 物理 ABS) -> 添字 は _compile_runtime でルーティングテーブルに焼く）。
+    定周期タイマーがループ上で読み出し、一定間隔 or 変化量しきい値を満たした時だけ出力する
+    """
+    SOURCES = ("wheel", "shift")
+    AXES = tuple(ABS)                      # steer / throttle / brake / clutch
+    LABELS = ("steer", "thr", "brk", "clt")
+
+    def __init__(self, loop, extra=None, period_ms=100, min_interval_ms=5000, min_delta=100):
+        self.loop = loop
+        self.extra = extra                 # 追加情報（FF スロット使用数など）を返す関数。サンプル時だけ呼ぶ
+        self.period = period_ms / 1000.0
         self.min_interval = min_interval_ms / 1000.0
         self.min_delta = min_delta
+        self.vals = array('i', [0]) * (len(self.SOURCES) * len(self.AXES))
+        self._last = array('i', self.vals)
         self._last_emit_t = 0.0
-        self._last_vals = {}
+        self._timer = None
+
+    def index_map(self) -> Dict[Tuple[str, int], int]:
+        n = len(self.AXES)
+        return {(tag, ABS[name]): si * n + ai
+                for si, tag in enumerate(self.SOURCES) for ai, name in enumerate(self.AXES)}
 
-    def should_emit(self, vals: dict) -> bool:
+    def seed(self, src: InputDevice, src_tag: str):
+        """起動時の値を一度だけ読む（読めなければ 0 のまま）"""
+        if src_tag not in self.SOURCES:
+            return
+        base = self.SOURCES.index(src_tag) * len(self.AXES)
+        for ai, name in enumerate(self.AXES):
+            try:
+                self.vals[base + ai] = src.absinfo(ABS[name]).value
+            except Exception:
+                pass
+
+    def start(self):
+        if self._timer is None:
+            self._timer = self.loop.call_later(self.period, self._tick)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _tick(self):
+        self._timer = self.loop.call_later(self.period, self._tick)
         now = time.monotonic()
-        by_time = (now - self._last_emit_t) >= self.min_interval
-
-        # 変化量で判定
-        by_delta = False
-        for k, v in vals.items():
-            pv = self._last_vals.get(k)
-            if pv is None:
-                by_delta = True
-                break
-            if abs(int(v) - int(pv)) >= self.min_delta:
-                by_delta = True
+        vals, last, md = self.vals, self._last, self.min_delta
+        by_delta = any(abs(a - b) >= md for a, b in zip(vals, last))
+        if not by_delta and (now - self._last_emit_t) < self.min_interval:
+            return
+        self._last_emit_t = now
+        self._last[:] = vals
+        self.publish(vals)
+
+    def publish(self, vals):
+        n = len(self.AXES)
+        extra = self.extra() if self.extra is not None else ""
+        for si, tag in enumerate(self.SOURCES):
+            row = " ".join(f"{lab}={vals[si * n + ai]:6d}" for ai, lab in enumerate(self.LABELS))
+            logging.debug("[TEL] %-5s %s%s", tag, row, extra)
+
+# ------------------------
+# --shm: ライブ状態の共有メモリ出力（オーバーレイ/ロガー/リグモニタ向け）
+# ------------------------
+#
+# レイアウト（ネイティブバイトオーダ、固定長 SHM_SIZE バイト）:
+#   0   header  SHM_HDR  magic "USST", layout, seq, size, frames(u64), ts_ns(u64, CLOCK_MONOTONIC), flags, pad
+#   40  axes    i32 x (ABS_MAX+1)   仮想軸の直近送出値（未送出は -2^31）
+#   296 keys    u8  x (KEY_MAX+1)/8 仮想ボタンのビットマップ（bit = code、押下中=1）
+#   392 ff      SHM_FF  gear(-1 無し/0..7/8=N), FF 使用スロット, 物理 FF 容量, 直近アップロード type
+#   408 levels  i32 x 8             FF type（FF_RUMBLE..FF_RAMP）ごとの直近レベル
+#   440 hist    u32 個数 + pad, SHM_HIST x SHM_NHIST（名前, n, p50/p99/max µs）
+# seqlock: 書き手は seq を奇数にしてから本体を書き、偶数に戻す。
+# 読み手は seq を読む → 本体をコピー → seq を読み直し、奇数か変化していたらやり直す（read_live_state）
+SHM_MAGIC   = b"USST"
+SHM_LAYOUT  = 1
+SHM_SIZE    = 1024
+SHM_HDR     = struct.Struct("=4sIIIQQII")
+SHM_OFF_AXES   = SHM_HDR.size
+SHM_OFF_KEYS   = SHM_OFF_AXES + 4 * (ecodes.ABS_MAX + 1)
+SHM_OFF_FF     = SHM_OFF_KEYS + (ecodes.KEY_MAX + 1) // 8
+SHM_FF      = struct.Struct("=iiii")
+SHM_OFF_LEVELS = SHM_OFF_FF + SHM_FF.size
+SHM_NLEVELS = 8                      # FF_RUMBLE(0x50) .. FF_RAMP(0x57)
+SHM_OFF_HIST   = SHM_OFF_LEVELS + 4 * SHM_NLEVELS
+SHM_HIST    = struct.Struct("=16sQIIII")
+SHM_NHIST   = 8
+SHM_FLAG_RUNNING = 1
+_SHM_SEQ_OFF = 8                     # header 内の seq の位置
+
+
+def _ff_effect_level(eff) -> int:
+    """ff_effect の代表レベル（constant.level / periodic.magnitude / ramp.start / 条件の right_coeff / rumble.strong）"""
+    t = int(eff.type)
+    u = eff.u
+    if t == ecodes.FF_CONSTANT:
+        return int(u.constant.level)
+    if t == ecodes.FF_PERIODIC:
+        return int(u.periodic.magnitude)
+    if t == ecodes.FF_RAMP:
+        return int(u.ramp.start_level)
+    if t == ecodes.FF_RUMBLE:
+        return int(u.rumble.strong_magnitude)
+    if t in (ecodes.FF_SPRING, ecodes.FF_FRICTION, ecodes.FF_DAMPER, ecodes.FF_INERTIA):
+        return int(u.condition[0].right_coeff)
+    return 0
+
+
+class LiveStateExporter:
+    """
+    仮想デバイスの出力キャッシュ（ui._last_abs / ui._last_key）・ギア・FF 状態・遅延ヒストグラムを
+    一定周期で /dev/shm のファイルへ書き出す。ホットパスには何も足さない（読むだけのタイマー）
+    """
+    def __init__(self, loop, path: str, us: "UnderSteer", hz: int = 100):
+        self.loop = loop
+        self.path = path
+        self.us = us
+        self.period = 1.0 / max(1, int(hz))
+        self._fd = self._open_private(path)
+        os.ftruncate(self._fd, SHM_SIZE)
+        self._mm = mmap.mmap(self._fd, SHM_SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self._seq = 0
+        self._frames = 0
+        self._timer = None
+        self._keys = bytearray((ecodes.KEY_MAX + 1) // 8)
+        self._key_codes = sorted(int(c) for c in us.ui.ui_caps.get(ecodes.EV_KEY, []))
+
+    @staticmethod
+    def _open_private(path: str) -> int:
+        """
+        /dev/shm は誰でも書ける sticky ディレクトリなので、root で開く時に先回りされたシンボリックリンク /
+        ハードリンク / 他人のファイルを掴まない（掴むと ftruncate で任意のファイルを壊す）
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC, 0o644)
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                raise OSError(errno.EINVAL, f"{path} is not a regular file")
+            if st.st_uid != os.geteuid() or st.st_nlink != 1:
+                raise OSError(errno.EPERM, f"refusing to use {path}: not a private file of this user")
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+
+    def start(self):
+        self.publish()
+        self._timer = self.loop.call_later(self.period, self._tick)
+
+    def _tick(self):
+        self._timer = self.loop.call_later(self.period, self._tick)
+        self.publish()
+
+    def publish(self, flags: int = SHM_FLAG_RUNNING):
+        us, ui, mm = self.us, self.us.ui, self._mm
+        # 本体はロック外で組み立てておき、seq 奇数の区間は書き込みだけにする
+        keys = self._keys
+        keys[:] = bytes(len(keys))
+        last_key = ui._last_key
+        for code in self._key_codes:
+            if last_key[code] > 0:
+                keys[code >> 3] |= 1 << (code & 7)
+        rt = us._rt
+        gear = rt.gear_mapper.current if rt.gear_mapper is not None else -1
+        ff_mapper = getattr(ui, "ff_mapper", None)
+        ff_used = ff_mapper.slots_in_use() if ff_mapper is not None else -1
+        ff_cap = getattr(us.wheel_info.dev, "ff_effects_count", -1)
+        hists = list(HISTOGRAMS.values())[:SHM_NHIST]
+        self._frames += 1
+
+        self._seq += 1
+        struct.pack_into("=I", mm, _SHM_SEQ_OFF, self._seq)              # 奇数: 書き込み中
+        SHM_HDR.pack_into(mm, 0, SHM_MAGIC, SHM_LAYOUT, self._seq, SHM_SIZE,
+                          self._frames, time.monotonic_ns(), flags, 0)
+        mm[SHM_OFF_AXES:SHM_OFF_KEYS] = ui._last_abs.tobytes()
+        mm[SHM_OFF_KEYS:SHM_OFF_FF] = keys
+        SHM_FF.pack_into(mm, SHM_OFF_FF, gear, ff_used, ff_cap, ui.ff_last_type)
+        mm[SHM_OFF_LEVELS:SHM_OFF_HIST] = ui.ff_last_level.tobytes()
+        struct.pack_into("=II", mm, SHM_OFF_HIST, len(hists), 0)
+        off = SHM_OFF_HIST + 8
+        for h in hists:
+            SHM_HIST.pack_into(mm, off, h.name.encode()[:16], h.total,
+                               h.percentile_us(0.5), h.percentile_us(0.99), h.max_ns // 1000, 0)
+            off += SHM_HIST.size
+        self._seq += 1
+        struct.pack_into("=I", mm, _SHM_SEQ_OFF, self._seq)              # 偶数: 確定
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._mm is None:
+            return
+        try:
+            self.publish(flags=0)        # 読み手に停止を知らせる（ファイルは残す）
+        except Exception:
+            pass
+        self._mm.close()
+        os.close(self._fd)
+        self._mm = None
+
+
+def read_live_state(path: str = "/dev/shm/understeer", retries: int = 100) -> Optional[dict]:
+    """--shm の読み手（参考実装）。seqlock で一貫したスナップショットを dict で返す"""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), SHM_SIZE, mmap.MAP_SHARED, mmap.PROT_READ)
+    try:
+        for _ in range(retries):
+            (seq0,) = struct.unpack_from("=I", mm, _SHM_SEQ_OFF)
+            if seq0 & 1:
+                continue
+            raw = bytes(mm[:SHM_SIZE])
+            (seq1,) = struct.unpack_from("=I", mm, _SHM_SEQ_OFF)
+            if seq0 == seq1:
                 break
+        else:
+            return None
+    finally:
+        mm.close()
+    magic, layout, _seq, _size, frames, ts_ns, flags, _ = SHM_HDR.unpack_from(raw, 0)
+    if magic != SHM_MAGIC or layout != SHM_LAYOUT:
+        return None
+    axes = array('i', raw[SHM_OFF_AXES:SHM_OFF_KEYS])
+    keys = raw[SHM_OFF_KEYS:SHM_OFF_FF]
+    gear, ff_used, ff_cap, ff_type = SHM_FF.unpack_from(raw, SHM_OFF_FF)
+    levels = array('i', raw[SHM_OFF_LEVELS:SHM_OFF_HIST])
+    (nh, _) = struct.unpack_from("=II", raw, SHM_OFF_HIST)
+    hist = {}
+    for i in range(min(nh, SHM_NHIST)):
+        name, n, p50, p99, mx, _ = SHM_HIST.unpack_from(raw, SHM_OFF_HIST + 8 + i * SHM_HIST.size)
+        hist[name.rstrip(b"\0").decode()] = {"n": n, "p50_us": p50, "p99_us": p99, "max_us": mx}
+    return {
+        "running": bool(flags & SHM_FLAG_RUNNING), "frames": frames, "ts_ns": ts_ns,
+        "axes": {abs_name(c): v for c, v in enumerate(axes) if v != _OUT_UNSET},
+        "buttons": [key_name(c) for c in range(len(keys) * 8) if keys[c >> 3] & (1 << (c & 7))],
+        "gear": gear, "ff_used": ff_used, "ff_cap": ff_cap, "ff_last_type": ff_type,
+        "ff_levels": {FF_NAMES.get(ecodes.FF_RUMBLE + i, str(ecodes.FF_RUMBLE + i)): levels[i]
+                      for i in range(SHM_NLEVELS)},
+        "latency": hist,
+    }
+
+
+# ------------------------
+# --control: 実行中の調整用 Unix ソケット（JSON lines）
+# ------------------------
+#   {"cmd": "get"}
+#   {"cmd": "set", "gain": 60, "autocenter": 0, "ff_gap_ms": 1.5, "loop_wait_ms": 4,
+#    "ignore_ff": ["FF_RUMBLE"], "rate": {"ABS_X": 250, "ABS_Y": 0},
+#    "ff_mix": {"spring": 50, "periodic": 20, "global": 80}}      # ff_mix は --ff-soft 時のみ
+# 応答は 1 行の JSON（{"ok": true, ...} / {"ok": false, "error": "..."}）。
+# set は検証後に各スレッドのキューへ積んだ時点で返す（反映は FF ループの次の周回 / ルーティングのループ）
+# 例: echo '{"cmd":"set","gain":60}' | socat - UNIX-CONNECT:$XDG_RUNTIME_DIR/understeer.sock
+
+def _default_control_path() -> str:
+    # /tmp 直下の決め打ちの名前は他ユーザーに先回りされるので、XDG_RUNTIME_DIR が無ければ uid ごとの専用ディレクトリ
+    rt = os.environ.get("XDG_RUNTIME_DIR")
+    if rt:
+        return os.path.join(rt, "understeer.sock")
+    return os.path.join("/tmp", f"understeer-{os.geteuid()}", "understeer.sock")
+
+
+def _ctl_range(v, lo: float, hi: float, name: str) -> float:
+    v = float(v)
+    if not (lo <= v <= hi):
+        raise ValueError(f"{name} out of range ({lo}..{hi}): {v}")
+    return v
+
+
+def _ctl_ff_type(x) -> int:
+    if isinstance(x, str):
+        key = x if x.startswith("FF_") else "FF_" + x.upper()
+        code = getattr(ecodes, key, None)
+        if code is None:
+            raise ValueError(f"unknown FF type: {x}")
+        return int(code)
+    return int(x)
+
+
+class ControlServer:
+    def __init__(self, us: "UnderSteer", path: str):
+        self.us = us
+        self.path = path
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: Set[asyncio.StreamWriter] = set()
+
+    def _check_dir(self):
+        """
+        置き場所は自分の持ち物で、他人が書き込めないディレクトリに限る（root で動くので
+        /tmp 等に置くと差し替え・シンボリックリンク攻撃の的になる）。既定の専用ディレクトリは無ければ 0700 で作る
+        """
+        d = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.mkdir(d, 0o700)
+        except FileExistsError:
+            pass
+        st = os.lstat(d)
+        if not stat.S_ISDIR(st.st_mode):
+            raise OSError(errno.ENOTDIR, f"not a directory: {d}")
+        if st.st_uid not in (os.geteuid(), 0) or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise OSError(errno.EPERM, f"refusing to use {d}: writable by other users")
+
+    async def start(self):
+        self._check_dir()
+        try:
+            st = os.lstat(self.path)
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(st.st_mode):
+                raise OSError(errno.EEXIST, f"{self.path} exists and is not a socket")
+            os.unlink(self.path)      # 前回の残骸
+        old = os.umask(0o117)         # bind した瞬間から 0660（chmod までの隙間を作らない）
+        try:
+            self._server = await asyncio.start_unix_server(self._client, path=self.path)
+        finally:
+            os.umask(old)
+        logging.info("[ctl] listening on %s", self.path)
+
+    def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        self._server = None
+        # 接続中のクライアントも切る（readline が EOF で抜ける）
+        for w in list(self._writers):
+            w.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                writer.write(json.dumps(self.handle_line(line)).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # 終了時のキャンセル。誰も await しない接続タスクなので握って閉じる
+            # （3.11 の start_unix_server はキャンセルされたハンドラを ERROR ログに出すため）
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def handle_line(self, line: bytes) -> dict:
+        try:
+            req = json.loads(line)
+            cmd = req.pop("cmd", None)
+            if cmd == "get":
+                return {"ok": True, **self.us.control_snapshot()}
+            if cmd == "set":
+                self.us.apply_control(req)
+                return {"ok": True, "queued": sorted(req)}
+            return {"ok": False, "error": f"unknown cmd: {cmd}"}
+        except (ValueError, TypeError, AttributeError) as e:
+            return {"ok": False, "error": str(e)}
 
-        if by_time or by_delta:
-            self._last_emit_t = now
-            self._last_vals = vals.copy()
-            return True
-        return False
 
 def setup_logger(
     level=logging.DEBUG,
@@ -686,9 +1401,45 @@ def _sanitize_periodic(eff):
 
     return "ok"
 
+
+def _ff_prep_condition(t: int, eff):
+    # ユニオンに入ってきたものを “安全に 2 軸初期化済み condition[2]” に組み直す
+    return _build_condition_pair_from_generic(t, eff)
+
+
+def _ff_prep_periodic(t: int, eff):
+    p = eff.u.periodic
+    if p.waveform not in (ecodes.FF_SINE, ecodes.FF_TRIANGLE, ecodes.FF_SQUARE):
+        logging.warning(f"[FFB-Pys(UP)] PERIODIC: Unknown waveform {p.waveform}")
+    # ★ custom未使用なら必ずゼロ化（機種/ドライバ依存のEINVAL回避）
+    p.custom_len = 0
+    p.custom_data = None
+    if _sanitize_periodic(eff) == "skip_zero":
+        # 「ゼロ強度の周期波」は実質無意味なので、物理送信せず成功扱いで返す
+        logging.debug("PERIODIC magnitude=0 → skip upload (pretend success)")
+        return None
+    return eff
+
+
+# 物理へ送る前の整形（type -> prep(t, eff) -> 送る eff / None = 送らず成功扱い。None 登録はそのまま送る）。
+# 新しい type はここに足すだけ（UInputFFDevice._build_ff_upload_table が uploader と組にする）
+FF_UPLOAD_PREP = {
+    ecodes.FF_RUMBLE: None,
+    ecodes.FF_PERIODIC: _ff_prep_periodic,
+    ecodes.FF_CONSTANT: None,
+    ecodes.FF_SPRING: _ff_prep_condition,
+    ecodes.FF_FRICTION: _ff_prep_condition,
+    ecodes.FF_DAMPER: _ff_prep_condition,
+    ecodes.FF_INERTIA: None,
+    ecodes.FF_RAMP: None,
+}
+
+
 import ctypes
 import logging
 
+
+
 def dump_ctypes_struct(obj, indent=0):
     """
     任意の ctypes.Structure を再帰的に展開して内容を返す。
@@ -723,12 +1474,8 @@ EVIOCRMFF = 0x40044581  # int 引数 (_IOW('E', 0x81, int))
 import struct
 from collections.abc import Mapping
 
-# --- add: OR 合流用のボタン・コアレッサ ---
-from collections import defaultdict
-
 # --- add: HAT 合流（priority / last） ---
 import time
-from collections import defaultdict
 
 try:
     from evdev import ecodes as _EC
@@ -739,176 +1486,283 @@ except Exception:
 
 class _HatCoalesce:
     """
-    HAT(ABS_HAT0X / ABS_HAT0Y)を複数ソースから1つの仮想へ合流。
-    mode='priority' : 先に定義/遭遇したソースを優先（最初に非0を出しているソースを採用）
+    HAT(ABS_HAT0X / ABS_HAT0Y ...)を複数ソースから1つの仮想へ合流。
+    mode='priority' : TSV の並び順で先のソースを優先（最初に非0を出しているソースを採用）
     mode='last'     : 最後に変化したソースを採用
-    使い方（どれでもOKな柔軟API）:
-      update(vcode, value)
-      update(vcode, src, value)
-      update(src, vcode, value)   # src と vcode の順が逆でも判定して補正
+    ソースはルーティング確定時に compile() で整数 ID（sid）を振っておき、
+    ホットパスは source_id(src_tag, code) → update(sid, value) だけ（文字列化・リスト生成なし）。
     エミッタ emit は emit(abs_code:int, value:int) を想定（-1/0/1）
     """
-    def __init__(self, emit, mapping_virt2src=None, mode="priority"):
+    HAT_CODES = tuple(range(_HATX, _HATX + 8))     # ABS_HAT0X .. ABS_HAT3Y
+
+    def __init__(self, emit, mode="priority"):
         self.emit = emit
         self.mode = "last" if mode == "last" else "priority"
-        self._vals = defaultdict(dict)        # vcode -> {src_key: value(-1/0/1)}
-        self._ts   = defaultdict(dict)        # vcode -> {src_key: last_change_ts}
-        self._order= defaultdict(list)        # vcode -> [src_key,...]（priority用既定順）
-        self._last_out = {}                   # vcode -> last emitted value
-
-        # 可能ならマッピングから優先順を初期化（形は不問、文字列化してキー化）
-        if mapping_virt2src:
-            for vcode, src_list in mapping_virt2src.items():
-                for s in src_list:
-                    sk = self._src_key(s)
-                    if sk not in self._order[vcode]:
-                        self._order[vcode].append(sk)
-
-    def _src_key(self, obj):
-        # src を一意化するためのキー化（タプル/辞書/数値/文字列どれでもOKに）
-        try:
-            if isinstance(obj, (list, tuple)):
-                return "t:" + "|".join(map(str, obj))
-            if isinstance(obj, dict):
-                return "d:" + "|".join(f"{k}={v}" for k,v in sorted(obj.items()))
-            return "s:" + str(obj)
-        except Exception:
-            return "s:" + repr(obj)
-
-    # 既存の _parse_args を以下に置き換え
-    def _parse_args(self, *args):
+        self._routes: Dict[str, Dict[int, int]] = {}    # src_tag -> {src_code: sid}
+        self._sid_slot = array('i')             # sid -> 仮想スロット
+        self._vals     = array('b')             # sid -> 現在値(-1/0/1)
+        self._stamp    = array('Q')             # sid -> 最後に変化した通番（last 用）
+        self._slot_sids: List[List[int]] = []   # slot -> [sid,...]（priority 順）
+        self._slot_vcode: List[int] = []        # slot -> 仮想 ABS コード
+        self._last_out = array('b')             # slot -> 最後に出した値
+        self._seq = 0
+
+    def compile(self, routes) -> int:
         """
-        許容:
-          (vcode, value)
-          (vcode, src, value)
-          (src, vcode, value)
-          (vname, vcode, src_tag, src_code, value)  # ← 今回これ
-        戻り: (vcode:int, src_key:str|None, value:int)
+        routes: {(src_tag, src_code): vcode}（TSV 出現順）。仮想側が HAT のものだけ登録。
+        戻り: 登録したソース数
         """
-        if len(args) < 2:
-            raise TypeError("update() expects at least 2 arguments")
-
-        # value は“最後の int”とみなす（-1/0/1で丸め）
-        ints = [a for a in args if isinstance(a, int)]
-        if not ints:
-            value = 0
-        else:
-            value = ints[-1]
-        try:
-            value = int(value)
-            value = -1 if value < 0 else (1 if value > 0 else 0)
-        except Exception:
-            value = 0
-
-        # vcode は HAT のコード(16/17)を優先的に拾う。無ければ最初の int を採用
-        vcode = None
-        for a in args:
-            if isinstance(a, int) and a in (_HATX, _HATY):
-                vcode = a
-                break
-        if vcode is None:
-            # 最初の int にフォールバック
-            vcode = next((a for a in args if isinstance(a, int)), _HATX)
-
-        # src は “vcode/value 以外”をまとめてキー化
-        src_parts = []
-        for a in args:
-            if a is vcode or (isinstance(a, int) and a == value):
+        slot_of: Dict[int, int] = {}
+        for (tag, code), vcode in routes.items():
+            if vcode not in self.HAT_CODES:
                 continue
-            src_parts.append(a)
-        src_key = None if not src_parts else self._src_key(tuple(src_parts))
-
-        return int(vcode), src_key, int(value)
-
-    # これをクラスの末尾あたりに追加（エイリアス）
-    def on(self, *args):
-        self.update(*args)
-
-    def update(self, *args):
-        vcode, src_key, value = self._parse_args(*args)
-
-        # HAT 以外は素通し
-        if vcode not in (_HATX, _HATY):
-            if self._last_out.get(vcode) != value:
-                self._last_out[vcode] = value
-                self.emit(vcode, value)
-            return
-
-        now = time.monotonic()
-
-        # src_key が無い（単独ソース）の場合は即時反映
-        if src_key is None:
-            if self._last_out.get(vcode) != value:
-                self._last_out[vcode] = value
-                self.emit(vcode, value)
+            tbl = self._routes.setdefault(tag, {})
+            if int(code) in tbl:
+                continue
+            slot = slot_of.get(vcode)
+            if slot is None:
+                slot = slot_of[vcode] = len(self._slot_vcode)
+                self._slot_vcode.append(vcode)
+                self._slot_sids.append([])
+                self._last_out.append(0)
+            sid = len(self._vals)
+            tbl[int(code)] = sid
+            self._sid_slot.append(slot)
+            self._vals.append(0)
+            self._stamp.append(0)
+            self._slot_sids[slot].append(sid)
+        return len(self._vals)
+
+    def source_id(self, src_tag: str, code: int) -> int:
+        """未登録なら -1"""
+        tbl = self._routes.get(src_tag)
+        if tbl is None:
+            return -1
+        return tbl.get(code, -1)
+
+    def update(self, sid: int, value: int):
+        value = -1 if value < 0 else (1 if value > 0 else 0)
+        vals = self._vals
+        if vals[sid] == value:
             return
+        vals[sid] = value
+        self._seq += 1
+        self._stamp[sid] = self._seq
 
-        # 値・時刻を記録（遭遇順を保持）
-        self._vals[vcode][src_key] = value
-        self._ts[vcode][src_key] = now
-        if src_key not in self._order[vcode]:
-            self._order[vcode].append(src_key)
-
-        # 合流ポリシで代表値を決定
+        slot = self._sid_slot[sid]
+        out = 0
         if self.mode == "last":
             # 直近で変化した非0を優先、全0なら0
-            cand = [(sk, self._ts[vcode].get(sk, 0), self._vals[vcode].get(sk, 0))
-                    for sk in self._vals[vcode]]
-            # 非0のみ
-            nonzero = [t for t in cand if t[2] != 0]
-            if nonzero:
-                nonzero.sort(key=lambda t: t[1], reverse=True)
-                out = nonzero[0][2]
-            else:
-                out = 0
+            best = 0
+            stamp = self._stamp
+            for s in self._slot_sids[slot]:
+                if vals[s] and stamp[s] > best:
+                    best = stamp[s]
+                    out = vals[s]
         else:
-            # priority: _order の先頭から見て最初に非0の値を採用。全0なら0
-            out = 0
-            for sk in self._order[vcode]:
-                v = self._vals[vcode].get(sk, 0)
-                if v != 0:
-                    out = v
+            # priority: 先頭から見て最初に非0の値を採用。全0なら0
+            for s in self._slot_sids[slot]:
+                if vals[s]:
+                    out = vals[s]
                     break
 
         # 変化した時だけ emit
-        if self._last_out.get(vcode) != out:
-            self._last_out[vcode] = out
-            self.emit(vcode, out)
+        if self._last_out[slot] != out:
+            self._last_out[slot] = out
+            self.emit(self._slot_vcode[slot], out)
+
+    def release_all(self):
+        """倒れている仮想 HAT をセンターへ戻す（ルーティング差し替え時）"""
+        for slot, out in enumerate(self._last_out):
+            if out:
+                self._last_out[slot] = 0
+                self.emit(self._slot_vcode[slot], 0)
 
-    # 互換用エイリアス
-    set = update
-    put = update
-    on_event = update
 
-class _ButtonCoalesce:
+class _ButtonMergeEngine:
     """
-    複数の物理ボタンを1つの仮想ボタンに OR 合流するための小物。
-    press/release で参照カウント、0→1/1→0時のみ emit する。
+    複数の物理ボタン → 同一仮想ボタンの OR 合流（ビットマスク版）。
+    - 物理ボタン 1 個 = ソースビット 1 本。押下状態は整数マスク _held にまとめて持つ
+    - 仮想ボタン（グループ）ごとに「属するソースビットの OR マスク」を持つ
+    - press() は _held と dirty マスクを更新するだけ。commit()（物理 SYN 時）で
+      dirty なグループだけ (held & group_mask) を評価し、前回の仮想マスクとの XOR で
+      変化した仮想ボタンだけ emit する
+    ルーティングはロード時に compile()。未知の (src_tag, code) は初出時に 1 回だけ割り当てる。
     """
-    def __init__(self, emit):
-        self.emit = emit                    # emit(key_code, value[0/1])
-        self._ref = defaultdict(int)        # key_code -> active press count
-
-    def press(self, code: int):
-        c = self._ref[code]
-        if c == 0:
-            self.emit(code, 1)              # 立上りのみ送出
-        self._ref[code] = c + 1
-
-    def release(self, code: int):
-        c = self._ref.get(code, 0)
-        if c <= 1:
-            self._ref[code] = 0
-            self.emit(code, 0)              # 立下りのみ送出
-        else:
-            self._ref[code] = c - 1
+    def __init__(self, emit, debug: bool = False, name_resolver=None):
+        self.emit = emit                    # emit(vcode, 0/1)
+        self.debug = debug
+        self._name = name_resolver or (lambda code: f"BTN_{code}")
+        self._src: Dict[str, Dict[int, Tuple[int, int]]] = {}   # tag -> {code: (src_bit, vidx)}
+        self._vcodes: List[int] = []        # vidx -> 仮想コード
+        self._vidx: Dict[int, int] = {}     # 仮想コード -> vidx
+        self._group: List[int] = []         # vidx -> ソースビットの OR マスク
+        self._nsrc = 0
+        self._held = 0                      # 押下中のソースビット
+        self._dirty = 0                     # この frame で触ったグループ（vidx のビット）
+        self._virt = 0                      # 直前に出した仮想状態（vidx のビット）
+
+    def compile(self, routes):
+        """routes: {(src_tag, code): vcode}。タグが "KEY" の行は全デバイス共通扱い"""
+        for (tag, code), vcode in routes.items():
+            if isinstance(vcode, int):
+                self.add(tag, int(code), vcode)
+
+    def add(self, tag: str, code: int, vcode: int) -> Tuple[int, int]:
+        ent = self._src.setdefault(tag, {}).get(code)
+        if ent is not None:
+            return ent
+        vidx = self._vidx.get(vcode)
+        if vidx is None:
+            vidx = self._vidx[vcode] = len(self._vcodes)
+            self._vcodes.append(vcode)
+            self._group.append(0)
+        bit = 1 << self._nsrc
+        self._nsrc += 1
+        self._group[vidx] |= bit
+        ent = self._src[tag][code] = (bit, vidx)
+        return ent
+
+    def lookup(self, tag: str, code: int) -> Optional[Tuple[int, int]]:
+        tbl = self._src.get(tag)
+        ent = tbl.get(code) if tbl is not None else None
+        if ent is None:
+            tbl = self._src.get("KEY")
+            ent = tbl.get(code) if tbl is not None else None
+        return ent
+
+    def press(self, ent: Tuple[int, int], down: bool):
+        bit, vidx = ent
+        held = (self._held | bit) if down else (self._held & ~bit)
+        if held != self._held:
+            self._held = held
+            self._dirty |= 1 << vidx
+
+    def commit(self) -> bool:
+        """dirty グループを評価して変化分だけ emit。emit したら True"""
+        dirty = self._dirty
+        if not dirty:
+            return False
+        self._dirty = 0
+        held, group = self._held, self._group
+        virt = self._virt & ~dirty
+        d = dirty
+        while d:
+            low = d & -d
+            if held & group[low.bit_length() - 1]:
+                virt |= low
+            d ^= low
+        edges = virt ^ self._virt
+        self._virt = virt
+        while edges:
+            low = edges & -edges
+            vidx = low.bit_length() - 1
+            state = 1 if virt & low else 0
+            self.emit(self._vcodes[vidx], state)
+            if self.debug:
+                print(f"[MERGE] {self._name(self._vcodes[vidx])} {'DOWN' if state else 'UP'}  "
+                      f"sources={bin(held & self._group[vidx]).count('1')}")
+            edges ^= low
+        return True
+
+    def release_all(self):
+        """押下中の仮想ボタンを全部離す（ルーティング差し替え時）"""
+        virt, self._virt, self._dirty = self._virt, 0, 0
+        while virt:
+            low = virt & -virt
+            self.emit(self._vcodes[low.bit_length() - 1], 0)
+            virt ^= low
+
+    def dump_state(self):
+        return {
+            "held": self._held,
+            "virtual": {self._vcodes[i]: 1 for i in range(len(self._vcodes)) if self._virt >> i & 1},
+        }
+
+
+class _RateBucket:
+    """同じ RATE を持つ仮想軸のまとまり（タイマーホイールの 1 スロット）"""
+    __slots__ = ("period", "due", "dirty", "axes")
+    def __init__(self, period: float):
+        self.period = period    # 送出周期 [sec]
+        self.due = 0.0          # 次に送出してよい時刻（loop.time 基準）
+        self.dirty = False      # 保留中の値があるか
+        self.axes: List[int] = []
 
-    def update(self, code: int, is_down: bool):
-        (self.press if is_down else self.release)(int(code))
+class _AxisRateLimiter:
+    """
+    仮想軸ごとの出力レート制限（TSV オプション RATE=<Hz>）。
+    - submit() は最新値を保留するだけ（周期内の中間サンプルは捨てる）
+    - 同じ RATE の軸は 1 バケットにまとめ、バケットの定周期で保留値を emit → flush 1 回
+    - 保留が無くなればタイマーは止める（アイドル中は起きない）
+    emit(vabs, value) / flush() は UInputFFDevice.write / syn を想定
+    """
+    def __init__(self, loop, emit, flush, rates: Dict[int, int]):
+        self.loop = loop
+        self.emit = emit
+        self.flush = flush
+        self._pending = array('i', [_OUT_UNSET]) * (ecodes.ABS_MAX + 1)
+        self._buckets: Dict[int, _RateBucket] = {}     # hz -> bucket
+        self._bucket_of: Dict[int, _RateBucket] = {}   # vabs -> bucket
+        for vabs, hz in rates.items():
+            b = self._buckets.get(int(hz))
+            if b is None:
+                b = self._buckets[int(hz)] = _RateBucket(1.0 / int(hz))
+            b.axes.append(int(vabs))
+            self._bucket_of[int(vabs)] = b
+        self._timer = None
+        self._timer_when = 0.0
+
+    def __contains__(self, vabs) -> bool:
+        return vabs in self._bucket_of
+
+    def submit(self, vabs: int, value: int):
+        b = self._bucket_of[vabs]
+        self._pending[vabs] = value
+        b.dirty = True
+        # 既に張ってあるタイマーより先に送出すべきなら張り直す
+        if self._timer is None or b.due < self._timer_when:
+            self._arm()
+
+    def _arm(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        due = None
+        for b in self._buckets.values():
+            if b.dirty and (due is None or b.due < due):
+                due = b.due
+        if due is None:
+            return
+        # アイドル明け（due が過去）は即時に送出される
+        self._timer_when = max(due, self.loop.time())
+        self._timer = self.loop.call_at(self._timer_when, self._tick)
+
+    def _tick(self):
+        self._timer = None
+        now = self.loop.time()
+        pend = self._pending
+        sent = False
+        for b in self._buckets.values():
+            if not b.dirty or b.due > now:
+                continue
+            b.dirty = False
+            # 定周期を維持。アイドル明けで遅れている場合は今から 1 周期後
+            b.due = b.due + b.period if b.due + b.period > now else now + b.period
+            for vabs in b.axes:
+                v = pend[vabs]
+                if v != _OUT_UNSET:
+                    pend[vabs] = _OUT_UNSET
+                    self.emit(vabs, v)
+                    sent = True
+        if sent:
+            self.flush()
+        self._arm()
 
-    # 互換エイリアス
-    on  = update
-    off = lambda self, code, *_: self.update(int(code), False)
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
 
 
 # どこか共有ユーティリティに
@@ -983,452 +1837,6 @@ def get_path_from_fd(fd: int) -> str:
 # === ここを understeer.py の適切な位置（import郡の下あたり）に追加 ===
 import threading, queue, errno
 
-class UploadTask:
-    __slots__ = ("virt_id", "effect", "result_errno", "phys_id_out")
-    def __init__(self, virt_id:int, effect):
-        self.virt_id = virt_id
-        self.effect = effect
-        self.result_errno = 0
-        self.phys_id_out = -1
-
-class HidrawHandle:
-    """
-    hidraw と event の対応が “取れた時だけ” 使う汎用ハンドル。
-    - FFB の ioctl / write は event デバイスに対して行う（hidraw は情報/制御用）。
-    - ここで hidraw/event ともに O_RDWR|O_NONBLOCK で開く。
-    
-    使い方
-    # 1) event のパスが分かっている場合（推奨）
-    handle = HidrawHandle(hidraw_path=hid_path, event_path=event_path)
-    # 2) 既に InputDevice を持っている場合
-    handle = HidrawHandle(hidraw_path=hid_path, event_dev=event_input_device)
-    
-    """
-    def __init__(self,
-                 hidraw_path: str,
-                 event_path: Optional[str] = None,
-                 event_dev: Optional[InputDevice] = None):
-        import os
-        self.hidraw_path = hidraw_path
-        # ★ hidraw は常に書き込み可能でオープン
-        self.hid_fd = os.open(hidraw_path, os.O_RDWR | os.O_NONBLOCK)
-
-        self.event_path: Optional[str] = None
-        self.ui_event_fd: Optional[int] = None
-        self.dev: Optional[InputDevice] = None
-
-        if event_dev is not None:
-            # 既存の InputDevice を優先的に使う
-            self.dev = event_dev
-            try:
-                self.event_path = event_dev.path
-            except Exception:
-                self.event_path = event_path
-        else:
-            self.event_path = event_path
-            if self.event_path:
-                # 読み書き可能で開ける
-                self.dev = InputDevice(self.event_path)
-
-        # ★ event 側の“書込FD”を必ず確保（InputDevice が RO の場合でも確実に書けるようにする）
-        if self.event_path:
-            try:
-                self.ui_event_fd = os.open(self.event_path, os.O_RDWR | os.O_NONBLOCK)
-            except PermissionError:
-                # 失敗時は None。FFB は使えないが dev.write() が使える環境もあるので保持
-                logging.error("FFB は使えないが dev.write() が使える環境もあるので保持")
-                self.ui_event_fd = None
-
-    def close(self):
-        """明示的クローズ（必要に応じて呼び出し側で管理）"""
-        import os
-        if getattr(self, "dev", None):
-            try:
-                self.dev.close()
-            except Exception:
-                pass
-            self.dev = None
-        if getattr(self, "event_fd", None) is not None:
-            try:
-                os.close(self.ui_event_fd)
-            except Exception:
-                pass
-            self.ui_event_fd = None
-        if getattr(self, "hid_fd", None) is not None:
-            try:
-                os.close(self.hid_fd)
-            except Exception:
-                pass
-            self.hid_fd = None
-
-
-import errno, logging, time, select, fcntl, os
-from evdev import ecodes
-
-def write_ff_safe(dev, code, value, *,
-                  timeout=0.25,           # 1回の書き込み許容待ち時間
-                  retries=3,              # リトライ回数
-                  backoff=0.02,           # EAGAIN時の間隔
-                  poll_before=False):      # POLLOUTを待ってから書く T / その他 F
-    """
-    EV_FF 書き込み用の堅牢ラッパ。
-    - デバイスビジー時(EAGAIN/EWOULDBLOCK)に短いバックオフで再試行
-    - select.poll(POLLOUT)でfdの出力準備を待つ（キャラデバイスでも有効なことが多い）
-    - 長時間ブロックしそうならタイムアウトで諦めて上位へ返す
-    戻り値: "ok" / "skip" / "timeout" / "gone" / "unsupported" / "ioerr"
-    """
-    logging.error("ここって使ってる？？")
-    try:
-        fd = dev.fileno()
-        # 必須ではないが、念のため fd 実体をログできるように
-        # logging.debug("FF fd -> %s", os.readlink(f"/proc/self/fd/{fd}"))
-    except Exception:
-        return "gone"
-    """
-    # 事前に POLLOUT 待ち（任意）
-    if poll_before:
-        p = select.poll()
-        p.register(fd, select.POLLOUT | select.POLLERR | select.POLLHUP)
-        events = p.poll(int(timeout * 1000))
-        if not events:
-            return "timeout"
-        # エラー/切断チェック
-        for _, ev in events:
-            if ev & (select.POLLERR | select.POLLHUP):
-                return "gone"
-    """
-    deadline = time.monotonic() + timeout
-    attempt = 0
-    while True:
-        attempt += 1
-        try:
-            # EV_FF 書き込み用の堅牢ラッパ。
-            dev.write(ecodes.EV_FF, code, int(value))
-            dev.syn()
-            return "ok"
-        except OSError as e:
-            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
-                if time.monotonic() >= deadline:
-                    return "timeout"
-                time.sleep(backoff)
-                if attempt <= retries:
-                    continue
-                return "timeout"
-            elif e.errno in (errno.ENODEV, errno.ENXIO):   # デバイス消滅/切断
-                return "gone"
-            elif e.errno == errno.EINVAL:                  # 未対応 or 引数不正
-                return "unsupported"
-            elif e.errno == errno.EIO:
-                return "ioerr"
-            else:
-                logging.exception("EV_FF write unexpected errno=%s", e.errno)
-                return f"errno:{e.errno}"
-        except Exception:
-            logging.exception("EV_FF write unexpected error")
-            return "ioerr"
-
-
-
-class AsyncFFBProxy:
-    """ 物理機器への FFB 送信 """
-    def __init__(self, open_physical_ff_target, ff_mapper, us):
-        """open_physical_ff_target: () -> HidrawHandle"""
-        self._open_target = open_physical_ff_target  # 関数（まだ呼ばない）
-
-        self.ff_mapper = ff_mapper
-        self.ui = us
-
-        #self._queue: asyncio.Queue[_QueuedOp] = asyncio.Queue(maxsize=1024)
-        self._task: Optional[asyncio.Task] = None
-        self._stop = asyncio.Event()
-        self._handle: Optional[HidrawHandle] = None
-        # ここではデバイスに触れない（遅延オープン）
-        logging.debug("AsyncFFBProxy: init (lazy target opener)")
-
-
-
-    def _phys_fd(self) -> Optional[int]:
-        """物理 /dev/input/eventX の fd を返す"""
-        if not self._handle:
-            return None
-        if getattr(self._handle, "event_fd", None) is not None:
-            return self._handle.ui_event_fd
-        dev = getattr(self._handle, "dev", None)
-        return getattr(dev, "fd", None)
-
-    def _upload_from_payload(self, kind: str, payload: dict) -> tuple[str, Optional[int]]:
-        """
-        enqueue された upload_* payload を EVIOCSFF で物理へアップロードし、
-        物理 effect_id を返す。
-        戻り値: (status, phys_id or None)
-        """
-        logging.error("使ってないはず")
-        fd = self._phys_fd()
-        dev = getattr(self._handle, "dev", None)
-        if fd is None or dev is None:
-            return ("no-handle", None)
-
-        eff = payload.get("effect", {})
-        virt_id = int(eff.get("id", -1))
-        replay  = eff.get("replay", {})
-        length  = int(replay.get("length", 0))
-        delay   = int(replay.get("delay", 0))
-
-        # build_* に渡すフォーマットへ整形
-        params = {"length_ms": length, "delay_ms": delay}
-
-        from evdev import ecodes as E
-
-        if kind == "upload_constant":
-            const = eff.get("constant", {})
-            params.update({"level": int(const.get("level", 0))})
-            buf = build_effect_constant({"effect_id": -1, "params": params})
-
-        elif kind == "upload_spring":
-            s = eff.get("spring", {})
-            params.update({
-                "right_saturation": int(s.get("right_sat", 0x7FFF)),
-                "left_saturation":  int(s.get("left_sat",  0x7FFF)),
-                "right_coeff":      int(s.get("right_coef", -5000)),
-                "left_coeff":       int(s.get("left_coef",  -5000)),
-                "deadband":         int(s.get("deadband", 0)),
-                "center":           int(s.get("center", 0)),
-            })
-            buf = build_effect_condition({"effect_id": -1, "params": params}, E.FF_SPRING)
-
-        elif kind == "upload_damper":
-            d = eff.get("damper", {})
-            params.update({
-                "right_saturation": int(d.get("right_sat", 0x7FFF)),
-                "left_saturation":  int(d.get("left_sat",  0x7FFF)),
-                "right_coeff":      int(d.get("right_coef", -5000)),
-                "left_coeff":       int(d.get("left_coef",  -5000)),
-                "deadband":         int(d.get("deadband", 0)),
-                "center":           int(d.get("center", 0)),
-            })
-            buf = build_effect_condition({"effect_id": -1, "params": params}, E.FF_DAMPER)
-
-        elif kind == "upload_rumble":
-            r = eff.get("rumble", {})
-            params.update({
-                "strong_magnitude": int(r.get("strong_magnitude", 0)),
-                "weak_magnitude":   int(r.get("weak_magnitude", 0)),
-            })
-            buf = build_effect_rumble({"effect_id": -1, "params": params})
-
-        else:
-            return ("unsupported-kind", None)
-
-        try:
-            phys_id = upload_effect(fd, buf)  # EVIOCSFF in/out
-            self.ff_mapper._virt2phys[int(virt_id)] = int(phys_id)
-            logging.debug("Pys / upload/EVIOCSFF %s: virt_id=%s -> phys_id=%s",
-                          kind, virt_id, phys_id)
-            return ("ok", phys_id)
-        except Exception as e:
-            clear_ff_effects(dev)
-            return ("err-upload", None)
-
-    def _map_effect_id(self, vid: int) -> int:
-        """仮想IDを物理IDへ。未登録なら元の値を返す（保険）"""
-        try:
-            return int(self.ff_mapper._virt2phys.get(int(vid), int(vid)))
-        except Exception:
-            return int(vid)
-
-
-    def _dispatch_blocking(self, op):
-        """
-        物理ホイール(dev = evdev.InputDevice想定)へブロッキングで指示を送る。
-        kind:
-          - gain:        {"value": 0..65535 or 0..100}
-          - autocenter:  {"value"| "enabled"| "autocenter"}
-          - play:        {"effect_id": int, "value": int=1}  # EV_FF: start(1)/repeat(n)
-          - stop:        {"effect_id": int}                   # EV_FF: stop(0)
-          - erase:       {"effect_id": int}
-          - upload|update: 将来実装（現状はスタブ）
-        """
-        logging.error("使ってないはず")
-        path = getattr(getattr(self._handle, "dev", None), "path", "(no-handle)")
-        logging.debug(f"[FFB-Pys-SendToWheel]<dispatch_block>: {op} {path}")
-        # op は (kind, payload) か、_QueuedOp(kind=..., payload=...) のどちらか
-        try:
-            # dataclass / namedtuple 風
-            kind = op.kind
-            p = op.payload
-        except AttributeError:
-            # 旧形式のタプル風
-            kind, p = op
-        dev  = getattr(self._handle, "dev", None)  # evdev.InputDevice を想定
-
-        if dev is None:
-            logging.error("_dispatch_blocking: ERR (no-handle)")
-            return "no-handle"
-
-        # 1) 
-        if kind == "gain":
-            v = int(p.get("value", 0))
-            if   v < 0:     v = 0
-            elif v > 65535: v = 65535
-
-            # 物理デバイスへ反映
-            #dev.write(ecodes.EV_FF, ecodes.FF_GAIN, v)
-            #dev.syn()
-            ret = write_ff_safe(dev, ecodes.FF_GAIN, v)
-            logging.debug("物理デバイスへ反映 ok:gain / %s", ret)
-            return "ok:gain"
-        if kind == "autocenter":
-            # 受け口は柔軟に：enabled / value / autocenter のいずれか
-            v = p.get("value", None)
-            if v is None:
-                if "enabled" in p:
-                    v = 65535 if bool(p["enabled"]) else 0
-                elif "autocenter" in p:
-                    v = int(p["autocenter"])
-                else:
-                    v = 0  # デフォルトでOFF
-            # 0..100 を送ってくるゲーム対策：0..65535 へ正規化
-            try:
-                v = int(v)
-            except Exception:
-                v = 0
-            if 0 <= v <= 100:
-                v = int(round(v * 655.35))
-            # クランプ
-            if v < 0:
-                v = 0
-            elif v > 65535:
-                v = 65535
-            # 物理デバイスへ反映
-            ret = write_ff_safe(dev, ecodes.FF_AUTOCENTER, v)
-            logging.debug("物理デバイスへ反映 ok:autocenter / %s", ret)
-            return "ok:autocenter"
-
-        if self.us.ff_passthrough_easy:
-            return "skip:ff_passthrough_easy-only"
-
-        # 2) 再生/停止（Linux evdevの標準：EV_FF, code=effect_id, value=1/0）
-        if kind == "play":
-            eff_id = p.get("effect_id")
-            if eff_id is None:
-                logging.warning("[FFB-Pys-SendToWheel] play missing effect_id -> ignored")
-                return "skip:play-missing-effect-id"
-            try:
-                eff_id = int(eff_id)
-            except Exception:
-                logging.warning("[FFB-Pys-SendToWheel] play bad effect_id -> ignored")
-                return "skip:play-bad-effect-id"
-
-            # repeat 既定値は 1（ゲーム次第で >1 が来ることもある）
-            repeat = p.get("value", 1)
-            try:
-                repeat = int(repeat)
-            except Exception:
-                repeat = 1
-            repeat = max(1, repeat)  # 0 は stop と紛らわしいので 1 以上に丸める
-
-            ret = write_ff_safe(dev, eff_id, repeat)  # EV_FF/code=eff_id/value=repeat
-            logging.debug("[FFB-Pys-SendToWheel] ok:play id=%d repeat=%d / %s", eff_id, repeat, ret)
-            return "ok:play"
-
-        if kind == "stop":
-            eff_id = p.get("effect_id")
-            if eff_id is None:
-                logging.warning("[FFB-Pys-SendToWheel] stop missing effect_id -> ignored")
-                return "skip:stop-missing-effect-id"
-            try:
-                eff_id = int(eff_id)
-            except Exception:
-                logging.warning("[FFB-Pys-SendToWheel] stop bad effect_id -> ignored")
-                return "skip:stop-bad-effect-id"
-
-            # stop は value=0 を送る
-            ret = write_ff_safe(dev, eff_id, 0)
-            logging.debug("[FFB-Pys-SendToWheel] ok:stop id=%d / %s", eff_id, ret)
-            return "ok:stop"
-
-        # 3) アップロード／更新（仮想→物理 変換と実エフェクト生成）
-        if kind in ("upload_constant", "upload_spring", "upload_damper", "upload_rumble"):
-            st, phys_id = self._upload_from_payload(kind, p)
-            return f"{st}:{kind}"
-
-        if kind in ("upload", "update"):
-            # 旧一般名（使わない想定だが保険）
-            et = p.get("effect_type")
-            logging.debug("[FFB-Pys-SendToWheel] %s-stub (effect_type=%s)", kind, et)
-            return f"ok:{kind}-stub"
-
-        # 4) 再生/停止（タイプ別の play_* を優先）
-        if kind in ("play_constant", "play_spring", "play_damper", "play_rumble"):
-            eff_id = p.get("effect_id")
-            if eff_id is None:
-                return f"skip:{kind}-missing-id"
-            peid = self._map_effect_id(eff_id)
-            repeat = int(p.get("value", 1))
-            ret = write_ff_safe(dev, peid, max(1, repeat))
-            logging.debug("Pys / %s virt_id=%s -> phys_id=%s / %s",
-                          kind, eff_id, peid, ret)
-            return f"ok:{kind}"
-
-        if kind == "play":
-            eff_id = p.get("effect_id")
-            if eff_id is None:
-                return "skip:play-missing-id"
-            peid = self._map_effect_id(eff_id)
-            repeat = int(p.get("repeat", p.get("value", 1)))
-            ret = write_ff_safe(dev, peid, max(1, int(repeat)))
-            logging.debug("Pys / play virt_id=%s -> phys_id=%s / %s",
-                          eff_id, peid, ret)
-            return "ok:play"
-
-        if kind == "stop":
-            eff_id = p.get("effect_id")
-            if eff_id is None:
-                return "skip:stop-missing-id"
-            peid = self._map_effect_id(eff_id)
-            ret = write_ff_safe(dev, peid, 0)
-            logging.debug("Pys / stop virt_id=%s -> phys_id=%s / %s",
-                          eff_id, peid, ret)
-            return "ok:stop"
-
-        if kind in ("erase", "remove", "upload_erase", "eviocrmff"):
-            eff_id = _coerce_effect_id(p)
-            if eff_id is None:
-                logging.error("Pys / erase: payload has no effect_id: %r", p)
-                return "bad-payload"
-            # ★ 必ず O_RDWR の eventFD を使う Pys / EVIOCRMFF
-            fd = self._phys_fd()
-            if fd is None:
-                logging.error("Pys / EVIOCRMFF failed: no phys fd")
-                return "no-handle"
-            # ★ 重要：EVIOCRMFF は int のポインタ渡し
-            EVIOCRMFF = 0x40044581
-            try:
-                # 0 は合法な effect_id。未登録は None 判定のみ。
-                phys_id = self.ff_mapper._virt2phys.get(eff_id, None)
-                target_id = phys_id if phys_id is not None else int(eff_id)
-                # 機器と会話
-                # ★ ここが重要：int をそのまま渡す（pack しない）
-                fcntl.ioctl(fd, EVIOCRMFF, int(target_id), False)
-                logging.debug("Pys / EVIOCRMFF ok (id=%d)", phys_id)
-                #return "ok:erase"
-            except OSError as e:
-                logging.error("Pys / EVIOCRMFF failed id=%d: %s", phys_id, e)
-                traceback.print_exc()
-                #return f"err:{e.errno}"
-
-            # マップ掃除（同じ仮想IDが再利用される可能性もあるため、一応消す）
-            try:
-                self.ff_mapper._virt2phys.pop(int(eff_id), None)
-            except Exception:
-                pass
-            return "ok:erase"
-
-        logging.error(f"[ff] 実装が必要_dispatch_blocking skip:unknown-kind:{kind}")
-        return f"skip:unknown-kind:{kind}"
-
-
-
 """
 実装：FFB
 """
@@ -1466,13 +1874,22 @@ def fd_path(fd: int) -> str:
 
 class FfEvioMapper:
     def __init__(self):
-        # 仮想id <-> 物理id の相互マップ
+        # 仮想id <-> 物理id の相互マップ。
+        # 書くのは FF サーバスレッドだけ（読みもほぼ同スレッドなのでロック無しで get してよい）。
+        # 変更は _map_lock の中でまとめて行う（ioctl はロックの外）。他スレッド（--shm / 制御ソケット）は
+        # マップに触らず、変更のたびに書き直す slots_used（int 1 個）だけを読む
         self._map_lock = threading.RLock()     # ★ 追加: 再入可能ロック
+        self.slots_used = 0
         self._virt2phys: dict[int, int] = {}
-        self._phys2virt: dict[int, int] = {}
+        self._phys2virt: dict[int, int] = {}   # pID -> 載せた virt_id（別名があっても 1 つ）
         self._phys_last_used: dict[int, float] = {}  # pID -> last used (monotonic)
+        # 内容アドレス: 同じ中身（id=0 にした ff_effect のバイト列）の effect は 1 スロットを共有する
+        self._phys_by_key: dict[bytes, int] = {}   # key -> pID
+        self._phys_key: dict[int, bytes] = {}      # pID -> key
+        self._phys_refs: dict[int, int] = {}       # pID -> 参照している virt_id の数
         self.phys_fd = None                    # ★ 後でセットされる想定
-        pass
+        self.backend = None                    # 物理への送信（EvdevFFBackend / HidrawFFBackend）
+        self.mixer: Optional[FFMixer] = None   # --ff-soft 時に UnderSteer が用意
 
     # === FfEvioMapper 相当のクラス内に、無ければ追加 ===
     def extract_id_from_ff_effect_buf(self, buf: bytearray) -> int:
@@ -1493,10 +1910,47 @@ class FfEvioMapper:
         except Exception:
             return default
 
-    # 登録（UPLOAD 成功後に使う）
-    def remember(self, virt_id: int, phys_id: int) -> None:
-        self._virt2phys[virt_id] = phys_id
-        self._phys2virt[phys_id] = virt_id
+    # 登録（UPLOAD 成功後 / 同じ中身のスロットへ別名を張る時に使う）
+    def remember(self, virt_id: int, phys_id: int, key: Optional[bytes] = None) -> None:
+        with self._map_lock:
+            if self._virt2phys.get(virt_id) != phys_id:
+                self._virt2phys[virt_id] = phys_id
+                self._phys_refs[phys_id] = self._phys_refs.get(phys_id, 0) + 1
+            self._phys2virt.setdefault(phys_id, virt_id)
+            if key is not None:
+                old = self._phys_key.get(phys_id)
+                if old is not None and old != key and self._phys_by_key.get(old) == phys_id:
+                    del self._phys_by_key[old]     # 同じスロットを別の中身で更新した
+                self._phys_key[phys_id] = key
+                self._phys_by_key[key] = phys_id
+            self.slots_used = len(self._phys_refs)
+
+    def lookup_key(self, key: bytes) -> Optional[int]:
+        return self._phys_by_key.get(key)
+
+    def unmap_virt(self, virt_id: int) -> int:
+        """virt_id の割当を外す。最後の参照だったら物理から消すべき pID を、まだ共有中なら -1 を返す"""
+        with self._map_lock:
+            phys = self._virt2phys.pop(virt_id, None)
+            if phys is None:
+                return -1
+            n = self._phys_refs.get(phys, 1) - 1
+            if n > 0:
+                self._phys_refs[phys] = n
+                if self._phys2virt.get(phys) == virt_id:
+                    self._phys2virt[phys] = next(v for v, p in self._virt2phys.items() if p == phys)
+                return -1
+            self._drop_phys(phys)
+            self.slots_used = len(self._phys_refs)
+            return phys
+
+    def _drop_phys(self, phys_id: int) -> None:
+        self._phys2virt.pop(phys_id, None)
+        self._phys_refs.pop(phys_id, None)
+        self._phys_last_used.pop(phys_id, None)
+        key = self._phys_key.pop(phys_id, None)
+        if key is not None and self._phys_by_key.get(key) == phys_id:
+            del self._phys_by_key[key]
 
     # 参照（ERASE 時に使う）
     def phys_of(self, virt_id: int) -> int | None:
@@ -1504,44 +1958,76 @@ class FfEvioMapper:
 
     # 片方の id が無効になったときの掃除
     def forget_by_virt(self, virt_id: int) -> None:
-        phys = self._virt2phys.pop(virt_id, None)
-        if phys is not None:
-            self._phys2virt.pop(phys, None)
+        phys = self.unmap_virt(virt_id)
+        if phys >= 0:
+            self._phys_last_used.pop(phys, None)
 
     def forget_by_phys(self, phys_id: int) -> None:
-        virt = self._phys2virt.pop(phys_id, None)
-        if virt is not None:
-            self._virt2phys.pop(virt, None)
+        with self._map_lock:
+            for virt in [v for v, p in self._virt2phys.items() if p == phys_id]:   # 別名も全部
+                del self._virt2phys[virt]
+            self._drop_phys(phys_id)
+            self.slots_used = len(self._phys_refs)
+
+    def clear(self) -> None:
+        with self._map_lock:
+            self._virt2phys.clear()
+            self._phys2virt.clear()
+            self._phys_last_used.clear()
+            self._phys_by_key.clear()
+            self._phys_key.clear()
+            self._phys_refs.clear()
+            self.slots_used = 0
+
+    def slots_in_use(self) -> int:
+        """FF サーバスレッド以外（--shm / 制御ソケット）から読む時はこれ（ロックを取らない）"""
+        return self.slots_used
+
+    def touch(self, phys_id: int) -> None:
+        self._phys_last_used[phys_id] = time.monotonic()
+
+    def _evict_some_phys_slots(self, limit: int = 4, keep=()) -> int:
+        """
+        ENOSPC 時の整理: keep（再生中の phys_id）以外の物理スロットを最終使用が古い順に limit 個まで消す。
+        消した数を返す。マップからも外すので、次の再生で必要なら再アップロードされる
+        """
+        with self._map_lock:
+            victims = sorted((p for p in self._phys_refs if p not in keep),
+                             key=lambda p: self._phys_last_used.get(p, 0.0))[:limit]
+        freed = 0
+        for phys_id in victims:
+            try:
+                self.backend.erase(phys_id)
+                freed += 1
+            except OSError as e:
+                logging.warning("[ff-evict] EVIOCRMFF id=%d failed: %s", phys_id, e)
+            self.forget_by_phys(phys_id)
+        logging.warning("[ff-evict] freed %d/%d physical slots (keep=%d)", freed, len(victims), len(keep))
+        return freed
+
+    def erase_all_phys_slots(self, timeout_sec: float = 0.5) -> int:
+        """マップにある物理スロットを全部消す（ハングに備えて 1 件ずつタイムアウト付き）。消した数を返す"""
+        with self._map_lock:
+            slots = list(self._phys_refs)
+        ok = 0
+        for phys_id in slots:
+            try:
+                self.backend.erase(phys_id, timeout_sec=timeout_sec)
+                ok += 1
+            except (OSError, TimeoutError) as e:
+                logging.warning("[ff] erase phys id=%d: %s", phys_id, e)
+        self.clear()
+        return ok
 
     def __repr__(self) -> str:
         logging.error("FfEvioMapper __repr__　使ってないと思う")
         # 追加したらここに出す（将来 hidraw/TMFF2 直送などの分岐名も）
-        return "<FfEvioMapper backend='EVIOCSFF/EVIOCRMFF' features='upload,erase'>"
+        return f"<FfEvioMapper backend={getattr(self.backend, 'name', None)!r} features='upload,erase'>"
 
     @staticmethod
     def _ff_type_name(t: int) -> str:
-        # FfEvioMapper._ff_type_name()
-        m = {
-            E.FF_CONSTANT: f"CONSTANT({E.FF_CONSTANT})",
-            E.FF_SPRING:   f"SPRING({E.FF_SPRING})",
-            E.FF_DAMPER:   f"DAMPER({E.FF_DAMPER})",
-            E.FF_RUMBLE:   f"RUMBLE({E.FF_RUMBLE})",
-            E.FF_PERIODIC: f"PERIODIC({E.FF_PERIODIC})",
-            getattr(E, "FF_SINE", 0): f"SINE({getattr(E, 'FF_SINE', 0)})",
-            getattr(E, "FF_SQUARE", 0): f"SQUARE({getattr(E, 'FF_SQUARE', 0)})",
-            getattr(E, "FF_TRIANGLE", 0): f"TRIANGLE({getattr(E, 'FF_TRIANGLE', 0)})",
-            getattr(E, "FF_RAMP", 0): f"RAMP({getattr(E, 'FF_RAMP', 0)})",
-            
-            E.FF_SAW_UP:          f"SAW_UP({E.FF_SAW_UP})",
-            E.FF_SAW_DOWN:          f"SAW_DOWN({E.FF_SAW_DOWN})",
-            E.FF_INERTIA:          f"INERTIA({E.FF_INERTIA})",
-            E.FF_FRICTION:          f"FRICTION({E.FF_FRICTION})",
-            E.FF_CUSTOM:          f"CUSTOM({E.FF_CUSTOM})",
-            
-            E.FF_GAIN:          f"GAIN({E.FF_GAIN})",
-            E.FF_AUTOCENTER:    f"AUTOCENTER({E.FF_AUTOCENTER})",
-        }
-        return m.get(int(t), f"TYPE_{int(t)}")
+        # FfEvioMapper._ff_type_name() → 'CONSTANT(82)'
+        return FF_TYPE_LABELS.get(t) or f"TYPE_{int(t)}"
 
     @staticmethod
     def _ff_effect_to_dict(eff) -> dict:
@@ -1602,194 +2088,197 @@ class FfEvioMapper:
         return d
 
 
-    def upload_ff_effect_via_eviocsff(self, phys_fd: int, ff_effect_struct) -> int:
-        # 可視化に役立つログ（どの event に投げているか）
-        psyfdpath = fd_path(phys_fd)
-        # 書いてみる
-        fcntl.ioctl(phys_fd, EVIOCSFF, ff_effect_struct, True)
-        logging.info(f"Pys up OK. type={FfEvioMapper._ff_type_name(ff_effect_struct.type)}")
-        
-        # カーネルが書き戻した id を取り出して元構造体へ反映
-        try:
-            id_offset = type(ff_effect_struct).id.offset
-            eff_id = ctypes.c_int16.from_buffer(ff_effect_struct, id_offset).value  # ✓ 2byte read
-        except Exception as e:
-            logging.error("Pys-FFB up/ ERROR")
-            traceback.print_exc()
-            # 最低でも id だけ返せればOK
-            eff_id = -1
 
+# ---- 物理側 FF バックエンド ----
+# FF サーバ（UInputFFDevice / SoftFFEngine / FfEvioMapper）は物理ホイールへの送信を全部ここ経由で行う。
+#   upload(eff) -> slot : eff.id = -1 で新規、既存 slot なら更新。スロット切れは OSError(ENOSPC)
+#   erase(slot) / play(slot, count)（count=0 で停止） / set_level(FF_GAIN|FF_AUTOCENTER, 0..0xFFFF) / close()
+#   types : 送れる FF type の集合（None = 物理ホイールが持っている type は全部）
+
+class EvdevFFBackend:
+    """従来の経路: /dev/input/eventX へ EVIOCSFF / EVIOCRMFF / EV_FF write（スロット管理はカーネル側）"""
+    name = "evdev"
+    types = None
+
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def upload(self, eff) -> int:
+        fcntl.ioctl(self.fd, EVIOCSFF, eff, True)
+        # カーネルが書き戻した id（s16）
+        eff_id = int(eff.id)
         if eff_id < 0:
             logging.error(f"EVIOCSFF returned invalid id={eff_id}")
             raise OSError(errno.EINVAL, f"EVIOCSFF returned invalid id={eff_id}")
-        
-        logging.debug(f"[Pys up] after EVIOCSFF id={eff_id}")
-        return int(eff_id)
-
-    def erase_ff_effect_via_eviocrmff(self, phys_fd: int, effect_id: int) -> None:
-        psyfdpath = fd_path(phys_fd)
-        fcntl.ioctl(phys_fd, EVIOCRMFF, int(effect_id), True)
-        logging.info(f"Pys er OK. id={effect_id}")
-
-
-# ---- input_event(カーネルに投げる再生/停止トリガ) ----
-_INPUT_EVENT_FMT = "qqHHI"  # sec,usec,type,code,value（timeは0で投げてOK）
-def _ie(type_, code, value):
-    return struct.pack(_INPUT_EVENT_FMT, 0, 0, type_, code, value)
-def pack_ie(t, c, v):  # timevalは0でOK
-    return struct.pack(INPUT_EVENT_FMT, 0, 0, t, c, v)
-
-# 共通ヘッダ(type,id,direction, trigger_button, trigger_interval, replay_length, replay_delay)
-_FF_HDR_FMT = "HhH H H H H"  # = 2+2+2 +2+2 +2+2 = 14 bytes
-
-# envelope（ここでは省略→全部0で）
-# 省略時の定数（attack_length, attack_level, fade_length, fade_level）
-_ENV_FMT = "HHHH"  # 8 bytes
-_ENV_ZERO = struct.pack(_ENV_FMT, 0, 0, 0, 0)
-
-# ------ Constant ------
-# level(s16), envelope(8B)
-_CONST_FMT = "h"  # level のみ（後にENVを連結）
-
-# ------ Periodic ------
-# waveform(u16) period(u16) magnitude(s16) offset(s16) phase(u16) envelope(8B) custom_len(u32)
-_PER_FMT = "HHhhH"  # + ENV(8) + I(4)
-
-# ------ Condition (Spring/Damper) ------
-# right_sat(u16) left_sat(u16) right_coeff(s16) left_coeff(s16) deadband(u16) center(s16)
-_COND_FMT = "HHhhHh"
-
-# ------ Rumble ------
-# strong(u16) weak(u16)
-_RUM_FMT = "HH"
-
-
-def _hdr(effect_type, eff_id, direction_deg, length_ms, delay_ms, trigger_button=0, trigger_interval=0):
-    # direction: 0..360 deg -> 0..0xFFFF (カーネル仕様)
-    direction = int((direction_deg % 360) * 0xFFFF / 360) if direction_deg is not None else 0
-    return struct.pack(
-        _FF_HDR_FMT,
-        effect_type,
-        int(eff_id),         # -1 で新規アップロード
-        direction,
-        int(trigger_button),
-        int(trigger_interval),
-        int(length_ms),
-        int(delay_ms),
-    )
+        logging.debug(f"[Pys up] after EVIOCSFF type={FfEvioMapper._ff_type_name(eff.type)} id={eff_id}")
+        return eff_id
 
-# ---- 各効果ビルダー（payload["params"]から構築） ----
-
-def build_effect_constant(payload):
-    p = payload["params"]
-    level = int(max(-32768, min(32767, p.get("level", 0))))
-    length = int(p.get("length_ms", 0))
-    delay  = int(p.get("delay_ms", 0))
-    direction_deg = int(p.get("direction_deg", 0))
-    eff_id = int(payload.get("effect_id", -1))
-
-    buf = bytearray()
-    buf += _hdr(E.FF_CONSTANT, eff_id, direction_deg, length, delay)
-    buf += struct.pack(_CONST_FMT, level)
-    buf += _ENV_ZERO
-    return buf
-
-def build_effect_periodic_sine(payload):
-    p = payload["params"]
-    length = int(p.get("length_ms", 0))
-    delay  = int(p.get("delay_ms", 0))
-    direction_deg = int(p.get("direction_deg", 0))
-    eff_id = int(payload.get("effect_id", -1))
-
-    waveform = E.FF_SINE
-    period_ms = int(p.get("period_ms", 10))   # 例: 100Hz = 10ms
-    magnitude = int(max(-32768, min(32767, p.get("magnitude", 20000))))
-    offset    = int(max(-32768, min(32767, p.get("offset", 0))))
-    phase_deg = int(p.get("phase_deg", 0))
-
-    buf = bytearray()
-    buf += _hdr(E.FF_PERIODIC, eff_id, direction_deg, length, delay)
-    buf += struct.pack(_PER_FMT, waveform, period_ms, magnitude, offset, phase_deg)
-    buf += _ENV_ZERO
-    buf += struct.pack("I", 0)  # custom_len = 0
-    return buf
-
-def build_effect_condition(payload, kind):
-    """kind: E.FF_SPRING or E.FF_DAMPER"""
-    p = payload["params"]
-    length = int(p.get("length_ms", 0))
-    delay  = int(p.get("delay_ms", 0))
-    direction_deg = int(p.get("direction_deg", 0))
-    eff_id = int(payload.get("effect_id", -1))
-
-    # 値域はデバイスによって最適が違う。まずは安全な中程度で。
-    right_sat = int(p.get("right_saturation", 0x7FFF))
-    left_sat  = int(p.get("left_saturation",  0x7FFF))
-    right_coef= int(p.get("right_coeff", -5000))
-    left_coef = int(p.get("left_coeff",  -5000))
-    deadband  = int(p.get("deadband", 0))
-    center    = int(p.get("center", 0))
-
-    # condition は左右2本分（index 0/1）を続けて入れる
-    cond = struct.pack(_COND_FMT, right_sat, left_sat, right_coef, left_coef, deadband, center)
-    cond += struct.pack(_COND_FMT, right_sat, left_sat, right_coef, left_coef, deadband, center)
-
-    buf = bytearray()
-    buf += _hdr(kind, eff_id, direction_deg, length, delay)
-    buf += cond
-    return buf
-
-def build_effect_rumble(payload, strong=False):
-    p = payload["params"]
-    length = int(p.get("length_ms", 0))
-    delay  = int(p.get("delay_ms", 0))
-    eff_id = int(payload.get("effect_id", -1))
-
-    strong_mag = int(p.get("strong_magnitude", 0 if not strong else 0x7FFF))
-    weak_mag   = int(p.get("weak_magnitude",   0 if strong else 0x7FFF))
-
-    buf = bytearray()
-    buf += _hdr(E.FF_RUMBLE, eff_id, 0, length, delay)
-    buf += struct.pack(_RUM_FMT, strong_mag, weak_mag)
-    return buf
-
-# =========================================================
-# アップロード／再生／停止／削除
-# =========================================================
-def upload_effect(psy_fd, effect_buf):
-    try:
-        fcntl.ioctl(psy_fd, EVIOCSFF, effect_buf, False)
-    except OSError as e:
-        if e.errno == 28:  # ENOSPC
-            # psy_fd から evdev.InputDevice を再解決できないので、
-            # 「仮想デバイス側」を引数で貰う設計に変える or クリア自体をやめる。
-            # 簡易対処：スロット不足時はそのまま例外にして上位で判断。
-            raise
+    def erase(self, slot: int, timeout_sec: Optional[float] = None):
+        if timeout_sec is None:
+            fcntl.ioctl(self.fd, EVIOCRMFF, int(slot), False)
         else:
-            raise
-    # id 書き戻しの読み出しはそのまま
-    hdr = struct.unpack(_FF_HDR_FMT, effect_buf[:struct.calcsize(_FF_HDR_FMT)])
-    _, eff_id, *_ = hdr
-    return eff_id
+            _ioctl_with_timeout(self.fd, EVIOCRMFF, int(slot), timeout_sec=timeout_sec)
+
+    def play(self, slot: int, count: int):
+        write_input_event(self.fd, E.EV_FF, slot, count)
+
+    def set_level(self, code: int, value: int):
+        write_input_event(self.fd, E.EV_FF, code, value)
+
+    def close(self):
+        pass
+
+
+# hidraw 直送できるホイール（VID, PID）-> プロトコル。いずれも Thrustmaster T300RS 系の出力レポート
+# （hid-tmff2 と同じ形）。PID は公開情報からのもので、b66d/b696/b69c は実機で要確認
+HIDRAW_FF_MODELS: Dict[Tuple[int, int], str] = {
+    (0x044F, 0xB66E): "t300rs",    # T300RS（PS3 normal）
+    (0x044F, 0xB66F): "t300rs",    # T300RS（PS3 advanced）
+    (0x044F, 0xB66D): "t300rs",    # T300RS（PS4）
+    (0x044F, 0xB696): "t248",
+    (0x044F, 0xB69C): "t128",      # README の T128
+}
+
+T300RS_REPORT_ID = 0x60
+T300RS_REPORT_LEN = 64             # report id + 63 バイト
+T300RS_MAX_EFFECTS = 16
+T300RS_TIMING_START = 0x4F
+T300RS_TIMING_END = 0xFF
+T300RS_CMD_CONSTANT = 0x6A
+T300RS_CMD_EFFECT = 0x6B           # condition / periodic
+T300RS_CMD_PLAY = 0x89
+T300RS_PLAY_START = 0x41
+T300RS_PLAY_STOP = 0x00
+T300RS_COND_KIND = {E.FF_SPRING: 0x06, E.FF_DAMPER: 0x07, E.FF_FRICTION: 0x07, E.FF_INERTIA: 0x07}
+T300RS_WAVE = {E.FF_SQUARE: 0x20, E.FF_TRIANGLE: 0x21, E.FF_SINE: 0x22, E.FF_SAW_UP: 0x23, E.FF_SAW_DOWN: 0x24}
+
+
+class HidrawFFBackend:
+    """
+    /dev/hidrawN へ T300RS 系の FF 出力レポートを直接書くバックエンド。
+    スロット（0..T300RS_MAX_EFFECTS-1）はここで管理するので、カーネルの EVIOCSFF スロット管理とロックを通らない。
+    path は普通のファイルでもよい（書いたレポートを後から読んで確かめられる）
+    """
+    name = "hidraw"
+    types = frozenset((E.FF_CONSTANT, E.FF_PERIODIC, *T300RS_COND_KIND))   # RUMBLE / RAMP は送れない
+
+    def __init__(self, path: str, model: str = "t300rs"):
+        self.path = path
+        self.model = model
+        # ブロッキングで開く（書くだけ。O_NONBLOCK だと USB が詰まった時に EAGAIN でレポートを落とす）
+        self.fd = os.open(path, os.O_RDWR)
+        self._used = bytearray(T300RS_MAX_EFFECTS)
+        self._buf = bytearray(T300RS_REPORT_LEN)
+
+    def _send(self, *parts: bytes):
+        buf = self._buf
+        buf[:] = bytes(T300RS_REPORT_LEN)
+        buf[0] = T300RS_REPORT_ID
+        i = 1
+        for b in parts:
+            buf[i:i + len(b)] = b
+            i += len(b)
+        os.write(self.fd, buf)
+
+    @staticmethod
+    def _timing(eff) -> bytes:
+        r = eff.replay
+        length = 0xFFFF if r.length == 0 else int(r.length)   # 0 = 停止まで
+        return struct.pack("<BHxxHxB", T300RS_TIMING_START, length, int(r.delay), T300RS_TIMING_END)
+
+    @staticmethod
+    def _dir(level: int, direction: int) -> int:
+        # ステア軸への投影（lg4ff / --ff-soft と同じ: 0x4000 で +1）
+        return _clamp_s16(round(level * math.sin(direction * (2.0 * math.pi / 0x10000))))
 
+    def upload(self, eff) -> int:
+        slot = int(eff.id)
+        if slot < 0:
+            try:
+                slot = self._used.index(0)
+            except ValueError:
+                raise OSError(errno.ENOSPC, "hidraw FF slots exhausted") from None
+        elif not (slot < T300RS_MAX_EFFECTS and self._used[slot]):
+            raise OSError(errno.EINVAL, f"hidraw FF slot {slot} not allocated")
+        t = int(eff.type)
+        hdr = bytes((0x00, slot + 1))
+        if t == E.FF_CONSTANT:
+            env = eff.u.constant.envelope
+            body = struct.pack("<BhHHHHx", T300RS_CMD_CONSTANT,
+                               self._dir(eff.u.constant.level, eff.direction),
+                               env.attack_length, env.attack_level, env.fade_length, env.fade_level)
+        elif t in T300RS_COND_KIND:
+            c = eff.u.condition[0]
+            body = struct.pack("<BhhHHHHB", T300RS_CMD_EFFECT,
+                               c.right_coeff, c.left_coeff, c.deadband, c.deadband,
+                               c.right_saturation, c.left_saturation, T300RS_COND_KIND[t])
+        elif t == E.FF_PERIODIC:
+            pe = eff.u.periodic
+            wave = T300RS_WAVE.get(int(pe.waveform))
+            if wave is None:
+                raise OSError(errno.EINVAL, f"hidraw FF: unsupported waveform {int(pe.waveform)}")
+            env = pe.envelope
+            body = struct.pack("<BhhHHHHHHB", T300RS_CMD_EFFECT,
+                               self._dir(pe.magnitude, eff.direction), pe.offset, pe.phase, pe.period,
+                               env.attack_length, env.attack_level, env.fade_length, env.fade_level, wave)
+        else:
+            raise OSError(errno.EINVAL, f"hidraw FF: unsupported type {FfEvioMapper._ff_type_name(t)}")
+        self._send(hdr, body, self._timing(eff))
+        self._used[slot] = 1
+        eff.id = slot
+        return slot
+
+    def erase(self, slot: int, timeout_sec: Optional[float] = None):
+        if not (0 <= slot < T300RS_MAX_EFFECTS and self._used[slot]):
+            raise OSError(errno.EINVAL, f"hidraw FF slot {slot} not allocated")
+        self.play(slot, 0)
+        self._used[slot] = 0
+
+    def play(self, slot: int, count: int):
+        if count > 0:
+            self._send(struct.pack("<BBBBH", 0x00, slot + 1, T300RS_CMD_PLAY, T300RS_PLAY_START, min(count, 0xFFFF)))
+        else:
+            self._send(bytes((0x00, slot + 1, T300RS_CMD_PLAY, T300RS_PLAY_STOP)))
 
-    # id はヘッダ内（type(2), id(2) の位置）に書き戻される
-    # _FF_HDR_FMT="HhH H H H H" → 先頭から 2 バイト後の s16 が id
-    # struct.unpack で取り出す:
-    hdr = struct.unpack(_FF_HDR_FMT, effect_buf[:struct.calcsize(_FF_HDR_FMT)])
-    _, eff_id, *_ = hdr
-    return eff_id
+    def set_level(self, code: int, value: int):
+        if code == E.FF_GAIN:
+            self._send(bytes((0x02, value >> 8)))
+        elif code == E.FF_AUTOCENTER:
+            self._send(bytes((0x08, 0x04, 0x01)))
+            self._send(struct.pack("<BBH", 0x08, 0x03, value))
 
-def start_effect(psy_fd, effect_id, repeat=1):
-    os.write(psy_fd, _ie(E.EV_FF, effect_id, repeat))
-    os.write(psy_fd, _ie(E.EV_SYN, E.SYN_REPORT, 0))
+    def close(self):
+        for slot, used in enumerate(self._used):
+            if used:
+                try:
+                    self.erase(slot)
+                except OSError:
+                    pass
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
 
-def stop_effect(psy_fd, effect_id):
-    os.write(psy_fd, _ie(E.EV_FF, effect_id, 0))
-    os.write(psy_fd, _ie(E.EV_SYN, E.SYN_REPORT, 0))
 
-def erase_effect(psy_fd, effect_id):
-    fcntl.ioctl(psy_fd, EVIOCRMFF, effect_id, False)
+def open_ff_backend(kind: str, phys_fd: int, dev: InputDevice, hidraw_path: Optional[str]):
+    """
+    --ff-backend の解決（ホイール 1 台ごと）。
+    auto: HIDRAW_FF_MODELS に載っていて hidraw が見つかれば hidraw、それ以外は evdev
+    """
+    if kind != "evdev":
+        model = HIDRAW_FF_MODELS.get((dev.info.vendor, dev.info.product))
+        if model is None or not hidraw_path:
+            lvl = logging.error if kind == "hidraw" else logging.info
+            lvl("[ff] hidraw backend unavailable for %04x:%04x (model=%s, hidraw=%s); using evdev",
+                dev.info.vendor, dev.info.product, model, hidraw_path)
+        else:
+            try:
+                be = HidrawFFBackend(hidraw_path, model)
+                logging.info("[ff] backend=hidraw %s (%s)", hidraw_path, model)
+                return be
+            except OSError as e:
+                logging.error("[ff] open %s failed: %s; using evdev", hidraw_path, e)
+    return EvdevFFBackend(phys_fd)
 
 
 """
@@ -1964,6 +2453,424 @@ def _build_condition_pair_from_generic(kind: int, eff_in) -> "ff_effect":
 
 
 
+# ------------------------
+# --ff-soft: FF エフェクトのソフトウェア合成
+# ------------------------
+# 指定 type（既定は条件系 4 種）は物理へアップロードせず、ステア位置/速度/加速度から力を計算し、
+# 物理側は FF_CONSTANT 1 本（1 スロット）を一定周期で更新する。ゲームのパラメータをそのまま使う
+
+SOFT_FF_CONDITION = (ecodes.FF_SPRING, ecodes.FF_DAMPER, ecodes.FF_FRICTION, ecodes.FF_INERTIA)
+SOFT_FF_VEL_FULL    = 4.0    # 速度 4.0（ハンドル全幅 ±1.0 を 1/4 秒で振り切る）で DAMPER の coeff 100%
+SOFT_FF_ACC_FULL    = 40.0   # INERTIA の coeff 100% になる角加速度
+SOFT_FF_FRICTION_V0 = 0.02   # FRICTION の符号切替をなめらかにする速度幅（停止付近のバタつき防止）
+SOFT_FF_VEL_ALPHA   = 0.35   # 速度/加速度の 1 次 IIR 係数
+SOFT_FF_QUANTUM     = 64     # これ未満のレベル変化は物理へ送らない（USB 転送を減らす）
+
+_SOFT_FF_NAMES = {
+    "spring": (ecodes.FF_SPRING,), "damper": (ecodes.FF_DAMPER,),
+    "friction": (ecodes.FF_FRICTION,), "inertia": (ecodes.FF_INERTIA,),
+    "condition": SOFT_FF_CONDITION,
+    "periodic": (ecodes.FF_PERIODIC,),
+}
+
+# 周期波テーブル（1 周期 = SOFT_FF_WAVE_RES 点、値は ±1.0）。行は waveform - FF_SQUARE
+#   FF_SQUARE / FF_TRIANGLE / FF_SINE / FF_SAW_UP / FF_SAW_DOWN（FF_CUSTOM は未対応で 0）
+SOFT_FF_WAVE_RES = 1024
+SOFT_FF_MAX_PERIODIC = 16
+
+try:
+    import numpy as _np          # あればベクトル化（無くても array で同じ結果）
+except ImportError:
+    _np = None
+
+
+def _build_wave_tables() -> List[array]:
+    n = SOFT_FF_WAVE_RES
+    sq  = array('d', (1.0 if i < n // 2 else -1.0 for i in range(n)))
+    tri = array('d', ((4.0 * i / n - 1.0) if i < n // 2 else (3.0 - 4.0 * i / n) for i in range(n)))
+    sin = array('d', (math.sin(2.0 * math.pi * i / n) for i in range(n)))
+    up  = array('d', (2.0 * i / n - 1.0 for i in range(n)))
+    dn  = array('d', (1.0 - 2.0 * i / n for i in range(n)))
+    return [sq, tri, sin, up, dn, array('d', bytes(8 * n))]
+
+SOFT_FF_WAVES = _build_wave_tables()
+
+
+def parse_soft_ff_types(spec: str) -> frozenset:
+    """'condition' / 'spring,damper' などを FF type の集合へ"""
+    types = set()
+    for name in spec.split(","):
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name not in _SOFT_FF_NAMES:
+            raise ValueError(f"--ff-soft: unknown effect type '{name}' (choices: {', '.join(_SOFT_FF_NAMES)})")
+        types.update(_SOFT_FF_NAMES[name])
+    return frozenset(types)
+
+
+class _SoftCondition:
+    """条件系エフェクト 1 本（X 軸 = condition[0] のみ使う）。値は ±1.0 に正規化して持つ"""
+    __slots__ = ("type", "rsat", "lsat", "rcoef", "lcoef", "db", "center", "playing")
+
+    def __init__(self, eff):
+        c = eff.u.condition[0]
+        self.type = int(eff.type)
+        # saturation 0 を送ってくるゲームが多い（0 = 上限なし扱い）
+        self.rsat = (c.right_saturation / 0xFFFF) or 1.0
+        self.lsat = (c.left_saturation / 0xFFFF) or 1.0
+        self.rcoef = c.right_coeff / 0x7FFF
+        self.lcoef = c.left_coeff / 0x7FFF
+        self.db = min(1.0, c.deadband / 0x7FFF)
+        self.center = c.center / 0x7FFF
+        self.playing = False
+
+    def force(self, metric: float) -> float:
+        # center±deadband の外側で傾き coeff（正の coeff = 戻す向き）、saturation で頭打ち
+        d = metric - self.center
+        if d > self.db:
+            f = -self.rcoef * (d - self.db)
+            return -self.rsat if f < -self.rsat else (self.rsat if f > self.rsat else f)
+        if d < -self.db:
+            f = -self.lcoef * (d + self.db)
+            return -self.lsat if f < -self.lsat else (self.lsat if f > self.lsat else f)
+        return 0.0
+
+
+FF_MIX_NTYPES = 8                # FF_RUMBLE(0x50) .. FF_RAMP(0x57)
+
+
+class FFMixer:
+    """
+    FF の合成器。仮想 effect id ごとの寄与（±1.0、向き込み）を前確保した配列のスロットに置き、
+    mix() で「寄与 × type 別ゲイン」を合算 → 全体ゲイン → クリップして 1 本の出力にする。
+    書き手は自分のスロットへ 1 要素書くだけ（ロック無し、最新値が勝つ）。mix() は新しい配列を作らない
+    """
+    def __init__(self, n_ids: int = 64):
+        self.n = n_ids
+        zeros = (lambda: _np.zeros(n_ids)) if _np is not None else (lambda: array('d', bytes(8 * n_ids)))
+        self.contrib = zeros()
+        self.slot_gain = zeros()                       # bind 時に type ゲインを写す（mix で type を引かない）
+        self.slot_type = array('b', [-1]) * n_ids
+        self.type_gain = array('d', [1.0]) * FF_MIX_NTYPES
+        self.gain = 1.0
+        self.clip = 1.0
+        self.last = 0.0
+
+    def bind(self, virt_id: int, t: int) -> bool:
+        if not (0 <= virt_id < self.n):
+            logging.warning("[ff-mix] virt id %d out of range (0..%d)", virt_id, self.n - 1)
+            return False
+        ti = t - ecodes.FF_RUMBLE
+        self.slot_type[virt_id] = ti
+        self.slot_gain[virt_id] = self.type_gain[ti] if 0 <= ti < FF_MIX_NTYPES else 1.0
+        return True
+
+    def unbind(self, virt_id: int):
+        if 0 <= virt_id < self.n:
+            self.contrib[virt_id] = 0.0
+            self.slot_gain[virt_id] = 0.0
+            self.slot_type[virt_id] = -1
+
+    def write(self, virt_id: int, value: float):
+        self.contrib[virt_id] = value
+
+    def set_type_gain(self, t: int, gain: float):
+        ti = t - ecodes.FF_RUMBLE
+        if not (0 <= ti < FF_MIX_NTYPES):
+            raise ValueError(f"no mixer gain for FF type {t}")
+        self.type_gain[ti] = gain
+        st = self.slot_type
+        for i in range(self.n):
+            if st[i] == ti:
+                self.slot_gain[i] = gain
+
+    def mix(self) -> float:
+        if _np is not None:
+            s = float(self.contrib.dot(self.slot_gain))
+        else:
+            s = sum(map(operator.mul, self.contrib, self.slot_gain))
+        s *= self.gain
+        c = self.clip
+        s = -c if s < -c else (c if s > c else s)
+        self.last = s
+        return s
+
+    def snapshot(self) -> dict:
+        d = {FF_NAMES.get(ecodes.FF_RUMBLE + i, str(i))[3:].lower(): round(g * 100.0, 1)
+             for i, g in enumerate(self.type_gain)}
+        d["global"] = round(self.gain * 100.0, 1)
+        return d
+
+
+def parse_ff_mix_gains(spec) -> Dict[int, float]:
+    """
+    'spring=50,rumble=20,global=80'（%）-> {FF type: 0..1, 0: 全体}。
+    dict（制御ソケット）もそのまま受ける
+    """
+    items = spec.items() if isinstance(spec, Mapping) else (
+        part.split("=", 1) for part in str(spec).split(",") if part.strip())
+    out: Dict[int, float] = {}
+    for name, pct in items:
+        name = str(name).strip()
+        g = _ctl_range(pct, 0, 200, f"ff mix gain {name}") / 100.0
+        if name.lower() in ("global", "all"):
+            out[0] = g
+            continue
+        t = _ctl_ff_type(name)
+        if not (ecodes.FF_RUMBLE <= t < ecodes.FF_RUMBLE + FF_MIX_NTYPES):
+            # FF_GAIN / FF_AUTOCENTER や波形名はエフェクト type ではない
+            raise ValueError(f"ff mix gain: not an effect type: {name}")
+        out[t] = g
+    return out
+
+
+class _PeriodicBank:
+    """
+    再生中の FF_PERIODIC をスロット（最大 SOFT_FF_MAX_PERIODIC）の並列配列で持ち、
+    render() で全スロットを 1 パスで合成する（numpy があれば配列演算、無ければ同じ式をループ）。
+    時刻は ns（perf_counter_ns）。envelope は attack/fade を線形補間（Linux ff-memless と同じ考え方）
+    """
+    FIELDS = ("wave", "period", "mag", "offset", "phase", "dir",
+              "att_len", "att_lvl", "fade_len", "fade_lvl", "length", "start", "on")
+
+    def __init__(self):
+        n = SOFT_FF_MAX_PERIODIC
+        for f in self.FIELDS:
+            setattr(self, f, _np.zeros(n) if _np is not None else array('d', bytes(8 * n)))
+        for i in range(n):
+            self.period[i] = 1e6      # 空きスロットも 0 除算しないように
+        self._slot: Dict[int, int] = {}            # virt_id -> slot
+        self._free = list(range(n - 1, -1, -1))
+        self._table = _np.array(SOFT_FF_WAVES) if _np is not None else None
+        # slot -> virt_id（-1 = 空き）。render はここを見て FFMixer の各スロットへ書く
+        self.virt = _np.full(n, -1, dtype=_np.int64) if _np is not None else array('i', [-1]) * n
+
+    def owns(self, virt_id: int) -> bool:
+        return virt_id in self._slot
+
+    def upload(self, virt_id: int, eff) -> bool:
+        i = self._slot.get(virt_id)
+        if i is None:
+            if not self._free:
+                logging.warning("[ff-soft] periodic slots full; drop virt=%d", virt_id)
+                return False
+            i = self._slot[virt_id] = self._free.pop()
+            self.virt[i] = virt_id
+        p = eff.u.periodic
+        env = p.envelope
+        wave = int(p.waveform) - ecodes.FF_SQUARE
+        self.wave[i] = wave if 0 <= wave < len(SOFT_FF_WAVES) - 1 else len(SOFT_FF_WAVES) - 1
+        self.period[i] = max(1, int(p.period)) * 1e6            # ms -> ns
+        self.mag[i] = int(p.magnitude) / 0x7FFF
+        self.offset[i] = int(p.offset) / 0x7FFF
+        self.phase[i] = int(p.phase) / 0x10000                  # 1 周期に対する割合
+        # 物理ドライバ（lg4ff 等）と同じく direction の sin 成分をハンドル軸の向きとする
+        self.dir[i] = math.sin(2.0 * math.pi * int(eff.direction) / 0x10000)
+        self.att_len[i] = int(env.attack_length) * 1e6
+        self.att_lvl[i] = int(env.attack_level) / 0x7FFF
+        self.fade_len[i] = int(env.fade_length) * 1e6
+        self.fade_lvl[i] = int(env.fade_level) / 0x7FFF
+        self.length[i] = int(eff.replay.length) * 1e6           # 0 = 無期限
+        return True
+
+    def erase(self, virt_id: int):
+        i = self._slot.pop(virt_id, None)
+        if i is not None:
+            self.on[i] = 0.0
+            self.virt[i] = -1
+            self._free.append(i)
+
+    def play(self, virt_id: int, value: int, now_ns: int):
+        i = self._slot.get(virt_id)
+        if i is not None:
+            self.on[i] = 1.0 if value > 0 else 0.0
+            self.start[i] = now_ns
+
+    def render(self, now_ns: int, mixer: FFMixer):
+        """使用中スロットの現在値を mixer.contrib[virt_id] へ書く（停止/期限切れは 0）"""
+        if _np is not None:
+            return self._render_np(now_ns, mixer)
+        res = SOFT_FF_WAVE_RES
+        contrib = mixer.contrib
+        for i in range(SOFT_FF_MAX_PERIODIC):
+            vid = self.virt[i]
+            if vid < 0:
+                continue
+            el = now_ns - self.start[i]
+            if not self.on[i] or 0 < self.length[i] < el:   # 停止中 / replay.length を過ぎた
+                contrib[vid] = 0.0
+                continue
+            m = self._envelope(abs(self.mag[i]), el, self.att_len[i], self.att_lvl[i],
+                               self.fade_len[i], self.fade_lvl[i], self.length[i])
+            if self.mag[i] < 0:
+                m = -m
+            k = int((el / self.period[i] + self.phase[i]) * res) % res
+            contrib[vid] = (self.offset[i] + m * SOFT_FF_WAVES[int(self.wave[i])][k]) * self.dir[i]
+
+    @staticmethod
+    def _envelope(m, el, att_len, att_lvl, fade_len, fade_lvl, length):
+        if att_len > 0 and el < att_len:
+            m = att_lvl + (m - att_lvl) * el / att_len
+        if fade_len > 0 and length > 0 and el > length - fade_len:
+            m = fade_lvl + (m - fade_lvl) * max(0.0, length - el) / fade_len
+        return m
+
+    def _render_np(self, now_ns: int, mixer: FFMixer):
+        np = _np
+        used = self.virt >= 0
+        if not used.any():
+            return
+        el = now_ns - self.start
+        on = (self.on > 0) & ((self.length <= 0) | (el <= self.length))
+        if not on.any():
+            mixer.contrib[self.virt[used]] = 0.0
+            return
+        amag = np.abs(self.mag)
+        # attack: el < att_len の区間だけ att_lvl から線形に
+        att = (self.att_len > 0) & (el < self.att_len)
+        m = np.where(att, self.att_lvl + (amag - self.att_lvl) * el / np.maximum(self.att_len, 1.0), amag)
+        # fade: 終了前 fade_len の区間だけ fade_lvl へ線形に
+        fade = (self.fade_len > 0) & (self.length > 0) & (el > self.length - self.fade_len)
+        m = np.where(fade, self.fade_lvl + (m - self.fade_lvl) *
+                     np.maximum(0.0, self.length - el) / np.maximum(self.fade_len, 1.0), m)
+        m = np.where(self.mag < 0, -m, m)
+        k = ((el / self.period + self.phase) * SOFT_FF_WAVE_RES).astype(np.int64) % SOFT_FF_WAVE_RES
+        v = (self.offset + m * self._table[self.wave.astype(np.int64), k]) * self.dir
+        mixer.contrib[self.virt[used]] = np.where(on, v, 0.0)[used]
+
+
+class SoftFFEngine:
+    """
+    ソフトウェア FF レンダラ。スレッドの役割:
+      - 入力スレッド: feed_pos(raw) で最新のステア生値を 1 要素配列へ書くだけ
+      - FF サーバスレッド: upload/erase/play と tick()（物理 fd への書き込みはこのスレッドだけ）
+    """
+    def __init__(self, ff_mapper: "FfEvioMapper", types: frozenset,
+                 steer_min: int, steer_max: int, hz: int = 250, invert: bool = False):
+        self.ff_mapper = ff_mapper
+        self.mixer: FFMixer = ff_mapper.mixer
+        self.backend = ff_mapper.backend
+        self.types = types
+        self.period_ns = int(1e9 / max(1, hz))
+        self.next_ns = 0
+        self.sign = -1.0 if invert else 1.0
+        self._mid = (steer_min + steer_max) / 2.0
+        self._half = max(1.0, (steer_max - steer_min) / 2.0)
+        self._raw = array('i', [int(self._mid)])
+        self._effects: Dict[int, _SoftCondition] = {}
+        self._periodic = _PeriodicBank()
+        self._pos = 0.0
+        self._vel = 0.0
+        self._acc = 0.0
+        self._t_prev = 0
+        self._out: Optional[ff_effect] = None     # 物理側 FF_CONSTANT
+        self._level = 0
+
+    def handles(self, t: int) -> bool:
+        return t in self.types
+
+    def owns(self, virt_id: int) -> bool:
+        return virt_id in self._effects or self._periodic.owns(virt_id)
+
+    # ---- FF サーバスレッド ----
+    def upload(self, virt_id: int, eff):
+        if not self.mixer.bind(virt_id, int(eff.type)):
+            return
+        if int(eff.type) == ecodes.FF_PERIODIC:
+            self._effects.pop(virt_id, None)
+            if not self._periodic.upload(virt_id, eff):
+                self.mixer.unbind(virt_id)
+                raise OSError(errno.ENOSPC, "soft periodic slots full")
+            return
+        self._periodic.erase(virt_id)
+        e = _SoftCondition(eff)
+        old = self._effects.get(virt_id)
+        if old is not None:
+            e.playing = old.playing      # 再生中のパラメータ更新
+        self._effects[virt_id] = e
+
+    def erase(self, virt_id: int):
+        self._effects.pop(virt_id, None)
+        self._periodic.erase(virt_id)
+        self.mixer.unbind(virt_id)
+
+    def play(self, virt_id: int, value: int):
+        e = self._effects.get(virt_id)
+        if e is not None:
+            e.playing = value > 0
+            if not e.playing:
+                self.mixer.write(virt_id, 0.0)
+        else:
+            self._periodic.play(virt_id, value, time.perf_counter_ns())
+
+    def tick(self, now_ns: int):
+        # 遅れたら追いつこうとせず今から 1 周期後（一定周期を優先）
+        nxt = self.next_ns + self.period_ns
+        self.next_ns = nxt if nxt > now_ns else now_ns + self.period_ns
+        pos = (self._raw[0] - self._mid) / self._half
+        if self._t_prev:
+            dt = (now_ns - self._t_prev) / 1e9
+            if dt > 0:
+                a = SOFT_FF_VEL_ALPHA
+                vel = self._vel + a * ((pos - self._pos) / dt - self._vel)
+                self._acc += a * ((vel - self._vel) / dt - self._acc)
+                self._vel = vel
+        self._pos, self._t_prev = pos, now_ns
+
+        # 各エフェクトは自分の mixer スロットへ寄与を書くだけ。合算/ゲイン/クリップは mixer
+        contrib = self.mixer.contrib
+        for vid, e in self._effects.items():
+            if not e.playing:
+                continue
+            t = e.type
+            if t == ecodes.FF_SPRING:
+                contrib[vid] = e.force(pos)
+            elif t == ecodes.FF_DAMPER:
+                contrib[vid] = e.force(self._vel / SOFT_FF_VEL_FULL)
+            elif t == ecodes.FF_FRICTION:
+                v = self._vel / SOFT_FF_FRICTION_V0
+                contrib[vid] = e.force(-1.0 if v < -1.0 else (1.0 if v > 1.0 else v))
+            elif t == ecodes.FF_INERTIA:
+                contrib[vid] = e.force(self._acc / SOFT_FF_ACC_FULL)
+        self._periodic.render(now_ns, self.mixer)
+        self._output(self.mixer.mix())
+
+    def _output(self, total: float):
+        level = _clamp_s16(int(total * self.sign * 0x7FFF))
+        if abs(level - self._level) < SOFT_FF_QUANTUM and (level != 0 or self._level == 0):
+            return
+        self._level = level
+        if self._out is None:
+            # 初回だけスロットを確保して再生開始（length=0 = 無期限）
+            eff = ff_effect()
+            eff.type = ecodes.FF_CONSTANT
+            eff.id = -1
+            eff.direction = 0x4000
+            eff.u.constant.level = level
+            self.backend.upload(eff)
+            self.backend.play(eff.id, 1)
+            self._out = eff
+            logging.info("[ff-soft] output FF_CONSTANT on physical id=%d", eff.id)
+            return
+        self._out.u.constant.level = level
+        self.backend.upload(self._out)
+
+    def close(self):
+        if self._out is None:
+            return
+        try:
+            self.backend.play(int(self._out.id), 0)
+            self.backend.erase(int(self._out.id))
+        except OSError as e:
+            logging.warning("[ff-soft] release output failed: %s", e)
+        self._out = None
+
+    # ---- 入力スレッド ----
+    def feed_pos(self, raw: int):
+        self._raw[0] = raw
+
+
 # --- ここで初めて sizeof を使う ---
 UP_SZ = sizeof(uinput_ff_upload)
 
@@ -2099,6 +3006,173 @@ def pack_ie(t, c, v):
 def write_input_event(fd, t, c, v):
     os.write(fd, pack_ie(t, c, v))
 
+# 出力差分キャッシュの「未送出」マーカー（ABS 値としては実質来ない s32 最小値）
+_OUT_UNSET = -0x80000000
+
+_SYN_REPORT_BYTES = None    # pack_ie(EV_SYN, SYN_REPORT, 0)（ecodes 読込後に確定）
+
+def pack_key_frame(keys, value: int) -> bytes:
+    """EV_KEY 群 + SYN_REPORT を 1 フレーム分まとめて pack（os.write 1 回で送る用）"""
+    global _SYN_REPORT_BYTES
+    if _SYN_REPORT_BYTES is None:
+        _SYN_REPORT_BYTES = pack_ie(ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+    return b"".join(pack_ie(ecodes.EV_KEY, k, value) for k in keys) + _SYN_REPORT_BYTES
+
+# ---- 仮想デバイス（uinput fd）への出力: 書き手は 1 人 ----
+_IE_STRUCT = struct.Struct(INPUT_EVENT_FMT)
+OUT_RING_EVENTS = 4096           # プロデューサ 1 つあたりのリング長（イベント数）
+
+
+class _OutRing:
+    """
+    プロデューサ 1 スレッド専用の SPSC リング（input_event を前確保の bytearray に直接 pack）。
+    push() で溜めて commit() で「ここまで 1 フレーム」と公開するので、書き手は常にフレーム単位で読む。
+    head/tail/wpos は単調増加のバイト数（空/満杯の区別が要らない）。tail は commit でだけ進む
+    """
+    __slots__ = ("writer", "name", "buf", "mv", "cap", "head", "tail", "wpos")
+
+    def __init__(self, writer: "UInputWriter", name: str, events: int = OUT_RING_EVENTS):
+        self.writer = writer
+        self.name = name
+        self.cap = events * _IE_STRUCT.size
+        self.buf = bytearray(self.cap)
+        self.mv = memoryview(self.buf)
+        self.head = 0        # 書き手が読んだ位置
+        self.tail = 0        # 公開済み（commit 済み）の終端
+        self.wpos = 0        # プロデューサの書き込み位置（未公開を含む）
+
+    def push(self, t: int, c: int, v: int):
+        w = self.wpos
+        if w + _IE_STRUCT.size - self.head > self.cap:
+            self.writer.wait_space(self, _IE_STRUCT.size)
+        _IE_STRUCT.pack_into(self.buf, w % self.cap, 0, 0, t, c, v)
+        self.wpos = w + _IE_STRUCT.size
+
+    def commit(self):
+        self.tail = self.wpos
+        self.writer.kick(self)
+
+    def take(self) -> Optional[bytes]:
+        """書き手側: 公開済みフレームをまとめて取り出す"""
+        h, t = self.head, self.tail
+        if h == t:
+            return None
+        a, b = h % self.cap, t % self.cap
+        data = bytes(self.mv[a:b]) if a < b else bytes(self.mv[a:]) + bytes(self.mv[:b])
+        self.head = t
+        return data
+
+
+class UInputWriter:
+    """
+    uinput fd の唯一の書き手。プロデューサ（入力中継ループ / 将来の FF 側など）は ring(name) で
+    自分専用のリングを貰い、フレーム単位で commit する。
+      mode="direct": commit したスレッドがその場でフレームを 1 回の write で出す（スレッド切替なし。既定）
+      mode="thread": 専用スレッドが eventfd で起こされ、全リングの公開済みフレームを 1 回の write にまとめて出す。
+                     フレームごとに eventfd_write + 起床が増えるので、書き手が複数いてまとめられる時だけ得になる
+    uinput の write は 1 回の呼び出しをデバイスロック内で処理するので、どちらでもフレームは割れない
+    """
+    def __init__(self, fd: int, mode: str = "direct", rt_cfg: Optional["RtConfig"] = None):
+        self.fd = fd
+        self.mode = mode
+        self.rings: List[_OutRing] = []
+        self.sleeping = False
+        self.flushes = 0
+        self._stop = False
+        self._efd = -1
+        self._thr: Optional[threading.Thread] = None
+        if mode == "thread":
+            self._efd = os.eventfd(0, os.EFD_CLOEXEC)
+            self._rt_cfg = rt_cfg
+            self._thr = threading.Thread(target=self._run, name="uinput-writer", daemon=True)
+            self._thr.start()
+
+    def ring(self, name: str) -> _OutRing:
+        r = _OutRing(self, name)
+        self.rings = self.rings + [r]      # 書き手スレッドはリストを読むだけ（差し替えで追加）
+        return r
+
+    def kick(self, ring: _OutRing):
+        if self._efd < 0:
+            data = ring.take()
+            if data:
+                os.write(self.fd, data)
+                self.flushes += 1
+        elif self.sleeping:
+            os.eventfd_write(self._efd, 1)
+
+    def wait_space(self, ring: _OutRing, need: int):
+        # リング満杯: 書き手に吐かせて空くのを待つ（通常は起きない）
+        logging.warning("[out] ring %s full; waiting for writer", ring.name)
+        while ring.wpos + need - ring.head > ring.cap:
+            if self._efd < 0 or self._stop:
+                ring.tail = ring.wpos = ring.head   # 書き手がいない: 未公開分ごと捨てる
+                return
+            os.eventfd_write(self._efd, 1)
+            time.sleep(0)
+
+    def _flush(self) -> bool:
+        chunks = [d for d in map(_OutRing.take, self.rings) if d]
+        if not chunks:
+            return False
+        try:
+            os.write(self.fd, chunks[0] if len(chunks) == 1 else b"".join(chunks))
+        except OSError as e:
+            logging.error("[out] uinput write failed: %s", e)
+        self.flushes += 1
+        return True
+
+    def _run(self):
+        rt_enter_thread(self._rt_cfg, "input")
+        efd = self._efd
+        while not self._stop:
+            while self._flush():
+                pass
+            # 寝る前にもう一度見る（sleeping を立てた後の commit は必ず kick される）
+            self.sleeping = True
+            if any(r.head != r.tail for r in self.rings):
+                self.sleeping = False
+                continue
+            try:
+                os.eventfd_read(efd)
+            except OSError:
+                break
+            self.sleeping = False
+        self._flush()
+
+    def close(self):
+        if self._thr is not None:
+            self._stop = True
+            os.eventfd_write(self._efd, 1)
+            self._thr.join(timeout=1.0)
+            os.close(self._efd)
+            self._thr = None
+            self._efd = -1
+        else:
+            self._flush()
+
+
+def open_raw_uinput_keyboard(name: str, key_codes, vid: int, pid: int, version: int = 0x0100) -> int:
+    """
+    /dev/uinput を直接 ioctl してキーボード（EV_KEY のみ）を作る。UInputFFDevice と同じ手順。
+    戻り: 書き込み用 fd（close 時は UI_DEV_DESTROY → os.close）
+    """
+    fd = os.open("/dev/uinput", os.O_WRONLY | os.O_NONBLOCK)
+    try:
+        fcntl.ioctl(fd, UI_SET_EVBIT, ecodes.EV_KEY)
+        for code in sorted(set(int(c) for c in key_codes)):
+            fcntl.ioctl(fd, UI_SET_KEYBIT, code)
+        us = uinput_setup()
+        us.id = input_id(bustype=0x03, vendor=vid, product=pid, version=version)
+        us.name = name.encode("utf-8")[:79]
+        us.ff_effects_max = 0
+        fcntl.ioctl(fd, UI_DEV_SETUP, us)
+        fcntl.ioctl(fd, UI_DEV_CREATE)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
 
 import os, fcntl, errno, struct, threading, time, logging
 from evdev import ecodes
@@ -2217,6 +3291,33 @@ def _u32_le(x: int) -> bytes:
 
 import threading, time, errno
 
+FF_SCHED_IDLE_SEC = 2.0          # 再生が終わってから物理スロットを消すまでの猶予（すぐ再生し直す effect の再アップロード避け）
+FF_SCHED_FOREVER = 1 << 62       # replay.length=0（停止まで続く）の終了時刻
+
+
+class _FfPlayback:
+    """
+    ゲームがアップロードした effect 1 個分の再生状態（FF サーバスレッド専用）。
+    eff は物理へ送れる形に整えた ff_effect のコピー。物理に載っているかは ff_mapper のマップで見る
+    """
+    __slots__ = ("eff", "key", "dirty", "end_ns", "idle_ns")
+
+    def __init__(self, eff):
+        self.eff = eff
+        self.key = b""           # 内容アドレス（id=0 にした eff のバイト列）
+        self.dirty = True        # 物理側の内容が古い（次の再生前に送り直す）
+        self.end_ns = -1         # 再生の終了予定（-1 = 停止中）
+        self.idle_ns = 0         # 再生が終わった時刻（物理スロットを消す判定用）
+
+    def start(self, count: int, now_ns: int):
+        r = self.eff.replay
+        if r.length == 0:
+            self.end_ns = FF_SCHED_FOREVER
+        else:
+            # 1 回 = delay + length。count 回繰り返す（ff-memless と同じ数え方）
+            self.end_ns = now_ns + count * (int(r.delay) + int(r.length)) * 1_000_000
+
+
 class UInputFFDevice:
     def __init__(self, ui_caps, name: str, vid: int=None, pid: int=None, version: int=0x0100, ff_effects_max=64, enqueue_cb=None, ui_base_fd=None, ui_base_path=None, loop=None, phys_dev=None, phys_event_path=None,ff_mapper=None,us=None, **kwargs):
         logging.debug("[FFB] UInputFFDevice : __init__")
@@ -2227,8 +3328,6 @@ class UInputFFDevice:
          phys_dev:         evdev.InputDevice（物理ホイール）。あればこれを優先
          phys_event_path:  物理ホイールの /dev/input/eventX（phys_dev が無い時に使う）
         """
-        self._last_const_key = None
-        self._last_const_ts = None
         self.ui_caps = ui_caps
         
         self.ui_base_fd = ui_base_fd
@@ -2247,6 +3346,29 @@ class UInputFFDevice:
         self._last_ff_end_ts = 0.0
         self._min_ff_gap_sec = 0.002  # 2ms 程度の最小間隔（必要なら 0.0 に）
         self._last_seen_req = (-1, -1)  # (request_id, effect.type)
+
+        # 制御ソケットから変えられる FF 側の設定（FF サーバスレッドが _ctl_q 経由で書き換える）
+        self._ctl_q: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._loop_wait_sec = LoopWait_sec
+        self.ff_ignored: frozenset = frozenset()   # 物理へ送らず成功扱いにする effect type
+        self.ff_gain_pct = -1.0                    # 未設定 = -1
+        self.ff_autocenter_pct = -1.0
+        self.soft_ff: Optional[SoftFFEngine] = None  # --ff-soft（UnderSteer が後から attach_soft_ff）
+        self._ff_upload_tab: list = [None] * FF_MIX_NTYPES   # type - FF_RUMBLE -> (prep, uploader)
+        # 再生スケジューラ: 物理に載せるのは再生中の effect だけ（停止中は保持のみ、終わったら猶予後に消す）
+        self._ff_sched: Dict[int, _FfPlayback] = {}   # virt_id -> 再生状態
+        self._ff_active: Dict[int, _FfPlayback] = {}  # 再生中だけ
+        self._ff_idle: Dict[int, _FfPlayback] = {}    # 再生が終わって物理スロットが残っているもの
+        self._ev_size = struct.calcsize(INPUT_EVENT_FMT)
+
+        # --- 出力側の差分キャッシュ（仮想コードで直接引く配列） ---
+        # 直近に送出した値と同じ write は捨て、フレーム内に実イベントが無ければ SYN も出さない
+        self._last_key = array('b', [-1]) * (E.KEY_MAX + 1)        # code -> 0/1/2, 未送出=-1
+        self._last_abs = array('i', [_OUT_UNSET]) * (E.ABS_MAX + 1) # code -> value
+        self._frame_dirty = False
+        # 直近にアップロードされた FF（--shm 用）。レベルは type - FF_RUMBLE で引く
+        self.ff_last_type = -1
+        self.ff_last_level = array('i', [0]) * SHM_NLEVELS
         
         # --- 物理FDの確保 ---
         if phys_dev is not None and hasattr(phys_dev, "fd"):
@@ -2259,9 +3381,10 @@ class UInputFFDevice:
         else:
              raise RuntimeError("UInputFFDevice: no physical device given (phys_dev or phys_event_path required)")
         self.ff_mapper.phys_fd = self.phys_fd
+        if self.ff_mapper.backend is None:
+            self.ff_mapper.backend = EvdevFFBackend(self.phys_fd)
+        self.ff_backend = self.ff_mapper.backend
         
-        self._effect_types = {}       # effect_id -> ecodes.FF_*
-        self._effects      = {}       # effect_id -> 最新の ff_effect（必要なら）
         self._ff_lock      = threading.Lock()
         self.ff_worker_stop = threading.Event()
         
@@ -2283,6 +3406,7 @@ class UInputFFDevice:
         # R) FF コールバックは “poll” の専用スレッドで待機
         logging.info(f"</dev/uinput>: FF request server start")
         self._ff_srv_stop = threading.Event()
+        self.created = threading.Event()        # UI_DEV_CREATE 済み（FF サーバスレッドはこれを待ってから回る）
         self._ff_srv_thr = threading.Thread(
             target=self._ff_request_server_loop, name="uinput-ff-server", daemon=True
         )
@@ -2352,6 +3476,7 @@ class UInputFFDevice:
                     self._setbit(UI_SET_FFBIT, int(ff))
                 except OSError:
                     pass
+        self._build_ff_upload_table()
         #logging.debug("UI_SET_FFBIT Set OK")
 
         # 既存の /dev/input/event* をスナップショット
@@ -2374,7 +3499,11 @@ class UInputFFDevice:
         # 6)
         fcntl.ioctl(self.ui_base_fd, UI_DEV_CREATE)
         logging.debug("UI_DEV_CREATE  OK")
-        CREATED_UI = True
+        # 入力フレームの書き手（--out-writer）。入力中継ループはリング "input" にだけ書く
+        self.writer = UInputWriter(self.ui_base_fd, getattr(getattr(self.us, "args", None), "out_writer", "direct"),
+                                   getattr(self.us, "rt_cfg", None))
+        self._out = self.writer.ring("input")
+        self.created.set()
         
         """
         作成後に能⼒を弄ると udev->state == UIST_CREATED で EINVAL になります。
@@ -2458,7 +3587,7 @@ class UInputFFDevice:
         except Exception: pass
         try:
             # 2) EVIOCRMFFで known phys_id を片っ端から削除（タイムアウト付き）
-            self.ff_mapper.erase_all_phys_slots(self.phys_fd, timeout_sec=0.5)
+            self.ff_mapper.erase_all_phys_slots(timeout_sec=0.5)
         except Exception: pass
 
     def _clear_physical_slots(self, max_id=64, timeout_per_id=0.25):
@@ -2475,10 +3604,10 @@ class UInputFFDevice:
 
         ok = skip = fail = 0
         # 1) マッピングされたIDを優先して潰す
-        for virt_id, phys_id in list(self.ff_mapper._virt2phys.items()):
+        for phys_id in list(self.ff_mapper._phys_refs):
             #logging.debug("Try now..")
             try:
-                _ioctl_with_timeout(self.phys_fd, EVIOCRMFF, struct.pack('i', int(phys_id)), timeout_sec=timeout_per_id)
+                self.ff_backend.erase(phys_id, timeout_sec=timeout_per_id)
                 ok += 1
                 #logging.debug("[ff物理] ERASE map virt=%d phys=%d OK (%d Try)", virt_id, phys_id, cnt)
                 # マップ掃除（同じ仮想IDが再利用される可能性もあるため、一応消す）
@@ -2495,13 +3624,22 @@ class UInputFFDevice:
                 #logging.debug("[ff物理] ERASE map virt=%d phys=%d fail: %s", virt_id, phys_id, e)
                 fail += 1
         logging.debug(f"[ff物理] ERASE map: (ok {ok} / skip {skip} / fail {fail})")
-        self.ff_mapper._virt2phys.clear()
-        logging.debug(f"_virt2phys.clear")
+        self.ff_mapper.clear()
+        logging.debug(f"ff_mapper.clear")
 
 
     def _ff_request_server_loop(self):
         import select
         self._make_uinput_nonblock()   # 既に open 済みでも後付けで nonblock にできる
+        while not self.created.wait(0.1):
+            if self._ff_srv_stop.is_set():
+                return
+        us_args = getattr(self.us, "args", None)
+        rt_cfg = getattr(self.us, "rt_cfg", None)
+        rt_enter_thread(rt_cfg, "ff")
+        h_loop = (latency_histogram("ff.loop")
+                  if (rt_cfg or getattr(us_args, "verbose", 0) or getattr(us_args, "shm", None)) else None)
+        lap_prev = 0
 
         p = select.poll()
         p.register(self.ui_base_fd, select.POLLIN | select.POLLERR | select.POLLHUP)
@@ -2516,8 +3654,23 @@ class UInputFFDevice:
 
         print(f"[LoopStart(U/FFB-Pys] <poll wait> {get_path_from_fd(self.ui_base_fd)} >>> Pys-Wheel")
         #logging.debug(f"LoopWait_ms: {LoopWait_ms}")
+        ctl_q = self._ctl_q
+        wait = self._loop_wait_sec
         while not self._ff_srv_stop.is_set():
             t0 = time.perf_counter_ns()
+            if h_loop is not None:
+                # 1 周が wait（LoopWait_sec、制御ソケットで変更可）からどれだけ遅れたか（= スケジューリング/処理のジッタ）
+                if lap_prev:
+                    h_loop.record_ns(t0 - lap_prev - int(wait * 1e9))
+                lap_prev = t0
+            # 制御ソケットからの変更はこのスレッドで適用（FF 側の設定の書き手はここだけ。読む側はロック不要）
+            while not ctl_q.empty():
+                fn = ctl_q.get_nowait()
+                try:
+                    fn()
+                except Exception as e:
+                    logging.warning("[ctl] apply failed: %s", e)
+            wait = self._loop_wait_sec
             #evs = p.poll(LoopWait_ms)
             dt_ms = (time.perf_counter_ns() - t0) / 1e6
 
@@ -2528,7 +3681,7 @@ class UInputFFDevice:
             while True:
                 # Read Next
                 kind, obj = self._try_begin_ff() # ここで読んでる！
-                #time.sleep(LoopWait_sec / 100) #fcntl.ioctl の後、必要
+                #time.sleep(wait / 100) #fcntl.ioctl の後、必要
                 if kind is None:
                     break
 
@@ -2560,22 +3713,22 @@ class UInputFFDevice:
                                     # 実処理（物理側へ EVIOCSFF 等）
                                     self._handle_ff_upload(up)  # up.retval は内部で設定
                                 except Exception as e:
-                                    up.retval = -getattr(e, "errno", errno.EIO)
-                                    logging.error("UPLOAD handling error errno=%s", getattr(e, "errno", "??"))
-                                    os.exit(1)
+                                    # ここで落ちると END_FF_UPLOAD が呼ばれずゲームの EVIOCSFF が戻らない
+                                    up.retval = -(getattr(e, "errno", None) or errno.EIO)
+                                    logging.exception("UPLOAD handling error errno=%s", getattr(e, "errno", "??"))
                                 #finally:
                                 #    self._last_seen_req = (req_id, eff_t)
 
                             # --- END は必ず対で呼ぶ ---
                             try:
-                                time.sleep(LoopWait_sec / 10) #fcntl.ioctl の前にも必要っぽい気がする
+                                time.sleep(wait / 10) #fcntl.ioctl の前にも必要っぽい気がする
                                 fcntl.ioctl(self.ui_base_fd, UI_END_FF_UPLOAD, up, True)
-                                time.sleep(LoopWait_sec / 100) #fcntl.ioctl の後、必要
+                                time.sleep(wait / 100) #fcntl.ioctl の後、必要
                                 logging.debug(f"Pys / UI_END_FF_UPLOAD: type={FfEvioMapper._ff_type_name(eff_t)} req_id={req_id}")
                             except OSError as e:
                                 # EINVAL(22) 等は握り潰して継続（レース/二重END許容）
                                 logging.warning("UI_END_FF_UPLOAD failed: %r ; continue", e)
-                                time.sleep(LoopWait_sec / 100) #fcntl.ioctl の後、必要
+                                time.sleep(wait / 100) #fcntl.ioctl の後、必要
                             self._last_ff_end_ts = time.monotonic()
                         finally:
                             # 通常パスで END 済みならフォールバック不要
@@ -2592,33 +3745,221 @@ class UInputFFDevice:
                         try:
                             try:
                                 self._handle_ff_erase(er)  # 中で物理 id 解放など
-                                #time.sleep(LoopWait_sec / 100) #fcntl.ioctl の後、必要
+                                #time.sleep(wait / 100) #fcntl.ioctl の後、必要
                                 er.retval = 0
                             except Exception as e:
                                 er.retval = -getattr(e, "errno", errno.EIO)
                             try:
-                                time.sleep(LoopWait_sec / 10) #fcntl.ioctl の前にも必要っぽい気がする
+                                time.sleep(wait / 10) #fcntl.ioctl の前にも必要っぽい気がする
                                 fcntl.ioctl(self.ui_base_fd, UI_END_FF_ERASE, er, True)
-                                time.sleep(LoopWait_sec / 100) #fcntl.ioctl の後、必要
+                                time.sleep(wait / 100) #fcntl.ioctl の後、必要
                                 logging.debug(f"Pys / UI_END_FF_ERASE: type={FfEvioMapper._ff_type_name(er.effect_id)} req_id={er.request_id}")
                             except OSError as e:
                                 logging.error("Can not UI_END_FF_ERASE: %r (continue)", e)
-                                os.exit(1)
                         finally:
                             # 通常パスで END 済みならフォールバック不要
                             pass
                     drained += 1
 
+            # ゲームからの再生/停止・ゲイン（仮想 event へ書かれた EV_FF）を読んで物理/ソフト側へ
+            self._drain_ff_events()
+            if self._ff_active or self._ff_idle:
+                self._ff_sched_tick(t0)
+            soft = self.soft_ff
+            if soft is not None and t0 >= soft.next_ns:
+                soft.tick(t0)
+
             # LoopEnd: UP,ER どっちも終わったらここに来る。
-            # ドレイン有無に関わらず最後に 1 回だけ SYN
+            # FF スレッドは入力フレームを出さない（SYN は実イベントを書いた出力側だけが打つ: ui.syn()）
             if drained:
                 logging.warning("[Psy Poll] drained %d FF requests", drained)
-            # 初期化直後は無いのでIF文
-            if CREATED_UI:
-                #print(get_path_from_fd(self.ui_base_fd))
-                write_input_event(self.ui_base_fd, E.EV_SYN, E.SYN_REPORT, 0)
-            time.sleep(LoopWait_sec) # Loop Wait 4ms
+            time.sleep(wait) # Loop Wait 4ms
         # LoopEnd: ドライバ終了のタイミングでここ
+        if self.soft_ff is not None:
+            self.soft_ff.close()
+
+    def _drain_ff_events(self):
+        """
+        uinput fd に溜まった input_event を読み切る。
+        EV_FF: code=FF_GAIN/FF_AUTOCENTER はそのまま物理へ、それ以外は effect id の再生(value>0)/停止(0)。
+        EV_UINPUT（アップロード/消去の通知）は _try_begin_ff 側で処理済みなので読み捨てる
+        """
+        sz = self._ev_size
+        while True:
+            try:
+                buf = os.read(self.ui_base_fd, sz * 64)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.debug("uinput read: %s", e)
+                return
+            if not buf:
+                return
+            for _sec, _usec, t, code, value in struct.iter_unpack(INPUT_EVENT_FMT, buf[:len(buf) - len(buf) % sz]):
+                if t == E.EV_FF:
+                    self._on_ff_event(code, value)
+
+    def _on_ff_event(self, code: int, value: int):
+        # バックエンドの書き込み失敗でスレッドごと落とさない（このイベントだけ捨てる）
+        try:
+            if code == E.FF_GAIN or code == E.FF_AUTOCENTER:
+                self.ff_backend.set_level(code, value)
+                pct = value * 100.0 / 0xFFFF
+                if code == E.FF_GAIN:
+                    self.ff_gain_pct = pct
+                else:
+                    self.ff_autocenter_pct = pct
+                return
+            soft = self.soft_ff
+            if soft is not None and soft.owns(code):
+                soft.play(code, value)
+                return
+            self._ff_sched_play(code, value)
+        except OSError as e:
+            logging.error("[FFB-Pys] EV_FF code=%d value=%d dropped: %s", code, value, e)
+
+    # ---- 再生スケジューラ（FF サーバスレッドからのみ呼ぶ） ----
+    def _ff_sched_upload(self, virt_id: int, eff) -> int:
+        """
+        ゲームからのアップロード。再生中なら即物理へ送り phys_id を返す。
+        停止中は内容を保持するだけで -1（次の再生時にアップロードする）
+        """
+        pb = self._ff_sched.get(virt_id)
+        saved = ff_effect.from_buffer_copy(eff)
+        saved.id = 0
+        if pb is None:
+            pb = self._ff_sched[virt_id] = _FfPlayback(saved)
+        else:
+            pb.eff = saved
+        pb.key = bytes(saved)
+        pb.dirty = True
+        if pb.end_ns < 0:
+            return -1
+        return self._ff_phys_commit(virt_id, pb)
+
+    def _ff_sched_handoff(self, pb: _FfPlayback, old_phys: int, new_phys: int):
+        """
+        再生中の effect が別の物理スロットへ移った（共有へ合流 / 共有から分離 / ENOSPC で載せ直し）。
+        新しいスロットを残り回数で再生し、古いスロットは他に再生中の別名が無ければ止める
+        """
+        mapper = self.ff_mapper
+        now = time.perf_counter_ns()
+        r = pb.eff.replay
+        if pb.end_ns == FF_SCHED_FOREVER or r.length == 0:
+            count = 1
+        else:
+            per_ns = (int(r.delay) + int(r.length)) * 1_000_000
+            count = max(1, -(-(pb.end_ns - now) // per_ns))
+        self.ff_backend.play(new_phys, count)
+        pb.start(count, now)
+        if old_phys != new_phys and old_phys in mapper._phys_refs:
+            if not any(mapper._virt2phys.get(v) == old_phys for v in self._ff_active):
+                self.ff_backend.play(old_phys, 0)
+
+    def _ff_phys_commit(self, virt_id: int, pb: _FfPlayback) -> int:
+        """
+        pb.eff を物理へ（既に載っていれば同じ phys_id を更新）。ENOSPC なら再生中以外を追い出して 1 回だけ再試行。
+        同じ中身が別の virt_id で既に載っていれば、アップロードせずそのスロットを共有する（参照カウント）
+        """
+        mapper = self.ff_mapper
+        phys_id = old_phys = mapper._virt2phys.get(virt_id)
+        key = pb.key
+        shared = mapper.lookup_key(key)
+        if shared is not None:
+            if shared != phys_id:
+                if phys_id is not None:
+                    self._release_phys_slot(virt_id, keep_effect=True)
+                mapper.remember(virt_id, shared)
+                logging.debug("[FFB-Pys] virt=%d shares phys=%d (refs=%d)", virt_id, shared, mapper._phys_refs[shared])
+                if virt_id in self._ff_active:
+                    self._ff_sched_handoff(pb, old_phys, shared)
+            mapper.touch(shared)
+            pb.dirty = False
+            return shared
+        if phys_id is not None and mapper._phys_refs.get(phys_id, 1) > 1:
+            # 共有中のスロットは書き換えられない: この virt だけ外して新しく載せる
+            mapper.unmap_virt(virt_id)
+            phys_id = None
+        eff = pb.eff
+        eff.id = -1 if phys_id is None else phys_id
+        try:
+            new_phys_id = mapper.backend.upload(eff)
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            keep = {mapper._virt2phys[v] for v in self._ff_active if v in mapper._virt2phys}
+            freed = mapper._evict_some_phys_slots(limit=4, keep=keep)
+            logging.warning("ENOSPC: freed <%d> slots, retrying alloc", freed)
+            for v in list(self._ff_idle):
+                if v not in mapper._virt2phys:
+                    del self._ff_idle[v]
+            # 新しいスロットへ載せ直すので、まだ残っている古い割当は外しておく（参照カウントが漏れる）
+            self._release_phys_slot(virt_id, keep_effect=True)
+            phys_id = None
+            eff.id = -1
+            try:
+                new_phys_id = mapper.backend.upload(eff)
+            except OSError as e2:
+                # 追い出しても空かない（全部再生中）。この effect は物理に載っていないので再生中扱いからも外し、
+                # 呼び出し側（_handle_ff_upload）が -ENOSPC を retval でゲームへ返す
+                eff.id = 0
+                if self._ff_active.pop(virt_id, None) is not None:
+                    pb.end_ns = -1
+                logging.error("[FFB-Pys] still no physical slot after eviction virt=%d: %s", virt_id, e2)
+                raise OSError(errno.ENOSPC, "no free physical FF slot") from e2
+        eff.id = 0
+        mapper.remember(virt_id, new_phys_id, key)
+        mapper.touch(new_phys_id)
+        pb.dirty = False
+        if phys_id is None and old_phys is not None and virt_id in self._ff_active:
+            self._ff_sched_handoff(pb, old_phys, new_phys_id)
+        return new_phys_id
+
+    def _ff_sched_play(self, virt_id: int, value: int):
+        pb = self._ff_sched.get(virt_id)
+        if pb is None:
+            return
+        now = time.perf_counter_ns()
+        mapper = self.ff_mapper
+        if value <= 0:
+            pb.end_ns = -1
+            if self._ff_active.pop(virt_id, None) is not None:
+                phys_id = mapper._virt2phys.get(virt_id)
+                if phys_id is not None:
+                    # 同じスロットを共有する別の virt がまだ再生中なら物理は止めない
+                    if not any(mapper._virt2phys.get(v) == phys_id for v in self._ff_active):
+                        self.ff_backend.play(phys_id, 0)
+                    pb.idle_ns = now
+                    self._ff_idle[virt_id] = pb
+            return
+        if pb.dirty or virt_id not in mapper._virt2phys:
+            try:
+                self._ff_phys_commit(virt_id, pb)
+            except OSError as e:
+                logging.error("[FFB-Pys] upload on play failed virt=%d type=%s: %s",
+                              virt_id, FfEvioMapper._ff_type_name(pb.eff.type), e)
+                return
+        phys_id = mapper._virt2phys[virt_id]
+        self.ff_backend.play(phys_id, value)
+        mapper.touch(phys_id)
+        pb.start(value, now)
+        self._ff_idle.pop(virt_id, None)
+        self._ff_active[virt_id] = pb
+
+    def _ff_sched_tick(self, now_ns: int):
+        """再生が終わったものを idle へ、idle のまま FF_SCHED_IDLE_SEC 経ったものは物理スロットを消す"""
+        for virt_id, pb in list(self._ff_active.items()):
+            if now_ns >= pb.end_ns:
+                pb.end_ns = -1
+                pb.idle_ns = now_ns
+                del self._ff_active[virt_id]
+                self._ff_idle[virt_id] = pb
+        if self._ff_idle:
+            limit = now_ns - int(FF_SCHED_IDLE_SEC * 1e9)
+            for virt_id, pb in list(self._ff_idle.items()):
+                if pb.idle_ns <= limit:
+                    del self._ff_idle[virt_id]
+                    self._release_phys_slot(virt_id, keep_effect=True)
 
     import os, fcntl, select, errno, logging
 
@@ -2663,305 +4004,127 @@ class UInputFFDevice:
     def _handle_ff_erase(self, er: "uinput_ff_erase"):
         virt_id = int(er.effect_id)
         logging.debug("Pys / BEGIN_ERASE req=%d virt_id=%d", int(er.request_id), virt_id)
-        
-        if True:
-            phys_id = self.ff_mapper._virt2phys.pop(virt_id, -1)
-            if phys_id >= 0:
-                try:
-                    fcntl.ioctl(self.phys_fd, EVIOCRMFF, phys_id, False)
-                    #time.sleep(LoopWait_sec)
-                    logging.warning(f"[FFB-Pys(Hdl)] EVIOCRMFF to physical: id={phys_id}")
-                except OSError as e:
-                    logging.error(f"[FFB-Pys(Hdl)] EVIOCRMFF failed id={phys_id}: {e}")
-                self._phys_meta.pop(phys_id, None)
+        if self.soft_ff is not None:
+            self.soft_ff.erase(virt_id)
+        self._release_phys_slot(virt_id)
         er.retval = 0
 
+    def _release_phys_slot(self, virt_id: int, keep_effect: bool = False):
+        """物理スロットを消す。keep_effect=False なら再生スケジューラからも外す（ゲーム側で消えた/物理へ送らない）"""
+        was_active = False
+        if not keep_effect:
+            self._ff_sched.pop(virt_id, None)
+            was_active = self._ff_active.pop(virt_id, None) is not None
+            self._ff_idle.pop(virt_id, None)
+        mapper = self.ff_mapper
+        shared = mapper._virt2phys.get(virt_id)
+        phys_id = mapper.unmap_virt(virt_id)   # まだ別の virt が共有していれば -1
+        if phys_id < 0 and was_active and shared is not None:
+            # 共有スロットは残るが、再生していたのがこの virt だけなら止める
+            if not any(mapper._virt2phys.get(v) == shared for v in self._ff_active):
+                self.ff_backend.play(shared, 0)
+        if phys_id >= 0:
+            try:
+                self.ff_backend.erase(phys_id)
+                logging.warning(f"[FFB-Pys(Hdl)] erase physical: id={phys_id}")
+            except OSError as e:
+                logging.error(f"[FFB-Pys(Hdl)] erase failed id={phys_id}: {e}")
+            self._phys_meta.pop(phys_id, None)
+
+    # ---- 制御ソケット（FF 側）: 変更は FF サーバスレッドのキューへ積むだけ ----
+    def post_ff_control(self, fn):
+        self._ctl_q.put(fn)
+
+    def set_ff_level(self, code: int, percent: float):
+        """FF_GAIN / FF_AUTOCENTER を物理ホイールへ（FF サーバスレッドから呼ぶ）"""
+        v = int(max(0.0, min(100.0, percent)) / 100.0 * 0xFFFF)
+        self.ff_backend.set_level(code, v)
+        if code == E.FF_GAIN:
+            self.ff_gain_pct = float(percent)
+        else:
+            self.ff_autocenter_pct = float(percent)
+        logging.info("[ctl] %s = %.1f%% (%d)", "gain" if code == E.FF_GAIN else "autocenter", percent, v)
 
-    def _effect_key_for_compare(self, eff: ff_effect) -> bytes:
-        
-        ret = [
-            eff.type,
-            eff.direction,
-            eff.trigger.button,
-            eff.trigger.interval,
-            eff.replay.length,
-            eff.replay.delay,
-        ]
-        
-        return ret
-
-    # 直近キーと時刻で coalesce
-    def _coalesce_and_maybe_skip_constant(self, upEff):
-        # test ...
-        #return False  # スキップ不可（処理する）
-        
-        if upEff.type != ecodes.FF_CONSTANT:
-            return False  # スキップ不可（処理する）
-
-        key = self._effect_key_for_compare(upEff)
-        now = time.monotonic()
-
-        # 変更なし
-        if key == self._last_const_key:
-            return True
 
-        # 更新
-        self._last_const_key = key
-        self._last_const_ts = now
-        return False
+    def _build_ff_upload_table(self):
+        """
+        type -> (prep, uploader) の表を作る（FF_RUMBLE 起点の配列、公開していない type は None）。
+        uploader はソフト合成する type なら SoftFFEngine、それ以外は再生スケジューラ→物理
+        """
+        tab = [None] * FF_MIX_NTYPES
+        soft = self.soft_ff
+        phys_types = getattr(getattr(self, "ff_backend", None), "types", None)
+        for t, prep in FF_UPLOAD_PREP.items():
+            if t not in self.ffbDic:
+                continue
+            if soft is not None and soft.handles(t):
+                tab[t - E.FF_RUMBLE] = (None, self._ff_upload_soft)
+            elif phys_types is None or t in phys_types:
+                tab[t - E.FF_RUMBLE] = (prep, self._ff_sched_upload)
+            # バックエンドが送れない type は None のまま（アップロードは -EINVAL で返す）
+        self._ff_upload_tab = tab    # 参照の差し替えだけなので FF スレッドとはロック不要
+
+    def attach_soft_ff(self, soft: "SoftFFEngine"):
+        self.soft_ff = soft
+        self._build_ff_upload_table()
+
+    def _ff_upload_soft(self, virt_id: int, eff) -> int:
+        # ソフト合成: 物理スロットは使わない（id は仮想側のまま返す）
+        self._release_phys_slot(virt_id)
+        self.soft_ff.upload(virt_id, eff)
+        return -1
 
     def _handle_ff_upload(self, up: "uinput_ff_upload"):
         virt_id = int(up.effect.id)  # uinput から来た仮想ID（更新キー）
         eff = up.effect               # ctypes 構造体
-
-        #if self._coalesce_and_maybe_skip_constant(up):
-        #    return  # UI_END_FF_UPLOAD 側で up.retval を見て完了させる
-
-        # --- 構造体全体をダンプ ---
-        #detail = dump_ctypes_struct(up.effect)
-        #logging.debug(f"[FFB-Pys(_handle_ff_upload)] effect DUMP:\n{detail}")
-
+        t = int(eff.type)
         if self.us.ff_passthrough_easy:
-            if int(eff.type) == ecodes.FF_GAIN:
-                logging.error("Gain xxxxxxxxxxxxxxxxxxxx")
-            if int(eff.type) == ecodes.FF_AUTOCENTER:
-                logging.error("AUTOCENTER xxxxxxxxxxxxxx")
-            # 明確に不対応
+            # FF_GAIN / FF_AUTOCENTER しか公開していないので effect のアップロードは不対応
             up.retval = -errno.EINVAL
             return
-        
-        t = int(eff.type)
-        if t not in self.ffbDic:
+
+        ti = t - E.FF_RUMBLE
+        h = self._ff_upload_tab[ti] if 0 <= ti < FF_MIX_NTYPES else None
+        if h is None:
             # 明確に不対応
             logging.error(f"明確に不対応 : type={t}")
             up.retval = -errno.EINVAL
             return
-        
-        # 1) 仮想→物理の既存割当を探す
-        phys_id = self.ff_mapper._virt2phys.get(virt_id, None)
-        if phys_id is not None:
-            eff.id = phys_id
-            is_update = True
-        else:
-            eff.id = -1
-            is_update = False
-        
-        # 代わりに別名の作業変数を用意（ログ用）
-        prev_phys_id = phys_id
-        new_phys_id  = -1
-        
-        # BEGIN 直後
-        logging.debug("Pys / BEGIN_UPLOAD req=%d type=%d id(virt?)=%d len=%d delay=%d",
-                      up.request_id, int(up.effect.type), int(up.effect.id),
-                      int(up.effect.replay.length), int(up.effect.replay.delay))
-        logging.debug("Pys / BEGIN_UPLOAD req=%u type=%u vID=%d (ff.id before=%d)",
-              int(up.request_id), int(eff.type), int(virt_id), int(eff.id))
-        try:
-            #logging.debug(f"[FFB-Pys(UP)] _handle_ff_upload: effect={FfEvioMapper._ff_type_name(eff.type)}")
-            if int(eff.type) == ecodes.FF_CONSTANT:
-                logging.debug(f"[FFB-Pys(UP)] effect= {FfEvioMapper._ff_type_name(eff.type)} ")
-                self._effect_types[int(eff.id)] = ecodes.FF_CONSTANT
-                
-                # 共通処理ここから
-                new_phys_id = self.ff_mapper.upload_ff_effect_via_eviocsff(self.phys_fd, eff)
-                # 3) マップ更新（virt→phys, phys→virt）
-                self.ff_mapper._virt2phys[virt_id] = new_phys_id
-                self.ff_mapper._phys2virt[new_phys_id] = virt_id
-                logging.debug(f"[FFB-Pys(UP)] {FfEvioMapper._ff_type_name(eff.type)} to physical: id={new_phys_id}")
-                up.effect.id = int(virt_id)
-                up.retval = 0
-                # 共通処理ここまで
-
-            elif int(eff.type) == ecodes.FF_SPRING:
-                logging.debug(f"[FFB-Pys(UP)] effect= {FfEvioMapper._ff_type_name(eff.type)} ")
-                self._effect_types[int(eff.id)] = ecodes.FF_SPRING
-                
-                # FF_SPRING , FF_DAMPER の場合 safe_eff 利用
-                # ユニオンに入ってきたものを “安全に 2 軸初期化済み condition[2]” に組み直す
-                safe_eff = _build_condition_pair_from_generic(t, eff)
-                eff = safe_eff
-                
-                # 共通処理ここから
-                new_phys_id = self.ff_mapper.upload_ff_effect_via_eviocsff(self.phys_fd, eff)
-                # 3) マップ更新（virt→phys, phys→virt）
-                self.ff_mapper._virt2phys[virt_id] = new_phys_id
-                self.ff_mapper._phys2virt[new_phys_id] = virt_id
-                logging.debug(f"[FFB-Pys(UP)] {FfEvioMapper._ff_type_name(eff.type)} to physical: id={new_phys_id}")
-                up.effect.id = int(virt_id)
-                up.retval = 0
-                # 共通処理ここまで
-
-            elif int(eff.type) == ecodes.FF_DAMPER:
-                logging.debug(f"[FFB-Pys(UP)] effect= {FfEvioMapper._ff_type_name(eff.type)} ")
-                self._effect_types[int(eff.id)] = ecodes.FF_DAMPER
-                
-                # FF_SPRING , FF_DAMPER の場合 safe_eff 利用
-                # ユニオンに入ってきたものを “安全に 2 軸初期化済み condition[2]” に組み直す
-                safe_eff = _build_condition_pair_from_generic(t, eff)
-                eff = safe_eff
-
-                # 共通処理ここから
-                new_phys_id = self.ff_mapper.upload_ff_effect_via_eviocsff(self.phys_fd, eff)
-                # 3) マップ更新（virt→phys, phys→virt）
-                self.ff_mapper._virt2phys[virt_id] = new_phys_id
-                self.ff_mapper._phys2virt[new_phys_id] = virt_id
-                logging.debug(f"[FFB-Pys(UP)] {FfEvioMapper._ff_type_name(eff.type)} to physical: id={new_phys_id}")
-                up.effect.id = int(virt_id)
-                up.retval = 0
-                # 共通処理ここまで
-
-            elif eff.type == ecodes.FF_FRICTION:
-                logging.debug(f"[FFB-Pys(UP)] effect= {FfEvioMapper._ff_type_name(eff.type)} ")
-                self._effect_types[int(eff.id)] = ecodes.FF_FRICTION
-                
-                # FF_SPRING , FF_DAMPER の場合 safe_eff 利用
-                # ユニオンに入ってきたものを “安全に 2 軸初期化済み condition[2]” に組み直す
-                safe_eff = _build_condition_pair_from_generic(t, eff)
-                eff = safe_eff
-
-                # 共通処理ここから
-                new_phys_id = self.ff_mapper.upload_ff_effect_via_eviocsff(self.phys_fd, eff)
-                # 3) マップ更新（virt→phys, phys→virt）
-                self.ff_mapper._virt2phys[virt_id] = new_phys_id
-                self.ff_mapper._phys2virt[new_phys_id] = virt_id
-                logging.debug(f"[FFB-Pys(UP)] {FfEvioMapper._ff_type_name(eff.type)} to physical: id={new_phys_id}")
-                up.effect.id = int(virt_id)
-                up.retval = 0
-                # 共通処理ここまで
-
-            elif int(eff.type) == ecodes.FF_RUMBLE:
-                logging.debug(f"[FFB-Pys(UP)] effect= {FfEvioMapper._ff_type_name(eff.type)} ")
-                self._effect_types[int(eff.id)] = ecodes.FF_RUMBLE
-                
-                # 共通処理ここから
-                new_phys_id = self.ff_mapper.upload_ff_effect_via_eviocsff(self.phys_fd, eff)
-                # 3) マップ更新（virt→phys, phys→virt）
-                self.ff_mapper._virt2phys[virt_id] = new_phys_id
-                self.ff_mapper._phys2virt[new_phys_id] = virt_id
-                logging.debug(f"[FFB-Pys(UP)] {FfEvioMapper._ff_type_name(eff.type)} to physical: id={new_phys_id}")
-                up.effect.id = int(virt_id)
-                up.retval = 0
-                # 共通処理ここまで
-                
-            elif int(eff.type) == ecodes.UI_FF_UPLOAD:
-                logging.debug(f"[FFB-Pys(UP)] effect= {FfEvioMapper._ff_type_name(eff.type)} ")
-                self._effect_types[int(eff.id)] = ecodes.UI_FF_UPLOAD
-                
-                # 共通処理ここから
-                new_phys_id = self.ff_mapper.upload_ff_effect_via_eviocsff(self.phys_fd, eff)
-                # 3) マップ更新（virt→phys, phys→virt）
-                self.ff_mapper._virt2phys[virt_id] = new_phys_id
-                self.ff_mapper._phys2virt[new_phys_id] = virt_id
-                logging.debug(f"[FFB-Pys(UP)] {FfEvioMapper._ff_type_name(eff.type)} to physical: id={new_phys_id}")
-                up.effect.id = int(virt_id)
-                up.retval = 0
-                # 共通処理ここまで
-
-            elif int(eff.type) == ecodes.FF_PERIODIC:
-                logging.debug(f"[FFB-Pys(UP)] effect= {FfEvioMapper._ff_type_name(eff.type)} ")
-                self._effect_types[int(eff.id)] = ecodes.FF_PERIODIC
-                
-                wave = eff.u.periodic.waveform
-                if wave in (ecodes.FF_SINE, ecodes.FF_TRIANGLE, ecodes.FF_SQUARE):
-                    logging.debug(f"[FFB-Pys(UP)] PERIODIC: waveform={wave} mag={eff.u.periodic.magnitude}")
-                else:
-                    logging.warning(f"[FFB-Pys(UP)] PERIODIC: Unknown waveform {wave}")
-
-                # ★ custom未使用なら必ずゼロ化（機種/ドライバ依存のEINVAL回避）
-                try:
-                    eff.u.periodic.custom_len = 0
-                    eff.u.periodic.custom_data = None
-                except Exception:
-                    pass
-
-                status = _sanitize_periodic(eff)
-                if status == "skip_zero":
-                    # 「ゼロ強度の周期波」は実質無意味なので、物理送信せず成功扱いで返す
-                    logging.debug("PERIODIC magnitude=0 → skip upload (pretend success)")
-                    up.retval = 0
-                    return
-
-                # 共通処理ここから
-                new_phys_id = self.ff_mapper.upload_ff_effect_via_eviocsff(self.phys_fd, eff)
-                # 3) マップ更新（virt→phys, phys→virt）
-                self.ff_mapper._virt2phys[virt_id] = new_phys_id
-                self.ff_mapper._phys2virt[new_phys_id] = virt_id
-                logging.debug(f"[FFB-Pys(UP)] {FfEvioMapper._ff_type_name(eff.type)} to physical: id={new_phys_id}")
-                up.effect.id = int(virt_id)
-                up.retval = 0
-                # 共通処理ここまで
-
-            else:
-                # 未対応タイプ
-                logging.error(f"[FFB-Pys(UP)] 未対応effect= {FfEvioMapper._ff_type_name(eff.type)} ")
-                self._effect_types[int(eff.id)] = eff.type
-                
-                # 共通処理ここから
-                new_phys_id = self.ff_mapper.upload_ff_effect_via_eviocsff(self.phys_fd, eff)
-                # 3) マップ更新（virt→phys, phys→virt）
-                self.ff_mapper._virt2phys[virt_id] = new_phys_id
-                self.ff_mapper._phys2virt[new_phys_id] = virt_id
-                logging.debug(f"[FFB-Pys(UP)] {FfEvioMapper._ff_type_name(eff.type)} to physical: id={new_phys_id}")
-                up.effect.id = int(virt_id)
+        if t in self.ff_ignored:
+            # 制御ソケットで無視指定された type: 物理へは送らず成功扱い（載っていた物理スロットは消す）
+            self._release_phys_slot(virt_id)
+            up.retval = 0
+            return
+        self.ff_last_type = t
+        if ti < SHM_NLEVELS:
+            self.ff_last_level[ti] = _ff_effect_level(eff)
+
+        logging.debug("Pys / BEGIN_UPLOAD req=%d type=%s vID=%d len=%d delay=%d",
+                      up.request_id, FF_TYPE_LABELS.get(t), virt_id,
+                      eff.replay.length, eff.replay.delay)
+        prep, upload = h
+        if prep is not None:
+            eff = prep(t, eff)
+            if eff is None:
                 up.retval = 0
-                # 共通処理ここまで
-
-            # _handle_ff_upload の成功パスの最後（物理 id 割当後）
-            #up.effect = eff
-            logging.debug(f"Pys / UPLOAD mapped virt={virt_id} -> phys={phys_id} new_phys={new_phys_id} (type={eff.type})")
+                return
+        try:
+            # 再生中なら即物理へ、停止中は保持だけ（再生時にアップロード、-1 が返る）
+            new_phys_id = upload(virt_id, eff)
         except OSError as e:
-            if e.errno == errno.ENOSPC:
-                # まずLRUで整理
-                freed = self.ff_mapper._evict_some_phys_slots(limit=4)
-                if freed == 0:
-                    # まだダメなら総当りでさらに整理（上の実装が既に総当りを含むので不要なら省略可）
-                    pass
-                # リトライ（1回だけ）
-                phys_id = self.ff_mapper.upload_ff_effect_via_eviocsff(self.phys_fd, up.effect)
-                logging.warning("ENOSPC: freed <%d> slots, retrying alloc", freed)
-                try:
-                    eff.id = -1
-                    new_phys_id = self.ff_mapper.upload_ff_effect_via_eviocsff(self.phys_fd, eff)
-                    self.ff_mapper._virt2phys[virt_id] = new_phys_id
-                    self.ff_mapper._phys2virt[new_phys_id] = virt_id
-                    up.retval = 0
-                except OSError as e2:
-                    up.retval = -getattr(e2, "errno", errno.EIO)
-                    logging.error("ERROR:_handle_ff_upload / 003")
-                    traceback.print_exc()
-                    raise
-            else:
-                up.retval = -getattr(e, "errno", errno.EIO)
-                logging.error("ERROR:_handle_ff_upload / 002")
-                traceback.print_exc()
-                raise
-        except Exception as e:
+            # ENOSPC は _ff_phys_commit 内で追い出し→再試行済み。ここに来るのはそれでも駄目だったもの。
+            # 例外は上げずにゲームへ retval で返す（END_FF_UPLOAD を必ず通す）
+            up.retval = -(e.errno or errno.EIO)
+            logging.error("[FFB-Pys] upload failed virt=%d type=%s: %s", virt_id, FF_TYPE_LABELS.get(t), e)
+            return
+        except Exception:
             logging.error("ERROR:_handle_ff_upload / 001")
             traceback.print_exc()
-            raise
-
-    def bind_ff_enqueue(self, cb):
-        """後からバインドする用（UnderSteer が ff_worker を作った後に呼べる）"""
-        self._enqueue_cb = cb
-        # 溜めていたものを吐き出す
-        if self._pending:
-            for kind, payload in self._pending:
-                try:
-                    cb(kind, payload)
-                except Exception as e:
-                    logging.error("enqueue flush failed: %s", e)
-            self._pending.clear()
-
-    def _enqueue_from_thread(self, kind: str, payload: dict):
-        cb = self._enqueue_cb
-        if cb is None:
-            # まだ ff_worker が準備できてない間は溜める（落とさない）
-            self._pending.append((kind, payload))
+            up.retval = -errno.EIO
             return
-        try:
-            cb(kind, payload)     # ※ UnderSteer 側で thread-safe にしておく
-        except Exception as e:
-            logging.error("enqueue failed: %s", e)
+        logging.debug("Pys / UPLOAD mapped virt=%d -> phys=%d (type=%s)", virt_id, new_phys_id, FF_TYPE_LABELS.get(t))
+        up.effect.id = virt_id
+        up.retval = 0
 
     def _setbit(self, which, code):
         # 第3引数は “int 値” でOK（_IOW の「copy_from_user(int)」に一致）
@@ -2970,15 +4133,37 @@ class UInputFFDevice:
 
     # --- evdev.UInput 互換APIを追加 ---
     def write(self, type_, code, value):
-        write_input_event(self.ui_base_fd, type_, code, value)
+        """
+        1イベント書き込み。EV_KEY / EV_ABS は直近送出値と同じなら捨てる（差分のみ送出）。
+        戻り値: 実際に書いたら True
+        """
+        if type_ == E.EV_ABS:
+            if self._last_abs[code] == value:
+                return False
+            self._last_abs[code] = value
+        elif type_ == E.EV_KEY:
+            if self._last_key[code] == value:
+                return False
+            self._last_key[code] = value
+        self._out.push(type_, code, value)
+        self._frame_dirty = True
+        return True
 
     def syn(self):
-        write_input_event(self.ui_base_fd, E.EV_SYN, E.SYN_REPORT, 0)
+        """フレーム確定。直前の SYN 以降に実イベントが無ければ何もしない。"""
+        if not self._frame_dirty:
+            return False
+        self._frame_dirty = False
+        out = self._out
+        out.push(E.EV_SYN, E.SYN_REPORT, 0)
+        out.commit()
+        return True
 
     def emit(self, type_, code, value):
-        self.write(type_, code, value)
-        #time.sleep(LoopWait_sec / 100) #fcntl.ioctl の後、必要
-        if type_ != E.EV_SYN:
+        if type_ == E.EV_SYN:
+            self.syn()
+            return
+        if self.write(type_, code, value):
             self.syn()
             # ここ入れて様子見 key emit...
             time.sleep(LoopWait_sec / 100) #fcntl.ioctl の後、必要
@@ -2996,6 +4181,9 @@ class UInputFFDevice:
             self.stop_ff_server()
         except Exception:
             pass
+        # 出力の書き手: 残りのフレームを吐いてから止める（fd を閉じる前）
+        if getattr(self, "writer", None) is not None:
+            self.writer.close()
 
         # 2) デバイス破棄（存在すれば）
         try:
@@ -3041,22 +4229,9 @@ FFB実装
 def code_to_name(code: int) -> str:
     """
     EV_KEY の数値コードから、見やすい名前（BTN_* / KEY_*）を返す。
-    - まず BTN 辞書（code→'BTN_*'）を優先
-    - 次に KEY 辞書（code→'KEY_*'）
-    - それでも無ければ ecodes.ecodes（name→code）を総当たりで逆引き
-    - 最後の手段で 'KEY_<code>'
+    共有シンボル表 KEY_NAMES を引くだけ。無ければ 'KEY_<code>'
     """
-    # 確実ルート: code→name の辞書を直接引く
-    name = ecodes.BTN.get(code)
-    if not name:
-        name = ecodes.KEY.get(code)
-    if not name:
-        # まれに辞書に欠けがある環境向けの保険（低頻度なので線形探索でOK）
-        for n, c in ecodes.ecodes.items():  # name -> code
-            if c == code:
-                name = n
-                break
-    return name or f"KEY_{code}"
+    return key_name(code)
 
 def get_vid_pid(phys_or_uniq: str) -> Tuple[Optional[str], Optional[str]]:
     """
@@ -3102,11 +4277,11 @@ def fmt_info(i: DevInfo) -> str:
     return f"{i.path:>15} | {vp} | name='{i.name}' phys='{i.phys}' uniq='{i.uniq}'"
 
 def is_axis(code: int) -> bool:
-    return ecodes.EV_ABS == ecodes.EV_ABS and code in ecodes.ABS.values()
+    return code in ABS_NAMES
 
 def is_button(code: int) -> bool:
     # おおまかに BTN_* 系（キーボードキーは除外）
-    return code in ecodes.BTN.values()
+    return code in BTN_NAMES
 
 # ------------------------
 # ギアマッピング
@@ -3143,21 +4318,19 @@ class GearMapper:
     ]
     STD_NEUTRAL = ecodes.BTN_DEAD
 
-    # ニュートラルフラグ（HAT-Keyboard連携用）
-    neutralFlg = True
-
     def __init__(self, path: Path):
         self.path = path
+        # ニュートラルフラグ（HAT-Keyboard連携用）。書くのも読むのも入力中継スレッド（インスタンスごと）
+        self.neutralFlg = True
         # gear_requirements[i] = set of input key codes for Gi (i:0..7)
         self.gear_requirements: List[Set[int]] = []
         self.neutral_button: Optional[int] = None  # 明示定義があれば使用
         # 入力側で監視すべきコード
         self.watch_codes: Set[int] = set()
-        # 入力の現在押下状態（True/False）
-        self.input_pressed: Dict[int, bool] = {}
-        # 出力（標準化ボタン）の状態
-        self.out_pressed: Dict[int, bool] = {c: False for c in (self.STD_GEAR_CODES + [self.STD_NEUTRAL])}
+        # 出力（標準化ボタン）: index 0..7 = G1..G8, 8 = NEUTRAL
+        self._out_codes: List[int] = self.STD_GEAR_CODES + [self.STD_NEUTRAL]
         self._load()
+        self._compile()
 
     # === 追加：名前→コード解決 ===
     def _name_to_code(self, token: str) -> int:
@@ -3233,60 +4406,106 @@ class GearMapper:
                 self._add_gear_by_tokens([line])
         if tmp_requirements:
             self.gear_requirements = tmp_requirements
-        # input_pressed 初期化
-        for code in self.watch_codes:
-            self.input_pressed[code] = False
+
+    # 監視コード数がこれ以下なら全押下パターンの判定表を先に作る（2^n エントリ）
+    _TABLE_MAX_BITS = 16
+
+    def _compile(self):
+        """
+        ギア定義を「監視コードのビットマスク → 出力 index」の判定表へ落とす。
+        出力 index: 0..7 = G1..G8, 8 = NEUTRAL, -1 = 何も押さない
+        """
+        self._bit: Dict[int, int] = {c: 1 << i for i, c in enumerate(sorted(self.watch_codes))}
+        self._req_masks: List[int] = [sum(self._bit[c] for c in req) for req in self.gear_requirements]
+        self._neutral_mask = self._bit.get(self.neutral_button, 0) if self.neutral_button is not None else 0
+        self._held = 0
+        self._out = self._decide(0)         # 判定上の現在出力
+        self._emitted = -1                  # 実際に仮想デバイスへ出している出力
+        self.neutralFlg = (self._out == 8)
+        n = len(self._bit)
+        if n <= self._TABLE_MAX_BITS:
+            self._table = array('b', (self._decide(m) for m in range(1 << n)))
+        else:
+            self._table = None
+            self._memo: Dict[int, int] = {}
+
+    def _decide(self, mask: int) -> int:
+        # 現在満たされているギア（先勝ち）
+        for i, req in enumerate(self._req_masks):
+            if req and (mask & req) == req:
+                return i if i < len(self.STD_GEAR_CODES) else -1
+        # どのギア条件も満たさない: 明示 NEUTRAL があればその押下時のみ、無ければ常にニュートラル
+        if self.neutral_button is not None:
+            return 8 if mask & self._neutral_mask else -1
+        return 8
 
     def feed_input_key(self, code: int, value: int) -> bool:
         """
         監視対象の入力キーが変化したら呼ぶ。
         戻り値: 出力の状態に変化があったかどうか。
         """
-        if code not in self.watch_codes:
+        bit = self._bit.get(code)
+        if bit is None:
             return False
-        self.input_pressed[code] = (value != 0)
-        return self._recompute_output()
-
-    def _recompute_output(self) -> bool:
-        # 現在満たされているギア（先勝ち）
-        active_gear_idx = None
-        for i, req in enumerate(self.gear_requirements):
-            if all(self.input_pressed.get(c, False) for c in req):
-                active_gear_idx = i
-                break
-        # ニュートラルの判定
-        neutral = False
-        if active_gear_idx is None:
-            if self.neutral_button is not None:
-                neutral = self.input_pressed.get(self.neutral_button, False)
-            else:
-                neutral = True  # どのギア条件も満たさない＝ニュートラル
-        GearMapper.neutralFlg = neutral
+        held = (self._held | bit) if value else (self._held & ~bit)
+        if held == self._held:
+            return False
+        self._held = held
+        if self._table is not None:
+            out = self._table[held]
+        else:
+            out = self._memo.get(held)
+            if out is None:
+                out = self._memo[held] = self._decide(held)
+        self._out = out
+        self.neutralFlg = (out == 8)
+        # 実際に出している出力と比べる（起動直後の暗黙ニュートラルは最初の変化で初めて出す）
+        return out != self._emitted
 
-        # 目標出力状態を作る
-        desired: Dict[int, bool] = {c: False for c in self.out_pressed.keys()}
-        if active_gear_idx is not None and active_gear_idx < len(self.STD_GEAR_CODES):
-            desired[self.STD_GEAR_CODES[active_gear_idx]] = True
-        elif neutral:
-            desired[self.STD_NEUTRAL] = True
+    def emit_to(self, ui: UInput):
+        """前回出した出力との差分（離すボタン/押すボタン）だけ書く。SYN は物理フレームの SYN_REPORT で出る"""
+        prev, cur = self._emitted, self._out
+        if prev == cur:
+            return
+        if prev >= 0:
+            ui.write(ecodes.EV_KEY, self._out_codes[prev], 0)
+        if cur >= 0:
+            ui.write(ecodes.EV_KEY, self._out_codes[cur], 1)
+        self._emitted = cur
 
-        changed = (desired != self.out_pressed)
-        self.out_pressed = desired
-        return changed
+    @property
+    def current(self) -> int:
+        """仮想デバイスへ出しているギア（0..7 / 8=N / -1=無し）"""
+        return self._emitted
 
-    def emit_to(self, ui: UInput):
-        """self.out_pressed の差分を実出力（押下/解放）として送る。"""
-        for code, pressed in self.out_pressed.items():
-            ui.write(ecodes.EV_KEY, code, 1 if pressed else 0)
-            #time.sleep(LoopWait_sec / 100) #fcntl.ioctl の後、必要
-        ui.syn()
-        # ここ入れて様子見 key emit...
-        time.sleep(LoopWait_sec / 100) #fcntl.ioctl の後、必要
+    def release_to(self, ui: UInput):
+        """出している標準ギア出力を離す（定義差し替え時）"""
+        if self._emitted >= 0:
+            ui.write(ecodes.EV_KEY, self._out_codes[self._emitted], 0)
+            self._emitted = -1
 
 # ------------------------
 # キーボードマッピング（TSV）
 # ------------------------
 
+class _KeyAction:
+    """
+    keymap 1 行ぶんの出力（ロード時に pack 済み）。
+      chord: press/release を各 1 回の os.write で送る（入力押下中は保持）
+      macro: steps = [(前ステップからの待ち[sec], frame, keys), ...] を入力押下時に 1 回再生
+             frame は pack 済みの送出バイト列、keys はそのステップ後も押したままのキー（中断時に離す）
+    """
+    __slots__ = ("keys", "press", "release", "steps", "handle", "held")
+
+    def __init__(self, keys: List[int], steps=None):
+        self.keys = keys
+        self.press = pack_key_frame(keys, 1)
+        self.release = pack_key_frame(reversed(keys), 0)
+        self.steps = steps
+        self.handle = None              # 再生中マクロの TimerHandle
+        self.held = b""                 # 再生中マクロで押しっぱなしのキー（中断時に離す）
+
+
 class KeymapTSV:
     """
     TSV で定義した「入力ボタン → 出力キー（同時押し可）」のマッピングを、
@@ -3297,20 +4516,25 @@ class KeymapTSV:
     例:
         BTN_0\tKEY_SPACE
         BTN_4\tKEY_LEFTCTRLKEY_R
+        BTN_5\tKEY_ESC\tWAIT=80\tKEY_DOWN\tWAIT=40\tKEY_ENTER   # マクロ
 
     - 押しっぱ対応: 入力が押下されている間は出力キーも押下状態を保持する
     - 解除順は逆順（修飾 → 本体の順で押し、本体 → 修飾の順で離すと安全）
+    - WAIT=<ms> を含む行はマクロ: WAIT で区切った各キー群を順に押し、次の群の直前に離す
+      （最後の群は MACRO_TAP_MS 後に離す）。待ちはイベントループのタイマーで回す
+    - 出力は /dev/uinput の生 fd へ、1 フレーム（キー群 + SYN）を os.write 1 回で送る
     """
+    MACRO_TAP_MS = 30
+
     def __init__(self, tsv_path: Path):
         self.tsv_path = tsv_path
-        # 入力(数値コード: BTN/KEY) → [出力キーコード]
-        self.map_codes: Dict[int, List[int]] = {}
-        self.src_pressed_codes: Dict[int, bool] = {}
-        # 入力(名前: HAT0_LEFT 等) → [出力キーコード]
-        self.map_names: Dict[str, List[int]] = {}
-        self.src_pressed_names: Dict[str, bool] = {}
-        # 仮想キーボード UInput
-        self.kb: Optional[UInput] = None
+        # 入力(数値コード: BTN/KEY) → 出力アクション
+        self.map_codes: Dict[int, _KeyAction] = {}
+        # 入力(名前: HAT0_LEFT 等) → 出力アクション
+        self.map_names: Dict[str, _KeyAction] = {}
+        # 仮想キーボード（/dev/uinput の fd）
+        self.kb_fd: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
 
         self._load()
         self._open_uinput_keyboard()
@@ -3333,14 +4557,39 @@ class KeymapTSV:
         except Exception:
             raise ValueError(f"Unknown button/key name: {name}")
 
-    def _parse_keys(self, rhs: str) -> List[int]:
-        keys = []
+    def _parse_action(self, rhs: str) -> Optional[_KeyAction]:
+        """RHS → _KeyAction。WAIT=<ms> があればマクロとしてステップ列を組む"""
+        groups: List[List[int]] = [[]]
+        waits: List[float] = []
         for token in rhs.strip().split("\t"):
             token = token.strip()
             if not token:
                 continue
-            keys.append(self._name_to_code(token))
-        return keys
+            if token.upper().startswith("WAIT="):
+                waits.append(max(0, int(token.split("=", 1)[1])) / 1000.0)
+                groups.append([])
+                continue
+            groups[-1].append(self._name_to_code(token))
+        if not waits:
+            return _KeyAction(groups[0]) if groups[0] else None
+
+        # マクロ: 群 i を押す → waits[i] 後に群 i を離して群 i+1 を押す → ... → 最後の群を離す
+        steps = []
+        delay = 0.0
+        prev: List[int] = []
+        for i, keys in enumerate(groups):
+            frame = (pack_key_frame(reversed(prev), 0) if prev else b"") + \
+                    (pack_key_frame(keys, 1) if keys else b"")
+            if frame:
+                steps.append((delay, frame, keys))
+                delay = 0.0
+            prev = keys
+            if i < len(waits):
+                delay += waits[i]
+        if prev:
+            steps.append((self.MACRO_TAP_MS / 1000.0, pack_key_frame(reversed(prev), 0), []))
+        all_keys = [k for g in groups for k in g]
+        return _KeyAction(all_keys, steps=steps) if all_keys else None
 
     def _load(self):
         import re
@@ -3361,10 +4610,6 @@ class KeymapTSV:
                 if not line:
                     continue
 
-            ## 実タブが無いが、可視「\t」がある場合は置換
-            #if "\t" not in line and "\\t" in line:
-            #    line = line.replace("\\t", "\t")
-
             # まずはタブで 2 分割（LHS / RHS）
             lhs = rhs = None
             if "\t" in line:
@@ -3372,24 +4617,18 @@ class KeymapTSV:
                 if len(parts) == 2:
                     lhs, rhs = parts[0].strip(), parts[1].strip()
 
-            #if not lhs or not rhs:
-            #    logging.warning(f"[keymap] L{idx}: skip (no separator) : {orig}")
-            #    continue
             print(lhs , " and " , rhs)
             try:
-                dst_keys = self._parse_keys(rhs)
-                if not dst_keys:
+                action = self._parse_action(rhs)
+                if action is None:
                     logging.warning(f"[keymap] L{idx}: no dst keys : {orig}")
                     continue
                 # HAT 名はそのまま名前マップへ、他はコード化してコードマップへ
                 if re.match(r"^HAT\d_(LEFT|RIGHT|UP|DOWN)$", lhs):
-                    key = lhs
-                    self.map_names[key] = dst_keys
-                    self.src_pressed_names[key] = False
+                    self.map_names[lhs] = action
                 else:
                     code = self._name_to_code(lhs)  # BTN_*/KEY_* or number
-                    self.map_codes[code] = dst_keys
-                    self.src_pressed_codes[code] = False
+                    self.map_codes[code] = action
             except Exception as e:
                 logging.warning(e)
                 logging.warning(f"[keymap] L{idx}: skip : {orig}  (can not map)")
@@ -3398,20 +4637,14 @@ class KeymapTSV:
     def _open_uinput_keyboard(self):
          # 使うキーだけ expose（過不足があると send 時に失敗するため union を作る）
         all_keys: Set[int] = set()
-        if self.map_codes:
-            all_keys |= set(chain.from_iterable(self.map_codes.values()))
-        if self.map_names:
-            all_keys |= set(chain.from_iterable(self.map_names.values()))
+        for action in chain(self.map_codes.values(), self.map_names.values()):
+            all_keys.update(action.keys)
         if not all_keys:
             return
-        caps = {
-             ecodes.EV_KEY: sorted(list(all_keys)),
-             # EV_REP は不要（OS 側に任せる）
-        }
-        # Generic 仮想キーボード
-        self.kb = UInput(caps, name="UnderSteer Virtual Keyboard",
-                          vendor=0x16c0, product=0x27db, version=0x0100)
-        logging.info(f"[uinput] created virtual keyboard: {self.kb.device}")
+        # Generic 仮想キーボード（EV_REP は不要。OS 側に任せる）
+        self.kb_fd = open_raw_uinput_keyboard("UnderSteer Virtual Keyboard", all_keys,
+                                              vid=0x16c0, pid=0x27db)
+        logging.info(f"[uinput] created virtual keyboard: keys={len(all_keys)}")
 
     @property
     def watch_codes(self) -> Set[int]:
@@ -3421,61 +4654,98 @@ class KeymapTSV:
     def watch_names(self) -> Set[str]:
         return set(self.map_names.keys())
 
+    def _send(self, frame: bytes):
+        try:
+            os.write(self.kb_fd, frame)
+        except OSError as e:
+            logging.warning(f"[keymap] write failed: {e}")
+
+    def _fire(self, action: _KeyAction, pressed: bool):
+        if action.steps is None:
+            # 押下：修飾から本体へ（記述順）／解放：逆順（本体→修飾）
+            self._send(action.press if pressed else action.release)
+        elif pressed:
+            self._start_macro(action)
+
+    def _start_macro(self, action: _KeyAction):
+        # 再生中なら止めて、押しっぱなしのキーを離してからやり直す
+        if action.handle is not None:
+            action.handle.cancel()
+            action.handle = None
+        if action.held:
+            self._send(action.held)
+            action.held = b""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        self._macro_step(action, 0)
+
+    def bind_loop(self, loop):
+        """マクロのタイマーを張るループ（--loop epoll では入力スレッドの _EpollLoop）"""
+        self._loop = loop
+
+    def _macro_step(self, action: _KeyAction, i: int):
+        steps = action.steps
+        # 待ち 0 のステップは続けて送り、待ちがあればタイマーに預けて抜ける
+        while i < len(steps):
+            if steps[i][0] > 0.0:
+                action.handle = self._loop.call_later(steps[i][0], self._macro_resume, action, i)
+                return
+            self._macro_play(action, i)
+            i += 1
+        action.handle = None
+
+    def _macro_resume(self, action: _KeyAction, i: int):
+        action.handle = None
+        self._macro_play(action, i)
+        self._macro_step(action, i + 1)
+
+    def _macro_play(self, action: _KeyAction, i: int):
+        _, frame, keys = action.steps[i]
+        self._send(frame)
+        action.held = pack_key_frame(reversed(keys), 0) if keys else b""
+
     def handle_src_event(self, code: int, value: int):
          """
          入力イベント（EV_KEY）を受け、マッピングされていれば kb に押下/解放を送る。
          value: 0=UP, 1=DOWN, 2=REPEAT（2は無視）
          """
-         if self.kb is None:
+         if self.kb_fd is None:
              return
-         if code not in self.map_codes:
+         action = self.map_codes.get(code)
+         if action is None:
              return
          if value == 2:
              # 自分でリピートを作らず、OS の auto-repeat に任せる
              return
- 
-         keys = self.map_codes[code]
-         if value:
-             # 押下：修飾から本体へ（記述順をそのまま採用）
-             for k in keys:
-                 self.kb.write(ecodes.EV_KEY, k, 1)
-             self.kb.syn()
-             self.src_pressed_codes[code] = True
-         else:
-             # 解放：逆順で解放（本体→修飾）
-             for k in reversed(keys):
-                 self.kb.write(ecodes.EV_KEY, k, 0)
-             self.kb.syn()
-             self.src_pressed_codes[code] = False
+         self._fire(action, value != 0)
 
     def handle_named(self, name: str, pressed: bool):
         """
          名前入力（HAT0_LEFT 等）を受け、対応キーを押下/解放。
         """
-        if self.kb is None:
-            #logging.error("None...")
+        if self.kb_fd is None:
             return
-        if name not in self.map_names:
-            #logging.error("not in")
+        action = self.map_names.get(name)
+        if action is None:
             return
-        keys = self.map_names[name]
-        if pressed:
-            for k in keys:
-                self.kb.write(ecodes.EV_KEY, k, 1)
-            self.kb.syn()
-            self.src_pressed_names[name] = True
-        else:
-            for k in reversed(keys):
-                self.kb.write(ecodes.EV_KEY, k, 0)
-            self.kb.syn()
-            self.src_pressed_names[name] = False
+        self._fire(action, pressed)
 
     def close(self):
-         try:
-             if self.kb:
-                 self.kb.close()
-         except Exception:
-             pass
+        for action in chain(self.map_codes.values(), self.map_names.values()):
+            if action.handle is not None:
+                action.handle.cancel()
+                action.handle = None
+        if self.kb_fd is None:
+            return
+        try:
+            fcntl.ioctl(self.kb_fd, UI_DEV_DESTROY)
+        except OSError:
+            pass
+        try:
+            os.close(self.kb_fd)
+        except OSError:
+            pass
+        self.kb_fd = None
 
 # ------------------------
 # デバイス選定
@@ -3576,6 +4846,8 @@ def merge_capabilities(
                     ff_features_set.update(item)
                 else:
                     ff_features_set.add(item)
+        # --ff-soft で合成する type は物理が持っていなくても仮想側に出す
+        ff_features_set.update(getattr(us, "soft_ff_types", ()))
         ff_features = sorted(list(ff_features_set))
         print("")
         logging.debug("ff_features")
@@ -3741,6 +5013,204 @@ def find_hidraw_for_event(event_path: str, *, timeout_sec=0.03, max_up=6) -> str
 
 
 
+# ------------------------
+# --loop epoll: 入力中継専用の最小イベントループ
+# ------------------------
+
+class _EpollTimer:
+    """_EpollLoop.call_at/call_later の戻り（asyncio.TimerHandle の cancel() 互換）"""
+    __slots__ = ("when", "seq", "cb", "args", "cancelled")
+
+    def __init__(self, when: float, seq: int, cb, args):
+        self.when, self.seq, self.cb, self.args = when, seq, cb, args
+        self.cancelled = False
+
+    def __lt__(self, other: "_EpollTimer") -> bool:
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _EpollLoop:
+    """
+    「evdev fd N 本 + タイマー + 制御パイプ」だけを回す epoll ループ（専用スレッドで run()）。
+    asyncio ループのうち、ルーティング部品が使う time / call_at / call_later /
+    call_soon_threadsafe / add_reader / remove_reader だけを持つ。
+    時刻は time.monotonic（asyncio の loop.time と同じ基準）。
+    """
+    def __init__(self):
+        self._ep = select.epoll()
+        self._readers: Dict[int, tuple] = {}         # fd -> (cb, args)
+        self._timers: List[_EpollTimer] = []         # heapq
+        self._ready = collections.deque()            # 他スレッドから積まれたコールバック
+        self._seq = 0
+        self._stopping = False
+        self._ctl_r, self._ctl_w = os.pipe()
+        os.set_blocking(self._ctl_r, False)
+        os.set_blocking(self._ctl_w, False)
+        self._ep.register(self._ctl_r, select.EPOLLIN)
+
+    time = staticmethod(time.monotonic)
+
+    def add_reader(self, fd: int, cb, *args):
+        self._readers[fd] = (cb, args)
+        self._ep.register(fd, select.EPOLLIN)
+
+    def remove_reader(self, fd: int):
+        if self._readers.pop(fd, None) is not None:
+            try:
+                self._ep.unregister(fd)
+            except (OSError, ValueError):
+                pass
+
+    def call_at(self, when: float, cb, *args) -> _EpollTimer:
+        self._seq += 1
+        h = _EpollTimer(when, self._seq, cb, args)
+        heapq.heappush(self._timers, h)
+        return h
+
+    def call_later(self, delay: float, cb, *args) -> _EpollTimer:
+        return self.call_at(time.monotonic() + delay, cb, *args)
+
+    def call_soon_threadsafe(self, cb, *args):
+        self._ready.append((cb, args))
+        self._wake()
+
+    def stop(self):
+        self._stopping = True
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._ctl_w, b"x")
+        except (BlockingIOError, OSError):
+            pass
+
+    def run(self):
+        ep, readers, timers, ready, ctl = self._ep, self._readers, self._timers, self._ready, self._ctl_r
+        while not self._stopping:
+            timeout = -1
+            if timers:
+                timeout = max(0.0, timers[0].when - time.monotonic())
+            for fd, _mask in ep.poll(timeout):
+                if fd == ctl:
+                    try:
+                        os.read(ctl, 4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                ent = readers.get(fd)
+                if ent is not None:
+                    ent[0](*ent[1])
+            while ready:
+                cb, args = ready.popleft()
+                cb(*args)
+            if timers:
+                now = time.monotonic()
+                while timers and timers[0].when <= now:
+                    h = heapq.heappop(timers)
+                    if not h.cancelled:
+                        h.cb(*h.args)
+
+    def close(self):
+        """run() が抜けた後に呼ぶ。以降の call_soon_threadsafe は捨てられる（閉じた fd 番号を再利用先へ書かない）"""
+        self._ep.close()
+        for fd in (self._ctl_r, self._ctl_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._ctl_r = self._ctl_w = -1
+
+
+# ------------------------
+# 設定ファイルのホットリロード
+# ------------------------
+
+class _RouteTable:
+    """
+    _pipe_events が 1 イベントにつき 1 回だけ参照するコンパイル済みルーティング一式。
+    再読込時は別スレッドで丸ごと作り直し、ループ上で self._rt を 1 回代入して差し替える。
+    """
+    __slots__ = ("routing", "src2virt_abs", "axis_chains", "buttons", "hat",
+                 "axis_rate", "gear_mapper", "keymap", "tel_index", "ff_steer")
+
+
+# <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_NONBLOCK    = 0o4000
+_IN_CLOEXEC     = 0o2000000
+_INOTIFY_EVENT_HDR = struct.Struct("iIII")   # wd, mask, cookie, len
+
+class _ConfigWatcher:
+    """
+    inotify（libc を ctypes で直接）で設定ファイルの書き換えを監視し、
+    落ち着いたところ（debounce 秒）で on_change(set[path]) をループ上で呼ぶ。
+    エディタの「別名保存→rename」にも追従できるよう、ファイルではなく親ディレクトリを watch する。
+    """
+    def __init__(self, loop, paths, on_change, debounce: float = 0.25):
+        self.loop = loop
+        self.on_change = on_change
+        self.debounce = debounce
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._names: Dict[int, Dict[str, str]] = {}      # wd -> {basename: 監視対象パス}
+        by_dir: Dict[str, Dict[str, str]] = {}
+        for path in paths:
+            full = os.path.abspath(path)
+            by_dir.setdefault(os.path.dirname(full), {})[os.path.basename(full)] = path
+        for d, names in by_dir.items():
+            wd = self._libc.inotify_add_watch(self._fd, d.encode(), _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE)
+            if wd < 0:
+                logging.warning("[reload] inotify_add_watch failed: %s (%s)", d, os.strerror(ctypes.get_errno()))
+                continue
+            self._names[wd] = names
+        self._pending: Set[str] = set()
+        self._timer = None
+        loop.add_reader(self._fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            buf = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        off = 0
+        hdr = _INOTIFY_EVENT_HDR
+        while off + hdr.size <= len(buf):
+            wd, _mask, _cookie, ln = hdr.unpack_from(buf, off)
+            name = buf[off + hdr.size: off + hdr.size + ln].split(b"\0", 1)[0].decode(errors="replace")
+            off += hdr.size + ln
+            path = self._names.get(wd, {}).get(name)
+            if path is not None:
+                self._pending.add(path)
+        if self._pending:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = self.loop.call_later(self.debounce, self._fire)
+
+    def _fire(self):
+        self._timer = None
+        changed, self._pending = self._pending, set()
+        self.on_change(changed)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._fd >= 0:
+            try:
+                self.loop.remove_reader(self._fd)
+            except Exception:
+                pass
+            os.close(self._fd)
+            self._fd = -1
+
+
 # ------------------------
 # パイプライン
 # ------------------------
@@ -3763,53 +5233,34 @@ class UnderSteer:
                   mapping_src2virt: Optional[dict] = None,
                   mapping_mode: str = "priority"):
 
-        # args.mapping_axes / args.mapping_buttons を使ってロード
+        # args.mapping_axes / args.mapping_buttons を使ってロード（TSV は 1 回ずつだけ読む）
         try:
-            (self.mapping_virt2src,
-             self.mapping_src2virt,
-             self.map_src2virt_abs,
-             self.map_src2virt_key) = build_routing_from_tsv(
-                 args.mapping_axes, args.mapping_buttons
-             )
+            self.routing = build_routing_from_tsv(
+                args.mapping_axes, args.mapping_buttons,
+                cache_path=getattr(args, "mapping_cache", None),
+            )
             logging.info("[mapping] loaded (axes_groups=%d, buttons_groups=%d)",
-                         len(_parse_mapping_tsv(args.mapping_axes) if args.mapping_axes else []),
-                         len(_parse_mapping_tsv(args.mapping_buttons) if args.mapping_buttons else []))
+                         self.routing.axes_groups, self.routing.button_groups)
         except Exception as e:
             logging.error("[mapping] load failed: %s", e)
             traceback.print_exc()
-            self.mapping_virt2src = {}
-            self.mapping_src2virt = {}
-            self.map_src2virt_abs = {}
-            self.map_src2virt_key = {}
-
-        self._ensure_btn_co()
+            self.routing = MappingRouting.empty()
+        self.mapping_virt2src = self.routing.virt2src
+        self.mapping_src2virt = self.routing.src2virt
+        self.map_src2virt_abs = self.routing.src2virt_abs
+        self.map_src2virt_key = self.routing.src2virt_key
+
+        self.args = args
+        # --rt（RT 優先度/CPU 固定/mlockall）。入力スレッド側は run()、FF スレッド側はサーバループ先頭で適用
+        self.rt_cfg = RtConfig.from_args(args)
+        self._h_input: Optional[LatencyHistogram] = (
+            latency_histogram("input.lat") if (self.rt_cfg or args.verbose or args.shm) else None)
 
         # --- デバッグフラグ（環境変数 or CLIで拡張してもOK） ---
         self.debug_merge = bool(int(os.getenv("UNDERSTEER_DEBUG_MERGE", "0")))
-        # コード→表示名の解決（任意）
-        def _btn_name(code:int):
-            try:
-                from evdev import ecodes as E
-                return next((k for k,v in E.__dict__.items() if k.startswith("BTN_") and v==code), f"BTN_{code}")
-            except Exception:
-                return f"BTN_{code}"
-        self._button_merger = ButtonMerger(debug=self.debug_merge, name_resolver=_btn_name)
-
-        # --- Button coalesce の初期化（常時作っておく） ---
-        def _emit_key(code, val):
-            # evdev へキー出力
-            self.ui.write(E.EV_KEY, int(code), int(val))
-        self._btn_co = _ButtonCoalesce(_emit_key)
 
         self._axis_scale: dict[int, tuple[int,int,int]] = {}  # code -> (src_min, src_max, mul)
-        self._axis_cache = {}          # { ecodes.ABS_*: last_value }
-        self._axis_cache_lock = threading.RLock()
         self._last_alive_ts = 0.0
-        # ABS_X を中心 0 と決めているなら
-        self._axis_cache[ecodes.ABS_X] = 0
-        self._axis_cache[ecodes.ABS_Y] = 0
-        self._axis_cache[ecodes.ABS_Z] = 0
-        self._axis_cache[ecodes.ABS_RZ] = 0
 
         self._abs_map = {}
         self._abs_owner = {}
@@ -3838,33 +5289,21 @@ class UnderSteer:
         #print("以下FFB無視")
         #print(self.ignore_ffb)
         
-        # for FFB Upload
-        self.ff_worker: Optional["AsyncFFBProxy"] = None
-        self.ff_cache_sig: Dict[Tuple[str, int], int] = {}  # (type, hash)->effect_id
         # for FFB EnQueue
         # self.ff_queue: asyncio.Queue[tuple[str, dict]] = asyncio.Queue(maxsize=1024)
         self._ff_consumer_task: asyncio.Task | None = None
-        # （任意）同種イベントの間引き用
-        self._ff_coalesce: dict[tuple[str, int], int] = {}
         
         self.gear_mapper = gear_mapper
 
         self.keymap = keymap
         self.keymap_source = keymap_source  # "wheel" | "shift" | "both"
         # マッピング（TSV）
-        self.mapping_virt2src = mapping_virt2src or {}
-        self.mapping_src2virt = mapping_src2virt or {}
+        # 明示指定があればそちらを優先（空の {} で TSV ロード結果を潰さない）
+        if mapping_virt2src:
+            self.mapping_virt2src = mapping_virt2src
+        if mapping_src2virt:
+            self.mapping_src2virt = mapping_src2virt
         self.mapping_mode = mapping_mode
-        if self.mapping_virt2src or self.mapping_src2virt:
-            def _emit_btn(vcode: int, pressed: int):
-                self.ui.write(ecodes.EV_KEY, vcode, pressed); self.ui.syn()
-            def _emit_abs(vcode: int, value: int):
-                self.ui.write(ecodes.EV_ABS, vcode, value); self.ui.syn()
-            self._btn_co = _ButtonCoalesce(_emit_btn)
-            self._hat_co = _HatCoalesce(_emit_abs, self.mapping_virt2src, mode=("last" if mapping_mode=="last" else "priority"))
-        else:
-            self._btn_co = None
-            self._hat_co = None
 
         self.echo_buttons = echo_buttons
         self.echo_buttons_tsv = echo_buttons_tsv
@@ -3879,7 +5318,24 @@ class UnderSteer:
         self.DEBUG_TELEMETORY = False
         if args.verbose >= 3:
             self.DEBUG_TELEMETORY = True
+        self._tel: Optional[TelemetrySampler] = None
+        self._rate_overrides: Dict[int, int] = {}   # vabs -> Hz（制御ソケット）
+        self._ctl: Optional[ControlServer] = None
+        if self.DEBUG_TELEMETORY:
+            self._tel = TelemetrySampler(asyncio.get_running_loop(), extra=self._telemetry_extra)
         
+        # --ff-soft: 条件系などをソフト合成（物理は FF_CONSTANT 1 本）
+        self.soft_ff_types: frozenset = frozenset()
+        self.soft_ff: Optional[SoftFFEngine] = None
+        if getattr(args, "ff_soft", None):
+            wheel_ff = set(wheel.dev.capabilities().get(ecodes.EV_FF, []))
+            if not self.ff_passthrough:
+                logging.warning("[ff-soft] needs --ff-pass-through; disabled")
+            elif ecodes.FF_CONSTANT not in wheel_ff:
+                logging.warning("[ff-soft] wheel has no FF_CONSTANT; disabled")
+            else:
+                self.soft_ff_types = parse_soft_ff_types(args.ff_soft)
+
         force_keys = []
         if self.gear_mapper:
             force_keys = GearMapper.STD_GEAR_CODES + [GearMapper.STD_NEUTRAL]
@@ -3895,6 +5351,15 @@ class UnderSteer:
         
         # 先に mapper を用意してから渡す
         self.ff_mapper = FfEvioMapper()
+        self.wheel_info.hidraw_path = args.ff_hidraw or find_hidraw_for_event(self.wheel_info.dev.path)
+        if self.wheel_info.hidraw_path:
+            logging.info("[wheel] hidraw_path=%s", self.wheel_info.hidraw_path)
+        else:
+            logging.info("[wheel] hidraw_path= None")
+        # --ff-backend: 物理への送信経路（ホイールごと）。evdev の時は UInputFFDevice が phys_fd で作る
+        if args.ff_backend != "evdev":
+            self.ff_mapper.backend = open_ff_backend(args.ff_backend, int(self.wheel_info.dev.fd),
+                                                     self.wheel_info.dev, self.wheel_info.hidraw_path)
         
         # 仮想デバイスの VID/PID/名前を引数で指定可能に
         # （G29偽装が既定：0x046d/0xc24f）
@@ -3915,10 +5380,32 @@ class UnderSteer:
             us=self,
         )
         self.center_all_axes()
-        
-        def _emit_btn(code, val):
-            self.ui.write(E.EV_KEY, int(code), 1 if val else 0)
-        self._btn_co = _ButtonCoalesce(_emit_btn)
+        if self.soft_ff_types:
+            self.ff_mapper.mixer = FFMixer(64)
+            if args.ff_mix_gain:
+                self._apply_ff_mix_gains(parse_ff_mix_gains(args.ff_mix_gain))
+            meta = self._abs_src_meta.get(("wheel", ABS["steer"]), {"min": -32768, "max": 32767})
+            self.soft_ff = SoftFFEngine(self.ff_mapper, self.soft_ff_types,
+                                        meta["min"], meta["max"], hz=args.ff_soft_hz,
+                                        invert=args.ff_soft_invert)
+            self.ui.attach_soft_ff(self.soft_ff)
+            logging.info("[ff-soft] rendering %s at %d Hz",
+                         ", ".join(FF_NAMES.get(t, str(t)) for t in sorted(self.soft_ff_types)), args.ff_soft_hz)
+
+        # --loop epoll: 入力中継は専用スレッドの epoll ループで回す（RATE/マクロのタイマーもそちら）
+        self._epoll: Optional[_EpollLoop] = _EpollLoop() if getattr(args, "loop", "asyncio") == "epoll" else None
+        # 専用スレッド（既定 executor は再読込でも使うので、RT 設定が漏れないよう分ける）。
+        # 終了時は run() の finally で入力スレッドが抜けるのを待ってから出力を閉じる
+        self._epoll_ex = (concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="input-epoll")
+                          if self._epoll is not None else None)
+        self._route_loop = self._epoll or asyncio.get_running_loop()
+
+        # ルーティング一式（軸チェーン/ボタン・HAT 合流/RATE/ギア/keymap）をコンパイル。
+        # _pipe_events はこの 1 参照だけを読む（ホットリロードで丸ごと差し替え）
+        self._rt = self._compile_runtime(self.routing, self.gear_mapper, self.keymap, self._route_loop)
+        self._watcher: Optional[_ConfigWatcher] = None
+        self._reload_task: Optional[asyncio.Task] = None
+        self._reload_pending: Set[str] = set()
         
         self.ui_event_path = self.ui.event_path
         print(
@@ -3927,11 +5414,6 @@ class UnderSteer:
         )
 
         print(f"[wheel pys-device]:{self.wheel_info.dev.path}")
-        self.wheel_info.hidraw_path = find_hidraw_for_event(self.wheel_info.dev.path)
-        if self.wheel_info.hidraw_path:
-            logging.info("[wheel] hidraw_path=%s", self.wheel_info.hidraw_path)
-        else:
-            logging.info("[wheel] hidraw_path= None")
         
         # ここ FFB
         self.phys_fd, self.phys_event_path = open_wheel_event_fd(self.wheel_info, require_ff=True)
@@ -3949,7 +5431,14 @@ class UnderSteer:
         # 仮想FFBデバイス作成直後に初期ゲイン設定
         # self.wheel_info.dev.fd に対して、Gain/AutoCenter
         try:
-            set_initial_ff_gain(self.wheel_info.dev.fd, 75)  # 75%などお好みで
+            # --ff-gain / --ff-autocenter（実行中は制御ソケットで変更可）
+            if self.ff_mapper.backend.name == "evdev":
+                set_initial_ff_gain(self.wheel_info.dev.fd, args.ff_gain, args.ff_autocenter)
+            else:
+                self.ff_mapper.backend.set_level(ecodes.FF_AUTOCENTER, int(args.ff_autocenter / 100.0 * 0xFFFF))
+                self.ff_mapper.backend.set_level(ecodes.FF_GAIN, int(args.ff_gain / 100.0 * 0xFFFF))
+            self.ui.ff_gain_pct = float(args.ff_gain)
+            self.ui.ff_autocenter_pct = float(args.ff_autocenter)
         except Exception as e:
             logging.warning(f"Failed to set initial FFB gain: {e}")
             traceback.print_exc()
@@ -3973,35 +5462,258 @@ class UnderSteer:
         logging.info("---")
         logging.info("")
 
-    def _ensure_btn_co(self):
-        if getattr(self, "_btn_co", None) is None:
-            from evdev import ecodes as E
-            def _emit_btn(code, val):
-                try:
-                    self.ui.write(E.EV_KEY, int(code), 1 if val else 0)
-                except Exception:
-                    logging.exception("[btn_co] emit failed (code=%r val=%r)", code, val)
-            self._btn_co = _ButtonCoalesce(_emit_btn)
+    def _compile_runtime(self, routing: MappingRouting, gear_mapper, keymap, loop) -> _RouteTable:
+        """routing からホットパス用のテーブル一式を組む（ui への書き込みはしない。別スレッド可）"""
+        rt = _RouteTable()
+        rt.routing = routing
+        rt.src2virt_abs = routing.src2virt_abs
+        rt.axis_chains = self._compile_axis_chains(routing)
+        # ボタン合流（物理→仮想の OR をビットマスクで）。SYN は物理側の SYN_REPORT で
+        rt.buttons = _ButtonMergeEngine(self._emit_key, debug=self.debug_merge, name_resolver=key_name)
+        rt.buttons.compile(routing.src2virt_key)
+        # HAT 合流（TSV で仮想 HAT へ向いているソースだけ ID を振る）
+        rt.hat = _HatCoalesce(self._emit_abs, mode=self.mapping_mode)
+        if not rt.hat.compile(routing.src2virt_abs):
+            rt.hat = None
+        # 仮想軸の出力レート制限（TSV の RATE=<Hz>）。指定が無ければ None
+        rt.axis_rate = self._build_axis_rate_limiter(routing, loop)
+        rt.gear_mapper = gear_mapper
+        rt.keymap = keymap
+        rt.tel_index = self._tel.index_map() if self._tel is not None else None
+        # --ff-soft へステア生値を流す物理軸
+        rt.ff_steer = ("wheel", ABS["steer"]) if self.soft_ff is not None else None
+        if keymap is not None:
+            keymap.bind_loop(loop)
+        return rt
+
+    def _emit_key(self, code: int, val: int):
+        self.ui.write(E.EV_KEY, code, val)
+
+    def _emit_abs(self, code: int, val: int):
+        self.ui.write(E.EV_ABS, code, val)
+
+    def _compile_axis_chains(self, routing: MappingRouting) -> Dict[Tuple[str, int], _AxisChain]:
+        """(src_tag, code) -> _AxisChain。TSV のオプションは先に出てきた行を採用"""
+        opts_by_src: Dict[Tuple[str, int], dict] = {}
+        for row in routing.rows:
+            if row.get("srcType") != "ABS":
+                continue
+            key = ((row.get("srcTag") or "").strip().lower(), int(row["srcAbs"]))
+            if key not in opts_by_src and isinstance(row.get("options"), dict):
+                opts_by_src[key] = row["options"]
+
+        chains: Dict[Tuple[str, int], _AxisChain] = {}
+        for key, src in self._abs_src_meta.items():
+            vabs = routing.src2virt_abs.get(key)
+            if vabs is None:
+                vabs = self._abs_map.get(key)
+            dst = self._abs_meta.get(vabs) if vabs is not None else None
+            if dst is None:
+                continue
+            dz_pct = 100.0 * dst.get("dz_raw", 0) / max(1, dst["max"] - dst["min"])
+            opts = opts_by_src.get(key)
+            chains[key] = _AxisChain(src["min"], src["max"], dst["min"], dst["center"], dst["max"],
+                                     opts, dz_default_pct=dz_pct)
+            if opts and (len(opts) > 1 or opts.get("reverse")):
+                logging.info("[mapping] axis %s:%s -> %s %s", key[0], abs_name(key[1]), abs_name(vabs),
+                             " ".join(f"{k}={v}" for k, v in opts.items() if v not in (False, None)))
+        return chains
+
+    def _build_axis_rate_limiter(self, routing: MappingRouting, loop) -> Optional[_AxisRateLimiter]:
+        """TSV の RATE= を仮想軸ごとに集約（同じ仮想軸に複数指定があれば高い方）"""
+        rates: Dict[int, int] = {}
+        for row in routing.rows:
+            opts = row.get("options")
+            if row.get("srcType") != "ABS" or not isinstance(opts, dict):
+                continue
+            hz = opts.get("rate")
+            if hz:
+                vabs = int(row["virtAbs"])
+                rates[vabs] = max(rates.get(vabs, 0), int(hz))
+        # 制御ソケットでの上書き（0 = 制限なし）。再読込後も残す
+        for vabs, hz in self._rate_overrides.items():
+            if hz > 0:
+                rates[vabs] = hz
+            else:
+                rates.pop(vabs, None)
+        if not rates:
+            return None
+        logging.info("[mapping] output rate limit: %s",
+                     ", ".join(f"{abs_name(v)}={hz}Hz" for v, hz in rates.items()))
+        return _AxisRateLimiter(loop, self._emit_abs, self.ui.syn, rates)
+
+    # ------------------------
+    # ホットリロード
+    # ------------------------
+    def _start_config_watch(self):
+        args = self.args
+        paths = [p for p in (args.mapping_axes, args.mapping_buttons,
+                             getattr(args, "gear_map", None), getattr(args, "keymap", None)) if p]
+        try:
+            self._watcher = _ConfigWatcher(asyncio.get_running_loop(), paths, self._on_config_changed)
+            logging.info("[reload] watching: %s", ", ".join(paths))
+        except OSError as e:
+            logging.warning("[reload] inotify unavailable, hot reload disabled: %s", e)
+
+    def _on_config_changed(self, paths: Set[str]):
+        # 再読込中に来た変更は溜めておき、終わったらもう一度
+        self._reload_pending |= paths
+        if self._reload_task is None or self._reload_task.done():
+            self._reload_task = asyncio.get_running_loop().create_task(self._reload_config())
+
+    async def _reload_config(self):
+        loop = asyncio.get_running_loop()
+        while self._reload_pending:
+            changed, self._reload_pending = self._reload_pending, set()
+            logging.info("[reload] changed: %s", ", ".join(sorted(changed)))
+            try:
+                # パース/LUT 生成/uinput キーボード作成は executor 側で（入力ループを止めない）
+                rt = await loop.run_in_executor(None, self._build_runtime_for, changed, self._route_loop)
+            except Exception as e:
+                logging.error("[reload] failed, keeping current mapping: %s", e)
+                continue
+            if self._epoll is not None:
+                # 入力スレッド側で差し替える（ルーティング中に旧テーブルを離さない）
+                self._epoll.call_soon_threadsafe(self._swap_runtime, rt)
+            else:
+                self._swap_runtime(rt)
+
+    def _build_runtime_for(self, changed: Set[str], loop) -> _RouteTable:
+        # RT 優先度の入力スレッドから生えた executor スレッドは設定を継承するので通常に戻す
+        rt_leave_thread(self.rt_cfg)
+        args, cur = self.args, self._rt
+        routing = cur.routing
+        if args.mapping_axes in changed or args.mapping_buttons in changed:
+            routing = build_routing_from_tsv(args.mapping_axes, args.mapping_buttons,
+                                             cache_path=getattr(args, "mapping_cache", None))
+        gear_mapper = cur.gear_mapper
+        if args.gear_map and args.gear_map in changed:
+            gear_mapper = GearMapper(Path(args.gear_map))
+        keymap = cur.keymap
+        if args.keymap and args.keymap in changed:
+            keymap = KeymapTSV(Path(args.keymap))
+        return self._compile_runtime(routing, gear_mapper, keymap, loop)
+
+    # ------------------------
+    # 制御ソケット
+    # ------------------------
+    def control_snapshot(self) -> dict:
+        ui = self.ui
+        rates = {}
+        if self._rt.axis_rate is not None:
+            rates = {abs_name(v): round(1.0 / b.period) for v, b in self._rt.axis_rate._bucket_of.items()}
+        return {
+            "gain": ui.ff_gain_pct,
+            "autocenter": ui.ff_autocenter_pct,
+            "ff_gap_ms": ui._min_ff_gap_sec * 1000.0,
+            "loop_wait_ms": ui._loop_wait_sec * 1000.0,
+            "ignore_ff": sorted(FF_NAMES.get(t, str(t)) for t in ui.ff_ignored),
+            "rate": rates,
+            "ff_mix": self.ff_mapper.mixer.snapshot() if self.ff_mapper.mixer is not None else None,
+        }
 
-    def _handle_key_event(self, src_tag, ev, keymap=None, gear_mapper=None):
+    def apply_control(self, req: dict):
         """
-        EV_KEY を TSV マッピングで仮想ボタンへ写像し、_ButtonCoalesce で OR 合流。
-        Keymap/GearMapper が先に消費した場合は何もしない。
+        "set" の中身を検証して振り分ける（ループ上で呼ぶ）。
+        FF 側（gain/autocenter/ペーシング/無視 type）は FF サーバスレッドのキューへ、
+        RATE はルーティングを回しているループへ。全項目を検証し終えてから積む（途中で失敗したら何も変えない）
         """
-        # ev.code (物理), ev.value(0/1)
-        kcode = ev.code
-        val = 1 if ev.value else 0
-        vcode = self.map_src2virt_key.get(("KEY", kcode))
-        if vcode is None:
-            if self.debug_merge:
-                print(f"[MERGE] no mapping for KEY {kcode}")
-            return
-        # --- 合流器を通す ---
-        for (vc, new_state) in self._button_merger.update(("KEY", kcode), vcode, val):
-            self.ui.write(E.EV_KEY, vc, new_state)
-            self.ui.syn()
-            if self.debug_merge:
-                print(f"[MERGE] EMIT ui.write(EV_KEY, {vc}, {new_state})")
+        ui = self.ui
+        ops = []
+        if "gain" in req:
+            gain = _ctl_range(req["gain"], 0, 100, "gain")
+            ops.append(lambda: ui.set_ff_level(E.FF_GAIN, gain))
+        if "autocenter" in req:
+            ac = _ctl_range(req["autocenter"], 0, 100, "autocenter")
+            ops.append(lambda: ui.set_ff_level(E.FF_AUTOCENTER, ac))
+        if "ff_gap_ms" in req:
+            gap = _ctl_range(req["ff_gap_ms"], 0, 50, "ff_gap_ms") / 1000.0
+            ops.append(lambda: setattr(ui, "_min_ff_gap_sec", gap))
+        if "loop_wait_ms" in req:
+            wait = _ctl_range(req["loop_wait_ms"], 0.1, 50, "loop_wait_ms") / 1000.0
+            ops.append(lambda: setattr(ui, "_loop_wait_sec", wait))
+        if "ignore_ff" in req:
+            ignored = frozenset(_ctl_ff_type(x) for x in req["ignore_ff"])
+            ops.append(lambda: setattr(ui, "ff_ignored", ignored))
+        if "ff_mix" in req:
+            if self.ff_mapper.mixer is None:
+                raise ValueError("ff_mix needs --ff-soft")
+            gains = parse_ff_mix_gains(req["ff_mix"])
+            ops.append(lambda: self._apply_ff_mix_gains(gains))
+        rates = None
+        if "rate" in req:
+            rates = {}
+            for name, hz in dict(req["rate"]).items():
+                code = _resolveAbsCode(name) if isinstance(name, str) else int(name)
+                if code is None:
+                    raise ValueError(f"unknown axis: {name}")
+                rates[int(code)] = int(_ctl_range(hz, 0, 2000, "rate"))
+
+        for fn in ops:
+            ui.post_ff_control(fn)
+        if rates is not None:
+            self._route_loop.call_soon_threadsafe(self._set_axis_rates, rates)
+
+    def _apply_ff_mix_gains(self, gains: Dict[int, float]):
+        mixer = self.ff_mapper.mixer
+        for t, g in gains.items():
+            if t == 0:
+                mixer.gain = g
+            else:
+                mixer.set_type_gain(t, g)
+
+    def _set_axis_rates(self, rates: Dict[int, int]):
+        # ルーティングのループ上で実行。RATE だけ作り直したテーブルに差し替える
+        self._rate_overrides.update(rates)
+        old = self._rt
+        new = _RouteTable()
+        for k in _RouteTable.__slots__:
+            setattr(new, k, getattr(old, k))
+        new.axis_rate = self._build_axis_rate_limiter(old.routing, self._route_loop)
+        self._rt = new
+        if old.axis_rate is not None:
+            old.axis_rate.close()
+
+    def _missing_outputs(self, rt: _RouteTable) -> List[str]:
+        """新しいルーティングが出力したいのに仮想デバイスが expose していないコード"""
+        keys = set(self.ui.ui_caps.get(E.EV_KEY, []))
+        axes = {code for code, _ in self.ui.ui_caps.get(E.EV_ABS, [])}
+        want_keys = set(rt.routing.src2virt_key.values())
+        if rt.gear_mapper is not None:
+            want_keys.update(GearMapper.STD_GEAR_CODES + [GearMapper.STD_NEUTRAL])
+        want_axes = set(rt.routing.src2virt_abs.values())
+        return [key_name(c) for c in sorted(want_keys - keys)] + [abs_name(c) for c in sorted(want_axes - axes)]
+
+    def _swap_runtime(self, new: _RouteTable):
+        """ループ上で呼ぶ。旧テーブルが押しっぱなしにしている仮想出力を離してから差し替える"""
+        old = self._rt
+        # 起動時から expose されていない出力は除き、今回新たに必要になったものだけ警告
+        missing = [n for n in self._missing_outputs(new) if n not in set(self._missing_outputs(old))]
+        if missing:
+            logging.warning("[reload] virtual device does not expose %s; restart to apply those outputs",
+                            ", ".join(missing))
+        old.buttons.release_all()
+        if old.hat is not None:
+            old.hat.release_all()
+        if old.gear_mapper is not None and old.gear_mapper is not new.gear_mapper:
+            old.gear_mapper.release_to(self.ui)
+        if old.axis_rate is not None:
+            old.axis_rate.close()
+
+        self._rt = new
+        self.routing = new.routing
+        self.mapping_virt2src = new.routing.virt2src
+        self.mapping_src2virt = new.routing.src2virt
+        self.map_src2virt_abs = new.routing.src2virt_abs
+        self.map_src2virt_key = new.routing.src2virt_key
+        self.gear_mapper = new.gear_mapper
+        self.keymap = new.keymap
+        self.ui.syn()
+
+        if old.keymap is not None and old.keymap is not new.keymap:
+            old.keymap.close()
+        logging.info("[reload] applied (axes_groups=%d, buttons_groups=%d)",
+                     new.routing.axes_groups, new.routing.button_groups)
 
     def center_all_axes(self):
         abs_caps = self.ui.ui_caps.get(ecodes.EV_ABS, [])
@@ -4042,215 +5754,13 @@ class UnderSteer:
         """
         logging.debug(f"UnderSteer:_pipe_events loop init (%s)", src_tag)
 
-        import evdev
-        telem = RateLimitedLogger(min_interval_ms=5000, min_delta=100)
-        latest = defaultdict(int)
-        
-        # 可能なら初期値を一度読む
-        try:
-            absinfo = src.absinfo
-            for name, code in ABS.items():
-                if code in absinfo:
-                    latest[name] = absinfo[code].value
-        except Exception:
-            pass
+        self._init_telemetry(src, src_tag)
 
         try:
             print(f"[LoopStart(Rd] : <{src_tag}>")
             async for ev in src.async_read_loop():
-                hat_name = None
-                # HAT 方向名（-1/0/1 の遷移を押下/解放として管理）
-                if ev.type == ecodes.EV_ABS:
-                    if ev.code in (ecodes.ABS_HAT0X, ecodes.ABS_HAT0Y, ecodes.ABS_HAT1X, ecodes.ABS_HAT1Y):
-                        hat_name = self._hat_dir_name(ev.code, int(ev.value))
-                
-                # For Logging
-                if ev.type == evdev.ecodes.EV_ABS:
-                    # 最新値の更新
-                    for name, code in ABS.items():
-                        if ev.code == code:
-                            latest[name] = ev.value
-                            break
-
-                if self.DEBUG_TELEMETORY:
-                    # ★ 定期/変化時テレメトリ出力（軽量）
-                    snapshot = {
-                        "steer": latest.get("steer", 0),
-                        "thr":   latest.get("throttle", 0),
-                        "brk":   latest.get("brake", 0),
-                        "clt":   latest.get("clutch", 0),
-                        # ついでに内部状態を少し：キュー長やFFスロット利用状況など
-                        "q": getattr(self, "_ev_queue_size", 0),
-                        "ff_used": getattr(self, "_phys_ff_used", -1),   # 任意: 実装に合わせて更新
-                        "ff_cap": getattr(self, "_phys_ff_cap", -1),
-                    }
-                    if telem.should_emit(snapshot):
-                        logging.debug(
-                            "[TEL] steer=%6d thr=%5d brk=%5d clt=%5d",
-                            snapshot["steer"], snapshot["thr"], snapshot["brk"], snapshot["clt"],
-                        )
-
-                # 押したボタン名のエコー（TSV作成補助）
-                if self.echo_buttons and ev.type == ecodes.EV_KEY and ev.value == 1:
-                    name = code_to_name(ev.code)
-                    print(f"[tap][{src_tag}] {name} ({ev.code})", flush=True)
-                    if self.echo_buttons_tsv:
-                        # そのまま keymap の素材にできるようタブ区切りテンプレ行も出す
-                        print(f"{name}\tKEY_???", flush=True)
-
-                # HAT 方向名（-1/0/1 の遷移を押下/解放）
-                if ev.type == ecodes.EV_ABS:
-                    if ev.code in (ecodes.ABS_HAT0X, ecodes.ABS_HAT0Y) or \
-                      hasattr(ecodes, "ABS_HAT1X") and ev.code in (ecodes.ABS_HAT1X, ecodes.ABS_HAT1Y):
-                        # ニュートラルの時にしか、HATのキーボード「a,w,s,d」を送らない
-                        if GearMapper.neutralFlg:
-                            key = (src_tag, ev.code)
-                            prev = self._hat_state.get(key, 0)
-                            cur = int(ev.value)
-                            # 例: 0→1 で RIGHT 押下, 1→0 で RIGHT 解放, -1→1 は LEFT解放→RIGHT押下
-                            # まず前の方向を解放
-                            if prev != 0:
-                                prev_name = self._hat_dir_name(ev.code, prev)
-                                if prev_name:
-                                    if self.echo_buttons:
-                                        print(f"[tap][{src_tag}] {prev_name} (release)", flush=True)
-                                    if self.echo_buttons_tsv:
-                                        print(f"{prev_name}\tKEY_???", flush=True)
-                                    if self.keymap and prev_name in self.keymap.watch_names:
-                                        try:
-                                            self.keymap.handle_named(prev_name, False)
-                                        except Exception as e:
-                                            logging.error(f"[keymap] handle_named(release,{prev_name}) failed: {e}")
-                            # 次に新しい方向を押下
-                            if cur != 0:
-                                cur_name = self._hat_dir_name(ev.code, cur)
-                                if cur_name:
-                                    if self.echo_buttons:
-                                        print(f"[tap][{src_tag}] {cur_name} (press)", flush=True)
-                                    if self.echo_buttons_tsv:
-                                        print(f"{cur_name}\tKEY_???", flush=True)
-                                    if self.keymap and cur_name in self.keymap.watch_names:
-                                        try:
-                                            self.keymap.handle_named(cur_name, True)
-                                        except Exception as e:
-                                            logging.error(f"[keymap] handle_named(press,{cur_name}) failed: {e}")
-                            self._hat_state[key] = cur
-
-                SendKey = False
-                # キーボード送出（TSV）: 対象元（wheel/shift/both）と EV_KEY のみ処理
-                if (self.keymap and ev.type == ecodes.EV_KEY and (self.keymap_source == "both" or self.keymap_source == src_tag)):
-                    if ev.code in self.keymap.watch_codes:
-                        try:
-                            self.keymap.handle_src_event(ev.code, ev.value)
-                            SendKey = True
-                        except Exception as e:
-                            logging.error(f"[keymap] handle_src_event failed for code={ev.code}, val={ev.value}: {e}")
-
-                    kcode = int(ev.code)
-                    kval  = 1 if ev.value else 0
-                    # ▼ 必ず先に初期化してから解決（NameError対策）
-                    vbtn_code = None
-                    mp = getattr(self, "map_src2virt_key", None)
-                    if isinstance(mp, dict):
-                        # 優先: (src_tag, code) で検索（wheel/shift/pad の衝突回避）
-                        vbtn_code = mp.get((src_tag, kcode))
-                        if not isinstance(vbtn_code, int):
-                            # 互換: ("KEY", code) でも検索（古いTSV/ローダ用）
-                            vbtn_code = mp.get(("KEY", kcode))
-                    # 最後のフォールバック（未定義なら None のまま）
-                    if not isinstance(vbtn_code, int):
-                        vbtn_code = self._map_src_key_to_virtual(src_tag, kcode)
-
-                    # 【Shift の場合】
-                    if src_tag == "shift" and self.gear_mapper:
-                        # ギア関連キーであれば吸収 → 標準化出力に置換
-                        changed = self.gear_mapper.feed_input_key(kcode, ev.value)
-                        # “ギア定義に含まれるキー”は素通し抑止
-                        if kcode in self.gear_mapper.watch_codes:
-                            if changed:
-                                self.gear_mapper.emit_to(self.ui)
-                            # 置換優先：元イベントはここで止める
-                            continue
-
-                if ev.type == ecodes.EV_KEY:
-                    kcode = int(ev.code)
-                    kval  = 1 if ev.value else 0
-
-                    # ▼ 必ず先に初期化してから解決
-                    vbtn_code = None
-                    mp = getattr(self, "map_src2virt_key", None)
-                    if isinstance(mp, dict):
-                        # 優先: (src_tag, code) で検索（wheel/shift/pad の衝突回避）
-                        vbtn_code = mp.get((src_tag, kcode))
-                        if not isinstance(vbtn_code, int):
-                            # 互換: ("KEY", code) でも検索（古いTSV/ローダ用）
-                            vbtn_code = mp.get(("KEY", kcode))
-                    # 最後のフォールバック（未定義なら None のまま）
-                    if not isinstance(vbtn_code, int):
-                        vbtn_code = self._map_src_key_to_virtual(src_tag, kcode)
-
-                    # 物理(KEY, code) → 仮想 BTN_* “実コード”へ直接出力
-                    if isinstance(vbtn_code, int):
-                        self.ui.emit(E.EV_KEY, vbtn_code, kval)
-                        continue
-                    # フォールバック：マップ無しは物理コードを素通し
-                    self.ui.emit(E.EV_KEY, kcode, kval)
-
-                elif ev.type == ecodes.EV_ABS:
-                    v = ev.value
-                    vabs = None
-                    if getattr(self, "map_src2virt_abs", None):
-                        # GroupId ルーティングは (src_tag, code) で引く（デバイス間衝突を防ぐ）
-                        vabs = self.map_src2virt_abs.get((src_tag, int(ev.code)))
-                    if vabs is None:
-                        vabs = self._map_src_abs_to_virtual(src_tag, ev.code)  # 既定フォールバック
-
-                    #if v in (-1, 0, 1):  # HATなどの軸範囲が -1〜1 の場合
-                    #    v *= 32767  （削除：スケーラに任せる）
-                    routed = False
-                    if self._hat_co and ("ABS", int(ev.code)) in self.mapping_src2virt:
-                        for vname in self.mapping_src2virt[("ABS", int(ev.code))]:
-                            if vname in ("ABS_HAT0X","ABS_HAT0Y"):
-                                vcode = getattr(ecodes, vname, None)
-                                if isinstance(vcode, int):
-                                    self._hat_co.on(vname, vcode, src_tag, int(ev.code), int(v))
-                                    routed = True
-                    if routed:
-                        continue
-
-                    # REVERSE 指定があれば反転（axisMappings を参照）
-                    try:
-                        ent = _findReverseOption(axisMappings, src_tag, ev.code)  # 下で定義
-                        logging.debug(ent)
-                        logging.debug(ent.get("reverse"))
-                        if ent and ent.get("reverse"):
-                            
-                            try:
-                                ai = src.absinfo(int(ev.code))
-                                smin, smax = int(ai.min), int(ai.max)
-                            except Exception:
-                                # フォールバック（必要に応じて環境に合わせて調整）
-                                smin, smax = 0, 1023
-                            v = invertRawValue(int(v), smin, smax)
-                    except Exception:
-                        pass
-
-                    # スケール
-                    v_scaled = self._scale_abs_to_virtual(src_tag, ev.code, vabs, v)
-                    self.ui.emit(E.EV_ABS, vabs, v_scaled)
-
-                elif ev.type == ecodes.EV_FF:
-                    # 物理から FF が来るケースは稀だが一応無視
-                    pass
-                elif ev.type in (ecodes.EV_SYN,):
-                    pass
-                else:
-                    # その他は無視（EV_MSC, EV_REL など）
-                    pass
-                # Loop 完了したらここに来る
-                # 一通り終わったよ的な通知を出す
-                #self.ui.syn()
-                #time.sleep(LoopWait_sec / 100) #fcntl.ioctl の後、必要
+                # ルーティングはイベントごとに 1 回だけ読む（ホットリロードはこの参照の差し替え）
+                self._route_event(self._rt, src_tag, ev)
         except asyncio.CancelledError:
             # キャンセルで抜ける
             raise
@@ -4267,6 +5777,180 @@ class UnderSteer:
             except Exception:
                 pass
 
+    async def _run_epoll_thread(self):
+        # このタスクがキャンセルされてもスレッドは止まらない。停止と join は run() の finally で行う
+        await asyncio.get_running_loop().run_in_executor(self._epoll_ex, self._epoll_thread_main)
+
+    def _epoll_thread_main(self):
+        rt_enter_thread(self.rt_cfg, "input")
+        self._epoll.run()
+
+    def _add_epoll_source(self, src: InputDevice, src_tag: str):
+        """--loop epoll: evdev fd を _EpollLoop に登録。読めるだけ読んで同期ルーティング"""
+        self._init_telemetry(src, src_tag)
+        ep = self._epoll
+
+        def on_readable():
+            try:
+                for ev in src.read():
+                    self._route_event(self._rt, src_tag, ev)
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                ep.remove_reader(src.fd)
+                if e.errno == errno.ENODEV:  # 19: No such device
+                    logging.warning("Input disconnected: %s (%s)", src_tag, e)
+                else:
+                    logging.exception("read error on %s", src_tag)
+
+        ep.add_reader(src.fd, on_readable)
+        print(f"[LoopStart(Rd] : <{src_tag}> (epoll)")
+
+    def _init_telemetry(self, src: InputDevice, src_tag: str):
+        if self._tel is not None:
+            self._tel.seed(src, src_tag)
+
+    def _telemetry_extra(self) -> str:
+        # サンプリングタイマーからだけ呼ばれる（イベントごとには作らない）
+        used = self.ui.ff_mapper.slots_in_use() if getattr(self.ui, "ff_mapper", None) else -1
+        cap = getattr(self.wheel_info.dev, "ff_effects_count", -1)
+        return f" ff={used}/{cap}"
+
+    def _route_event(self, rt: _RouteTable, src_tag: str, ev):
+        """
+        物理イベント 1 個をルーティングして仮想デバイスへ書く（同期。asyncio/epoll 両バックエンド共通）
+        rt は呼び出し側が 1 イベントにつき 1 回だけ self._rt から読んだもの
+        """
+        # 押したボタン名のエコー（TSV作成補助）
+        if self.echo_buttons and ev.type == ecodes.EV_KEY and ev.value == 1:
+            name = code_to_name(ev.code)
+            print(f"[tap][{src_tag}] {name} ({ev.code})", flush=True)
+            if self.echo_buttons_tsv:
+                # そのまま keymap の素材にできるようタブ区切りテンプレ行も出す
+                print(f"{name}\tKEY_???", flush=True)
+
+        # HAT 方向名（-1/0/1 の遷移を押下/解放）
+        if ev.type == ecodes.EV_ABS:
+            if ev.code in (ecodes.ABS_HAT0X, ecodes.ABS_HAT0Y) or \
+              hasattr(ecodes, "ABS_HAT1X") and ev.code in (ecodes.ABS_HAT1X, ecodes.ABS_HAT1Y):
+                # ニュートラルの時にしか、HATのキーボード「a,w,s,d」を送らない
+                if rt.gear_mapper is None or rt.gear_mapper.neutralFlg:
+                    key = (src_tag, ev.code)
+                    prev = self._hat_state.get(key, 0)
+                    cur = int(ev.value)
+                    # 例: 0→1 で RIGHT 押下, 1→0 で RIGHT 解放, -1→1 は LEFT解放→RIGHT押下
+                    # まず前の方向を解放
+                    if prev != 0:
+                        prev_name = self._hat_dir_name(ev.code, prev)
+                        if prev_name:
+                            if self.echo_buttons:
+                                print(f"[tap][{src_tag}] {prev_name} (release)", flush=True)
+                            if self.echo_buttons_tsv:
+                                print(f"{prev_name}\tKEY_???", flush=True)
+                            if rt.keymap and prev_name in rt.keymap.watch_names:
+                                try:
+                                    rt.keymap.handle_named(prev_name, False)
+                                except Exception as e:
+                                    logging.error(f"[keymap] handle_named(release,{prev_name}) failed: {e}")
+                    # 次に新しい方向を押下
+                    if cur != 0:
+                        cur_name = self._hat_dir_name(ev.code, cur)
+                        if cur_name:
+                            if self.echo_buttons:
+                                print(f"[tap][{src_tag}] {cur_name} (press)", flush=True)
+                            if self.echo_buttons_tsv:
+                                print(f"{cur_name}\tKEY_???", flush=True)
+                            if rt.keymap and cur_name in rt.keymap.watch_names:
+                                try:
+                                    rt.keymap.handle_named(cur_name, True)
+                                except Exception as e:
+                                    logging.error(f"[keymap] handle_named(press,{cur_name}) failed: {e}")
+                    self._hat_state[key] = cur
+
+        SendKey = False
+        # キーボード送出（TSV）: 対象元（wheel/shift/both）と EV_KEY のみ処理
+        if (rt.keymap and ev.type == ecodes.EV_KEY and (self.keymap_source == "both" or self.keymap_source == src_tag)):
+            if ev.code in rt.keymap.watch_codes:
+                try:
+                    rt.keymap.handle_src_event(ev.code, ev.value)
+                    SendKey = True
+                except Exception as e:
+                    logging.error(f"[keymap] handle_src_event failed for code={ev.code}, val={ev.value}: {e}")
+
+            kcode = int(ev.code)
+
+            # 【Shift の場合】
+            if src_tag == "shift" and rt.gear_mapper:
+                # ギア関連キーであれば吸収 → 標準化出力に置換
+                changed = rt.gear_mapper.feed_input_key(kcode, ev.value)
+                # “ギア定義に含まれるキー”は素通し抑止
+                if kcode in rt.gear_mapper.watch_codes:
+                    if changed:
+                        rt.gear_mapper.emit_to(self.ui)
+                    # 置換優先：元イベントはここで止める
+                    return
+
+        if ev.type == ecodes.EV_KEY:
+            # 物理(KEY, code) → 仮想ボタン。合流は SYN_REPORT でまとめて評価
+            ent = rt.buttons.lookup(src_tag, ev.code)
+            if ent is None:
+                # TSV に無いキーは初出時に登録して物理コードを素通し
+                ent = rt.buttons.add(src_tag, ev.code, ev.code)
+            rt.buttons.press(ent, ev.value != 0)
+
+        elif ev.type == ecodes.EV_ABS:
+            v = ev.value
+            key = (src_tag, ev.code)
+            # テレメトリ（-vvv）: 追跡軸なら配列へ書くだけ。集計/出力はサンプリングタイマー側
+            if rt.tel_index is not None:
+                ti = rt.tel_index.get(key)
+                if ti is not None:
+                    self._tel.vals[ti] = v
+            if key == rt.ff_steer:
+                self.soft_ff.feed_pos(v)
+            # GroupId ルーティングは (src_tag, code) で引く（デバイス間衝突を防ぐ）
+            vabs = rt.src2virt_abs.get(key)
+            if vabs is None:
+                vabs = self._map_src_abs_to_virtual(src_tag, ev.code)  # 既定フォールバック
+            if vabs is None:
+                return
+
+            #if v in (-1, 0, 1):  # HATなどの軸範囲が -1〜1 の場合
+            #    v *= 32767  （削除：スケーラに任せる）
+            if rt.hat is not None:
+                sid = rt.hat.source_id(src_tag, ev.code)
+                if sid >= 0:
+                    rt.hat.update(sid, v)
+                    return
+
+            # 整形（反転/デッドゾーン/カーブ/平滑化はロード時にコンパイル済み）
+            # 同値は ui.write 側の差分キャッシュで捨てられる
+            chain = rt.axis_chains.get(key)
+            if chain is not None:
+                v_scaled = chain.process(v)
+            else:
+                v_scaled = self._scale_abs_to_virtual(src_tag, ev.code, vabs, v)
+            if rt.axis_rate is not None and vabs in rt.axis_rate:
+                # RATE 指定軸は最新値だけ保留し、定周期で送出
+                rt.axis_rate.submit(vabs, v_scaled)
+            else:
+                self.ui.write(E.EV_ABS, vabs, v_scaled)
+
+        elif ev.type == ecodes.EV_FF:
+            # 物理から FF が来るケースは稀だが一応無視
+            pass
+        elif ev.type == ecodes.EV_SYN:
+            # 物理フレームの区切りで仮想側も 1 回だけ SYN（変化が無ければ出さない）
+            if ev.code == ecodes.SYN_REPORT:
+                rt.buttons.commit()
+                self.ui.syn()
+                if self._h_input is not None:
+                    # evdev のタイムスタンプは CLOCK_REALTIME
+                    self._h_input.record_ns(time.time_ns() - (ev.sec * 1_000_000_000 + ev.usec * 1000))
+        else:
+            # その他は無視（EV_MSC, EV_REL など）
+            pass
+
     def register_abs_mapping_first_win(self, role, caps, deadzone_pct=0.025):
         abs_caps = caps.get(ecodes.EV_ABS, [])
         for code, ai in abs_caps:
@@ -4316,17 +6000,6 @@ class UnderSteer:
                  self._abs_meta[vabs] = {"min": amin, "max": amax, "center": center, "dz_raw": dz_raw}
         """
 
-    # 低速で実測センターを追従（静止時のみ）
-    def _track_center(self, role, code, raw):
-        key = (role, int(code))
-        meta = self._abs_src_meta.get(key); c = self._abs_src_center.get(key)
-        if not meta or c is None: return
-        smin, smax = meta["min"], meta["max"]
-        dz_src = max(1, int((smax - smin) * 0.025))   # 2.5% 相当
-        if abs(int(raw) - c) <= dz_src:
-            alpha = 0.02  # 遅めのEMAでドリフトだけ吸収
-            self._abs_src_center[key] = int(round((1-alpha)*c + alpha*int(raw)))
-
     @staticmethod
     def _lin_piecewise(raw, smin, c, smax, dmin, dc, dmax):
         r = int(raw)
@@ -4363,28 +6036,6 @@ class UnderSteer:
         key = (src_tag, int(src_abs_code))
         return self._abs_map.get(key, None)
 
-    # 追加：KEY 用フォールバック（レガシー互換）
-    # 目的:
-    #   - _pipe_events() 側から呼ばれる旧来のフォールバック呼び出しを解決
-    #   - まず (src_tag, code) を試し、無ければ ("KEY", code) を試す
-    #   - 見つからなければ None（呼び出し側で物理コード素通し）
-    def _map_src_key_to_virtual(self, src_tag: str, kcode: int):
-        try:
-            mp = getattr(self, "map_src2virt_key", None)
-            if not isinstance(mp, dict):
-                return None
-            # 1) 推奨：デバイス別キー（wheel/shift/pad）で検索
-            v = mp.get((src_tag, int(kcode)))
-            if isinstance(v, int):
-                return v
-            # 2) 互換：従来の ("KEY", code) で検索（古いTSV/古いローダ用）
-            v = mp.get(("KEY", int(kcode)))
-            if isinstance(v, int):
-                return v
-            return None
-        except Exception:
-            return None
-
     def _write_ff(self, wheel_dev, t, c, v):
         try:
             t0 = time.monotonic()
@@ -4416,17 +6067,53 @@ class UnderSteer:
                     # grab 不可でも実運用では続行したいケースが多い
                     logging.warning("grab failed (%s): %s", tag, e)
 
+        # 設定ファイルの書き換えを監視してホットリロード
+        if not getattr(self.args, "no_watch", False):
+            self._start_config_watch()
+
+        if self._tel is not None:
+            self._tel.start()
+        # 制御ソケット（gain/autocenter/FF ペーシング/無視 type/RATE を実行中に変更）
+        if getattr(self.args, "control", None):
+            try:
+                self._ctl = ControlServer(self, self.args.control)
+                await self._ctl.start()
+            except OSError as e:
+                logging.warning("[ctl] control socket disabled: %s", e)
+                self._ctl = None
+
+        # ライブ状態を /dev/shm へ（読み手は read_live_state を参照）
+        self._shm: Optional[LiveStateExporter] = None
+        if getattr(self.args, "shm", None):
+            try:
+                self._shm = LiveStateExporter(loop, self.args.shm, self, hz=self.args.shm_hz)
+                self._shm.start()
+                logging.info("[shm] live state -> %s (%d Hz)", self.args.shm, self.args.shm_hz)
+            except OSError as e:
+                logging.warning("[shm] disabled: %s", e)
+
+        # --rt: asyncio/uvloop では入力中継はこのスレッド（epoll は入力スレッド側で適用）
+        if self._epoll is None:
+            rt_enter_thread(self.rt_cfg, "input")
+
         print("")
         print("TaskGroup waiting Loop")
         # 例外が1タスクで起きたら全体を畳む実装（TaskGroup）
         try:
             async with asyncio.TaskGroup() as tg:
                 # 入力中継（wheel / shifter）
-                t1 = tg.create_task(self._pipe_events(self.wheel_info.dev, "wheel"))
-                t2 = tg.create_task(self._pipe_events(self.shifter_info.dev, "shift"))
-                self._tasks.extend([t1, t2])
+                if self._epoll is not None:
+                    self._add_epoll_source(self.wheel_info.dev, "wheel")
+                    self._add_epoll_source(self.shifter_info.dev, "shift")
+                    self._tasks.append(tg.create_task(self._run_epoll_thread()))
+                else:
+                    t1 = tg.create_task(self._pipe_events(self.wheel_info.dev, "wheel"))
+                    t2 = tg.create_task(self._pipe_events(self.shifter_info.dev, "shift"))
+                    self._tasks.extend([t1, t2])
                 # 明示停止が来るまで待つ（どれかが例外で落ちれば TaskGroup が伝播して抜ける）
                 await self._stop_ev.wait()
+                if self._epoll is not None:
+                    self._epoll.stop()
 
         except asyncio.CancelledError:
             # 外部からキャンセルされた場合
@@ -4439,6 +6126,12 @@ class UnderSteer:
         finally:
             
             # --- 安全に締める ---
+            # 0) epoll 入力スレッド停止。_route_event / マクロのタイマーが抜けるまで待ってから出力を閉じる
+            if self._epoll is not None:
+                self._epoll.stop()
+                self._epoll_ex.shutdown(wait=True)
+                self._epoll.close()
+
             # 1) UI close
             ui = getattr(self, "ui", None)
             if ui:
@@ -4456,12 +6149,32 @@ class UnderSteer:
                     except Exception:
                         pass
 
-            # 4) ff_worker 停止
-            if hasattr(self, "ff_worker") and self.ff_worker:
-                try:
-                    self.ff_worker.stop()
-                except Exception:
-                    pass
+            # 2) 設定監視・レート制限タイマー停止、再読込で作った keymap を閉じる
+            if self._watcher is not None:
+                self._watcher.close()
+            if self._reload_task is not None:
+                self._reload_task.cancel()
+            if self._tel is not None:
+                self._tel.close()
+            if getattr(self, "_shm", None) is not None:
+                self._shm.close()
+            if self._ctl is not None:
+                self._ctl.close()
+            rt = getattr(self, "_rt", None)
+            if rt is not None:
+                if rt.axis_rate is not None:
+                    rt.axis_rate.close()
+                if rt.keymap is not None:
+                    rt.keymap.close()
+
+            # 5) 遅延ヒストグラム
+            if self.rt_cfg or self.args.verbose:
+                for h in HISTOGRAMS.values():
+                    h.dump()
+
+            # 4) FF バックエンド（hidraw なら残ったスロットを止めて閉じる）
+            if getattr(self, "ff_mapper", None) is not None and self.ff_mapper.backend is not None:
+                self.ff_mapper.backend.close()
 
             logging.debug("async run: UnderSteer End.")
 
@@ -4503,65 +6216,6 @@ class UnderSteer:
         except Exception:
             return None
 
-    def _open_ff_target(self):
-        """
-        FFB は /dev/input/eventX に対して行うため、wheel_info.dev を event 起点で渡す。
-        hidraw は任意（ログ用途）。無ければ None で構わない。
-        """
-        # wheel_info.dev は evdev.InputDevice（/dev/input/eventX）
-        dev = self.wheel_info.dev
-        if dev is None:
-            raise RuntimeError("wheel_info.dev is None (event device not available)")
-
-        # hidraw パスが取れているなら渡す（無くてもOK）
-        hidraw_path = getattr(self.wheel_info, "hidraw_path", None) or "(no-hidraw)"
-
-        # 推奨：event_dev を渡す
-        return HidrawHandle(hidraw_path=hidraw_path, event_dev=dev)
-        # または event_path を渡す
-        #return HidrawHandle(hidraw_path=hidraw_path, event_path=dev.path)
-
-    def _translate_ff_event_to_op(self, ev):
-        """
-        EV_FF 入力イベントを FFBProxy 用の操作(op)に変換する。
-        返り値は (kind, payload) のタプル。
-          kind: "gain" | "autocenter" | "play" | "stop"
-          payload: dict（必要なパラメータを格納）
-        未対応/不要イベントは None を返す。
-        """
-        from evdev import ecodes
-
-        logging.error("ここは使ってない")
-        if ev.type != ecodes.EV_FF:
-            return None
-
-        code = ev.code      # FF_GAIN(96) / FF_AUTOCENTER(97) / それ以外は effect_id
-        value = ev.value    # 0=停止, >0=再生(繰返し回数の意味合いを持つこともある)
-        
-        # 管理系だけはコードで分岐
-        if code == ecodes.FF_GAIN:
-            # 生値(0..65535)のまま渡す。スケーリングは送出側で。
-            logging.debug("gain")
-            return ("gain", {"gain": int(value)})
-
-        if code == ecodes.FF_AUTOCENTER:
-            # 生値(0..65535)のまま渡す。0=OFF, >0=ON(強さ)
-            logging.debug("autocenter")
-            return ("autocenter", {"autocenter": int(value)})
-
-        if self.ff_passthrough_easy:
-            return None
-
-        # ここからは「エフェクトの再生/停止」トリガ
-        # code は "effect_id"（upload 済みの ID）、value は 0/非0（停止/再生）
-        effect_id = int(code)
-
-        if value:
-            # 一部ドライバは value を繰返し回数として使うことがあるため温存
-            return ("play", {"effect_id": effect_id, "repeat": int(value)})
-        else:
-            return ("stop", {"effect_id": effect_id})
-
 import fcntl
 import ctypes
 from evdev import ecodes
@@ -4616,6 +6270,48 @@ def build_argparser():
                    help="軸マッピングTSV（空行でグループ化。上から順に仮想へ割当）")
     p.add_argument("--mapping-buttons", default="mapping_buttons.tsv",
                    help="ボタンマッピングTSV（空行でグループ化。上から順に仮想へ割当）")
+    p.add_argument("--mapping-cache", nargs="?", const=".mapping.cache", default=None, metavar="PATH",
+                   help="TSV のコンパイル結果をキャッシュ（TSV の mtime/size と evdev 版が同じなら再パースしない。既定: .mapping.cache）")
+    p.add_argument("--loop", choices=["asyncio", "uvloop", "epoll"], default="asyncio",
+                   help="入力中継のイベントループ: asyncio（既定）/ uvloop（要 pip install uvloop）/ "
+                        "epoll（専用スレッドで evdev fd を直接 epoll。FF 処理は従来どおり）")
+    p.add_argument("--out-writer", choices=["direct", "thread"], default="direct",
+                   help="仮想デバイスへの出力: direct（既定。SYN のたびにそのフレームを呼び出し元で 1 write）/ "
+                        "thread（専用スレッドが複数リングのフレームをまとめて 1 write。書き手が 1 つなら起床のぶん重い）")
+    p.add_argument("--rt", action="store_true",
+                   help="入力中継/FF スレッドをリアルタイム優先度で動かし、mlockall でメモリを固定（権限が無ければ警告して続行）")
+    p.add_argument("--rt-policy", choices=["fifo", "rr"], default="fifo",
+                   help="--rt のスケジューリングポリシ（SCHED_FIFO / SCHED_RR）")
+    p.add_argument("--rt-prio", type=int, default=50, help="--rt 時の入力スレッド優先度（1..99）")
+    p.add_argument("--rt-ff-prio", type=int, default=None, help="--rt 時の FF スレッド優先度（既定: --rt-prio）")
+    p.add_argument("--rt-cpus", default=None, metavar="LIST",
+                   help="--rt 時に入力スレッドを固定する CPU（例: 2,3 / 2-3）")
+    p.add_argument("--rt-ff-cpus", default=None, metavar="LIST",
+                   help="--rt 時に FF スレッドを固定する CPU（既定: --rt-cpus）")
+    p.add_argument("--rt-prefault-mb", type=int, default=16,
+                   help="--rt 時に先に触っておくヒープ量（MB）")
+    p.add_argument("--shm", nargs="?", const="/dev/shm/understeer", default=None, metavar="PATH",
+                   help="仮想軸/ボタン/ギア/FF/遅延カウンタを共有メモリへ出力（seqlock。既定: /dev/shm/understeer）")
+    p.add_argument("--shm-hz", type=int, default=100, help="--shm の更新周期（Hz）")
+    p.add_argument("--ff-gain", type=float, default=75.0, help="起動時の FF ゲイン（%%）")
+    p.add_argument("--ff-autocenter", type=float, default=75.0, help="起動時のオートセンター（%%）")
+    p.add_argument("--ff-soft", nargs="?", const="condition", default=None, metavar="TYPES",
+                   help="FF をソフト合成する type（spring,damper,friction,inertia,periodic / condition=条件系 4 種）。"
+                        "物理へは FF_CONSTANT 1 本だけ送る。--ff-pass-through と併用")
+    p.add_argument("--ff-soft-hz", type=int, default=250, help="--ff-soft の出力更新周期（Hz）")
+    p.add_argument("--ff-soft-invert", action="store_true", help="--ff-soft の出力の向きを反転")
+    p.add_argument("--ff-backend", choices=("evdev", "hidraw", "auto"), default="evdev",
+                   help="物理ホイールへの FF 送信経路。hidraw: T300RS 系レポートを /dev/hidrawN へ直送"
+                        "（対応機種のみ）/ auto: 対応機種なら hidraw（既定: evdev）")
+    p.add_argument("--ff-hidraw", default=None, metavar="PATH",
+                   help="--ff-backend hidraw の書き込み先を明示（既定: wheel から自動検出）")
+    p.add_argument("--ff-mix-gain", default=None, metavar="SPEC",
+                   help="--ff-soft の合成ゲイン（%%）。例: spring=50,periodic=20,global=80")
+    p.add_argument("--control", nargs="?", const=_default_control_path(), default=None, metavar="PATH",
+                   help="実行中の調整用 Unix ソケット（JSON 1 行 = 1 コマンド。既定: "
+                        "$XDG_RUNTIME_DIR/understeer.sock、無ければ /tmp/understeer-<uid>/understeer.sock）")
+    p.add_argument("--no-watch", action="store_true",
+                   help="mapping TSV / --gear-map / --keymap の変更監視（自動再読込）を無効化")
     p.add_argument("--mapping-mode", choices=["priority","last"], default="priority",
                    help="HAT合流の挙動: priority=グループ内の上から順 / last=最後に動いたソース")
     p.add_argument("--keymap", help="ボタン→キーストロークのTSVファイル")
@@ -4650,46 +6346,11 @@ def find_by_path(infos: List[DevInfo], path: str) -> Optional[DevInfo]:
 
 def list_button_names(devinfo, label):
     try:
-        caps_v = devinfo.dev.capabilities(verbose=True)   # 文字ラベル付き
-        caps_n = devinfo.dev.capabilities(verbose=False)  # 数値キー
-
-        # --- EV_KEY の値リストを取り出す（verbose=True を優先） ---
-        key_entries = None
-        # verbose=True: キーが ('EV_KEY', 1) みたいなタプル
-        for k, v in caps_v.items():
-            #time.sleep(0.002)  # ★空振り時のCPU張り付き防止（2ms）
-            if isinstance(k, tuple) and len(k) >= 1 and k[0] == 'EV_KEY':
-                key_entries = v
-                break
-        # フォールバック: verbose=False（キーが数値 ecodes.EV_KEY）
-        if key_entries is None and ecodes.EV_KEY in caps_n:
-            # 数値版は値が単なるコード配列なので、(desc, code) 形に揃える
-            key_entries = [ (None, code) for code in caps_n[ecodes.EV_KEY] ]
-
-        if not key_entries:
+        codes = devinfo.dev.capabilities(verbose=False).get(ecodes.EV_KEY, [])
+        if not codes:
             print(f"[i] {label}: (no buttons)")
             return
-
-        names = []
-        for entry in key_entries:
-            #time.sleep(0.002)  # ★空振り時のCPU張り付き防止（2ms）
-            # verbose=True: entry は (desc, code)。desc は 'BTN_...' 文字列 か ('BTN_JOYSTICK','BTN_TRIGGER') のタプル
-            if isinstance(entry, tuple) and len(entry) == 2:
-                desc, code = entry
-                if isinstance(desc, tuple) and desc:
-                    # 別名タプルなら末尾（より具体的な方が多い）を採用
-                    name = desc[-1]
-                elif isinstance(desc, str):
-                    name = desc
-                else:
-                    # verbose=False からの整形時 or desc 不明 → 逆引きで名前化
-                    name = ecodes.BTN.get(code) or ecodes.KEY.get(code) or f"KEY_{code}"
-                names.append(name)
-            else:
-                # 想定外形：コードだけ来た場合
-                code = entry if isinstance(entry, int) else None
-                name = (ecodes.BTN.get(code) or ecodes.KEY.get(code) or f"KEY_{code}") if code is not None else "UNKNOWN"
-                names.append(name)
+        names = [key_name(code) for code in codes]
 
         # 重複除去＆安定ソート
         uniq = sorted(set(names))
@@ -4742,6 +6403,12 @@ async def main():
         to_stderr=True,
         log_file = None
     )
+    gil = gil_status()
+    if gil == "free-threaded":
+        logging.info("[py] free-threaded build, GIL disabled: input / FF / output threads run in parallel")
+    elif gil == "free-threaded-gil":
+        logging.warning("[py] free-threaded build but the GIL is enabled (an extension module such as evdev "
+                        "re-enabled it); set PYTHON_GIL=0 to force it off")
     infos = enumerate_input()
 
     print("")
@@ -4888,24 +6555,6 @@ async def main():
                 w.writerow(r); f.write("\n")
         print(f"[mapping] exported: {axes_path}, {btns_path}")
 
-    def _load_grouped(path: str):
-        groups, cur = [], []
-        if not os.path.exists(path): return groups
-        with open(path, "r", encoding="utf-8") as f:
-            for line in f:
-                if line.startswith("#"): continue
-                if not line.strip():
-                    if cur: groups.append(cur); cur=[]
-                    continue
-                cols = line.rstrip("\n").split("\t"); cols += ["" for _ in range(max(0,7-len(cols)))]
-                try:
-                    cols[0] = int(cols[0]) if str(cols[0]).strip().isdigit() else -1
-                    cols[5] = int(cols[5]) if str(cols[5]).strip().isdigit() else -1
-                except Exception: pass
-                cur.append(cols[:7])
-        if cur: groups.append(cur)
-        return groups
-
     mapping_virt2src, mapping_src2virt = {}, {}
 
     app = UnderSteer(
@@ -4954,5 +6603,14 @@ async def main():
 if __name__ == "__main__":
     if os.geteuid() != 0:
         print("[!] 実行には通常 root 権限が必要です（/dev/uinput, /dev/input/event* のアクセス）", file=sys.stderr)
-    rc = asyncio.run(main())
+    loop_kind = build_argparser().parse_known_args()[0].loop
+    loop_factory = None
+    if loop_kind == "uvloop":
+        try:
+            import uvloop
+            loop_factory = uvloop.new_event_loop
+        except ImportError:
+            print("[!] uvloop が見つかりません（pip install uvloop）。asyncio で起動します", file=sys.stderr)
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        rc = runner.run(main())
     sys.exit(rc)
\ No newline at end of file